@@ -0,0 +1,106 @@
+"""
+Aggregate WRF output files into daily or monthly means
+
+The inputs may be individual files or directories (such as a whole `${RUN_DIR}`),
+which are searched recursively for files matching the file pattern.
+Each file is streamed once; running sums are kept on disk next to the outputs
+so that an `--incremental` run only needs to read the newly arrived files.
+"""
+
+import logging
+
+import click
+
+from setup_runs.netcdf import NetCDFEncoding
+from setup_runs.wrf.aggregate_fields import (
+    PERIOD_FORMATS,
+    aggregate_fields,
+    find_files,
+)
+from setup_runs.wrf.average_fields import DEFAULT_MAX_CHUNK_BYTES, parse_patterns
+
+logger = logging.getLogger("aggregate_wrfout")
+
+
+@click.command()
+@click.option(
+    "-p",
+    "--period",
+    help="Period to aggregate over",
+    type=click.Choice(list(PERIOD_FORMATS)),
+    default="daily",
+)
+@click.option(
+    "-o",
+    "--output-dir",
+    help="Directory where the aggregates are written",
+    default=".",
+    type=click.Path(file_okay=False, dir_okay=True),
+)
+@click.option(
+    "--pattern",
+    help="Pattern used to find WRF output files within directories",
+    default="WRFOUT_*.nc",
+)
+@click.option(
+    "--incremental",
+    help="Fold new files into existing partial aggregates instead of replacing them",
+    is_flag=True,
+)
+@click.option(
+    "--max-chunk-bytes",
+    help="Maximum number of bytes to read from a variable at once",
+    default=DEFAULT_MAX_CHUNK_BYTES,
+    type=int,
+)
+@click.option(
+    "--complevel",
+    help="Deflate level of the aggregates (0 disables compression)",
+    default=4,
+    type=int,
+)
+@click.option(
+    "--include",
+    help="Comma-separated glob patterns of the variables to aggregate",
+    default=None,
+)
+@click.option(
+    "--exclude",
+    help="Comma-separated glob patterns of the variables to skip",
+    default=None,
+)
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+def main(
+    paths: tuple[str, ...],
+    period: str,
+    output_dir: str,
+    pattern: str,
+    incremental: bool,
+    max_chunk_bytes: int,
+    complevel: int,
+    include: str | None,
+    exclude: str | None,
+):
+    """
+    Aggregate WRF output files into daily or monthly means
+    """
+    files = find_files(list(paths), pattern)
+    logger.info("Found %d files to aggregate", len(files))
+
+    written = aggregate_fields(
+        files,
+        output_dir,
+        period=period,
+        incremental=incremental,
+        max_chunk_bytes=max_chunk_bytes,
+        encoding=NetCDFEncoding(complevel=complevel),
+        include=parse_patterns(include),
+        exclude=parse_patterns(exclude),
+    )
+    for path in written:
+        logger.info("Wrote %s", path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
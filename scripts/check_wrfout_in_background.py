@@ -5,9 +5,22 @@ Each output file is averaged into a single timestep and saved with a new filenam
 This is required because WRF reports instantaneous values at each timestep.
 Instead we want to average the values over a time period (in this case hourly).
 If the file is successfully processed, the original file is removed.
+
+When watching, inotify is used (on Linux) to pick up each file as soon as WRF closes it.
+On other platforms, or with `--poll`, the directory is polled instead.
+Note that inotify only sees writes made from the node the watcher runs on.
+
+The state of each file is recorded in a journal in the run directory
+so that unchanged files aren't re-read on every scan,
+an interrupted run resumes where it left off
+and the cleanup step can check that every file was processed (`--report`).
 """
 
+import concurrent.futures
 import datetime
+import fnmatch
+import signal
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
 import click
@@ -16,7 +29,23 @@ import os
 import time
 import logging
 
-from setup_runs.wrf.average_fields import average_fields
+from setup_runs.netcdf import NetCDFEncoding, parse_chunk_sizes
+from setup_runs.utils import fingerprint
+from setup_runs.watch import InotifyWatcher, inotify_available
+from setup_runs.wrf.journal import (
+    DONE,
+    FAILED,
+    JOURNAL_FILENAME,
+    JournalEntry,
+    PENDING,
+    PROCESSING,
+    ProcessingJournal,
+)
+from setup_runs.wrf.average_fields import (
+    average_fields,
+    parse_patterns,
+    DEFAULT_MAX_CHUNK_BYTES,
+)
 
 
 EXPECTED_TIMESTEPS = 12
@@ -48,45 +77,269 @@ def generate_out_filename(in_file: str):
     return out_file, time_str
 
 
-def process_file(in_file: Path, expected_steps: int | None):
+def count_steps(in_file: Path) -> int:
+    """
+    Number of time steps in a WRF output file
+    """
+    with netCDF4.Dataset(in_file) as nc:
+        return len(nc.dimensions["Time"])
+
+
+def process_file(in_file: Path, **average_kwargs) -> str:
     """
     Process a WRF output file into a single time step
 
+    The input file is removed once it has been successfully processed.
+
     Parameters
     ----------
     in_file
         File to process
-    expected_steps
-        The number of time steps expected in the input file
-        Ignored if None.
+    average_kwargs
+        Additional options passed to `average_fields`,
+        such as `max_chunk_bytes`, `n_workers`, `encoding`, `include` and `exclude`
+
+    Returns
+    -------
+        Name of the averaged file
+    """
+    out_file, time_str = generate_out_filename(in_file.name)
+
+    logger.info(f"Averaging {in_file} to {out_file}")
+    average_fields(in_file, out_file, time_str, **average_kwargs)
+
+    if not os.path.exists(out_file):
+        raise RuntimeError("output file not created")
+    logger.info("successfully processed. Removing old file")
+    os.remove(in_file)
+    return out_file
+
+
+class FileProcessor:
+    """
+    Process files in order using a bounded pool of worker processes
+
+    Files are queued in the order they are found and submitted to the pool
+    as workers become free, so that no more than `workers` files are averaged
+    at once and the pool never takes more cores than it was given.
+    A file is only ever queued once while it is waiting or being processed,
+    so rescanning the directory doesn't pick up files that are still in progress.
+
+    With a single worker, files are processed in the calling process.
+
+    If a journal is provided, the state of each file is recorded in it.
+    Unchanged files which have already been processed (or have failed) are skipped
+    and the number of time steps in a file is only read once.
+    Only this process writes to the journal; the workers just average the files.
+
+    If a worker process dies, the files it shared the pool with are recorded as failed
+    and a new pool is started for the files which are still queued.
     """
-    if expected_steps is not None:
-        with netCDF4.Dataset(in_file) as nc:
-            ntimes = len(nc.dimensions["Time"])
 
-        if ntimes != expected_steps:
+    def __init__(
+        self,
+        expected_steps: int | None,
+        workers: int = 1,
+        journal: ProcessingJournal | None = None,
+        retry_failed: bool = False,
+        **average_kwargs,
+    ):
+        self.expected_steps = expected_steps
+        self.workers = workers
+        self.journal = journal
+        self.retry_failed = retry_failed
+        self.average_kwargs = average_kwargs
+        self.pending: list[Path] = []
+        self.in_progress: dict[Path, concurrent.futures.Future] = {}
+        self._executor = (
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            if workers > 1
+            else None
+        )
+        if journal is not None:
+            for entry in journal.recover():
+                logger.warning("Processing of %s was interrupted, retrying", entry.path)
+
+    @property
+    def busy(self) -> bool:
+        """Are there files waiting for or being processed"""
+        return bool(self.pending or self.in_progress)
+
+    def queue(self, in_file: Path):
+        """Queue a file to be processed, unless it is already queued or in progress"""
+        if in_file in self.in_progress or in_file in self.pending:
+            return
+        if self._is_ready(in_file):
+            self.pending.append(in_file)
+
+    def _is_ready(self, in_file: Path) -> bool:
+        """Check if a file should be processed, updating the journal"""
+        if self.journal is not None:
+            entry = self._journal_entry(in_file)
+            if entry is None:
+                return False
+            nsteps = entry.nsteps
+        elif self.expected_steps is not None:
+            nsteps = self._count_steps(in_file)
+        else:
+            return True
+
+        if self.expected_steps is not None and nsteps != self.expected_steps:
             logger.debug(
-                "File %s has %d timesteps, expected %d", in_file, ntimes, expected_steps
+                "File %s has %s timesteps, expected %d",
+                in_file,
+                nsteps,
+                self.expected_steps,
             )
-            return
+            return False
+        return True
 
-    out_file, time_str = generate_out_filename(in_file.name)
+    def _count_steps(self, in_file: Path) -> int | None:
+        try:
+            return count_steps(in_file)
+        except OSError:
+            logger.debug("Could not read %s", in_file, exc_info=True)
+            return None
 
-    logger.info(f"Averaging {in_file} to {out_file}")
-    try:
-        average_fields(in_file, out_file, time_str)
-    except Exception:
-        logger.exception(f"Error processing {in_file}")
-        return
+    def _journal_entry(self, in_file: Path) -> JournalEntry | None:
+        """
+        Get the journal entry of a file, recording it as pending if it is new or changed
 
-    if not os.path.exists(out_file):
-        logger.error("output file not created")
-    else:
-        logger.info("successfully processed. Removing old file")
-        os.remove(in_file)
+        The number of steps is only read if the file has changed since it was recorded.
+        Returns None if the file has already been dealt with.
+        """
+        try:
+            current = fingerprint(in_file)
+        except FileNotFoundError:
+            return None
+        entry = self.journal.lookup(in_file)
+        if entry is not None and entry.matches(current):
+            if entry.state == DONE:
+                return None
+            if entry.state == FAILED and not self.retry_failed:
+                logger.debug("Skipping %s which previously failed", in_file)
+                return None
+            if entry.state == PENDING and entry.nsteps is not None:
+                return entry
+        return self.journal.record(
+            in_file,
+            PENDING,
+            nsteps=self._count_steps(in_file),
+            file_fingerprint=current,
+        )
+
+    def _record(self, in_file: Path, state: str, **kwargs):
+        if self.journal is not None:
+            self.journal.record(in_file, state, **kwargs)
+
+    def _finished(
+        self, in_file: Path, out_file: str | None, error: BaseException | None
+    ):
+        if error is None:
+            self._record(in_file, DONE, output=out_file)
+        else:
+            logger.error("Error processing %s", in_file, exc_info=error)
+            self._record(in_file, FAILED, error=repr(error))
+
+    def _collect(self):
+        """Record the outcome of the files which have finished"""
+        for in_file, future in list(self.in_progress.items()):
+            if future.cancelled():
+                ## left in the processing state, to be reset by `ProcessingJournal.recover`
+                del self.in_progress[in_file]
+            elif future.done():
+                del self.in_progress[in_file]
+                error = future.exception()
+                self._finished(in_file, None if error else future.result(), error)
+
+    def _submit(self, in_file: Path) -> concurrent.futures.Future:
+        try:
+            return self._executor.submit(process_file, in_file, **self.average_kwargs)
+        except BrokenProcessPool:
+            ## the files which were running fail with the pool (see `_collect`)
+            logger.warning("A worker process died, starting a new pool")
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers
+            )
+            return self._executor.submit(process_file, in_file, **self.average_kwargs)
+
+    def dispatch(self):
+        """Collect finished files and submit queued files to any free workers"""
+        self._collect()
+
+        while self.pending and len(self.in_progress) < self.workers:
+            in_file = self.pending.pop(0)
+            self._record(
+                in_file, PROCESSING, output=generate_out_filename(in_file.name)[0]
+            )
+            if self._executor is None:
+                try:
+                    out_file = process_file(in_file, **self.average_kwargs)
+                except Exception as error:
+                    self._finished(in_file, None, error)
+                else:
+                    self._finished(in_file, out_file, None)
+            else:
+                self.in_progress[in_file] = self._submit(in_file)
+
+    def wait(self, timeout: float | None = None):
+        """Wait for any of the files in progress to finish"""
+        if self.in_progress:
+            concurrent.futures.wait(
+                self.in_progress.values(),
+                timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+
+    def drain(self):
+        """Process all the queued files, returning once they are complete"""
+        while self.busy:
+            self.dispatch()
+            self.wait()
+
+    def close(self):
+        """
+        Shut down the worker pool
+
+        Files which haven't started are abandoned,
+        while those being processed are finished and recorded in the journal.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._collect()
 
 
-def process_files(file_pattern, expected_steps: int | None, timeout=10.0):
+def find_files(file_pattern, timeout=10.0) -> list[Path]:
+    """
+    Find the files ready to be processed, in order
+
+    Parameters
+    ----------
+    file_pattern
+        Glob pattern used to find the files to process
+    timeout
+        Number of seconds since a file was last modified before it will be processed.
+        Writing larger domains to disk may not be instantaneous.
+    """
+    files = []
+    for in_file in sorted(Path(".").glob(file_pattern)):
+        mtime_ago = time.time() - os.path.getmtime(in_file)
+        logger.debug("found file %s mtimeago %d s", in_file, mtime_ago)
+        if mtime_ago > timeout:
+            files.append(in_file)
+    return files
+
+
+def process_files(
+    file_pattern,
+    expected_steps: int | None,
+    timeout=10.0,
+    workers: int = 1,
+    journal: ProcessingJournal | None = None,
+    retry_failed: bool = False,
+    **average_kwargs,
+):
     """
     Check the WRF output directory for new files and process them
 
@@ -100,12 +353,141 @@ def process_files(file_pattern, expected_steps: int | None, timeout=10.0):
     timeout
         Number of seconds since a file was last modified before it will be processed.
         Writing larger domains to disk may not be instantaneous.
+    workers
+        Number of files to process concurrently
+    journal
+        Journal recording the state of each file
+    retry_failed
+        Retry files which failed in a previous attempt
+    average_kwargs
+        Additional options passed to `average_fields`
     """
-    for in_file in Path(".").glob(file_pattern):
-        mtime_ago = time.time() - os.path.getmtime(in_file)
-        logger.debug("found file %s mtimeago %d s", in_file, mtime_ago)
-        if mtime_ago > timeout:
-            process_file(in_file, expected_steps=expected_steps)
+    processor = FileProcessor(
+        expected_steps,
+        workers=workers,
+        journal=journal,
+        retry_failed=retry_failed,
+        **average_kwargs,
+    )
+    try:
+        for in_file in find_files(file_pattern, timeout=timeout):
+            processor.queue(in_file)
+        processor.drain()
+    finally:
+        processor.close()
+
+
+def report(journal: ProcessingJournal, file_pattern: str = "wrfout_*") -> bool:
+    """
+    Summarise the journal and check that every remaining file has been processed
+
+    Files matching the pattern which haven't been processed are reported,
+    including those missing from the journal
+    (for example if the watcher stopped before it found them).
+    Journal entries of files which no longer exist
+    (for example those removed from the spinup period) are ignored.
+
+    Returns
+    -------
+        True if there are no unprocessed files remaining
+    """
+    complete = True
+    counts = {}
+    for entry in journal.entries():
+        counts[entry.state] = counts.get(entry.state, 0) + 1
+        if entry.state != DONE and os.path.exists(entry.path):
+            click.echo(f"Could not process {entry.path} ({entry.error or entry.state})")
+            complete = False
+    for in_file in sorted(Path(".").glob(file_pattern)):
+        entry = journal.lookup(in_file)
+        if entry is None:
+            click.echo(f"Could not process {in_file} (not in the journal)")
+            complete = False
+        elif entry.state == DONE and not entry.matches(fingerprint(in_file)):
+            click.echo(f"Could not process {in_file} (changed since it was processed)")
+            complete = False
+    summary = ", ".join(f"{count} {state}" for state, count in sorted(counts.items()))
+    click.echo(f"Journal {journal.path}: {summary or 'empty'}")
+    return complete
+
+
+def watch_files(
+    file_pattern,
+    processor: FileProcessor,
+    timeout=10.0,
+    use_inotify: bool = True,
+    poll_interval: float = 1.0,
+):
+    """
+    Process new files until the process is killed
+
+    When inotify is available,
+    a file is processed as soon as WRF closes it (or it is moved into the directory)
+    without repeatedly scanning the directory.
+    Otherwise, the directory is polled every `poll_interval` seconds.
+
+    Parameters
+    ----------
+    file_pattern
+        Glob pattern used to find the files to process
+    processor
+        Processor used to average the files
+    timeout
+        Number of seconds since a file was last modified before it will be processed.
+        Only used when polling, and when scanning the directory as the watch starts.
+    use_inotify
+        Use inotify to watch the directory if it is available
+    poll_interval
+        Number of seconds between polls of the directory,
+        or between checks on the workers when using inotify
+    """
+    if use_inotify and not inotify_available():
+        logger.warning("inotify is not available, falling back to polling")
+        use_inotify = False
+
+    if not use_inotify:
+        while True:
+            time.sleep(poll_interval)
+            for in_file in find_files(file_pattern, timeout=timeout):
+                processor.queue(in_file)
+            processor.dispatch()
+
+    with InotifyWatcher(".") as watcher:
+        # Pick up any files which were completed before the watch started
+        for in_file in find_files(file_pattern, timeout=timeout):
+            processor.queue(in_file)
+        processor.dispatch()
+        # Files closed just before the watch started were too recent for that scan
+        # and have no close event, so the directory is scanned again once they are old enough
+        rescan_at = time.monotonic() + timeout
+        while True:
+            # wake up periodically to hand queued files to workers as they free up
+            wait = poll_interval if processor.busy else None
+            if rescan_at is not None:
+                until_rescan = max(rescan_at - time.monotonic(), 0)
+                wait = until_rescan if wait is None else min(wait, until_rescan)
+            names = watcher.read_events(timeout=wait)
+            if rescan_at is not None and time.monotonic() >= rescan_at:
+                rescan_at = None
+                names = names + [
+                    str(f) for f in find_files(file_pattern, timeout=timeout)
+                ]
+            if watcher.overflowed:
+                logger.warning("inotify events were lost, rescanning the directory")
+                watcher.overflowed = False
+                names = names + [str(f) for f in find_files(file_pattern, timeout=0)]
+            for name in names:
+                in_file = Path(name)
+                if fnmatch.fnmatch(name, file_pattern) and in_file.exists():
+                    logger.debug("file %s was closed", in_file)
+                    processor.queue(in_file)
+            processor.dispatch()
+
+
+def exit_on_signal(signum, frame):
+    """Exit cleanly, ignoring further signals while the workers are shut down"""
+    signal.signal(signum, signal.SIG_IGN)
+    raise SystemExit(128 + signum)
 
 
 @click.command()
@@ -121,30 +503,175 @@ def process_files(file_pattern, expected_steps: int | None, timeout=10.0):
     help="Watch for any files matching the file pattern",
     is_flag=True,
 )
+@click.option(
+    "--poll",
+    help="Poll the directory for new files rather than using inotify when watching",
+    is_flag=True,
+)
+@click.option(
+    "--poll-interval",
+    help="Number of seconds between polls of the directory when watching",
+    default=1.0,
+    type=float,
+)
 @click.option(
     "--verify-steps/--no-verify-steps",
     help="Verify the that there are the expected number of steps in an output file."
     "This assumes that there are 12 x 5 minute steps.",
     default=False,
 )
+@click.option(
+    "--workers",
+    help="Number of files to process concurrently. "
+    "Keep this small enough to leave the cores used by wrf.exe alone.",
+    default=1,
+    type=int,
+)
+@click.option(
+    "--max-chunk-bytes",
+    help="Maximum number of bytes to read from a variable at once when averaging. "
+    "Bounds the memory used to process large domains.",
+    default=DEFAULT_MAX_CHUNK_BYTES,
+    type=int,
+)
+@click.option(
+    "--variable-workers",
+    help="Number of workers used to average the variables of each file",
+    default=1,
+    type=int,
+)
+@click.option(
+    "--complevel",
+    help="Deflate level of the averaged files (0 disables compression)",
+    default=4,
+    type=int,
+)
+@click.option(
+    "--chunk-sizes",
+    help="Chunk lengths of the averaged files, e.g. Time=1,bottom_top=1",
+    default=None,
+)
+@click.option(
+    "--significant-digits",
+    help="Quantize floats in the averaged files to this number of significant digits",
+    default=None,
+    type=int,
+)
+@click.option(
+    "--include",
+    help="Comma-separated glob patterns of the variables to keep in the averaged files",
+    default=None,
+)
+@click.option(
+    "--exclude",
+    help="Comma-separated glob patterns of the variables to drop from the averaged files",
+    default=None,
+)
+@click.option(
+    "--journal",
+    "journal_path",
+    help="Journal recording the processing state of each file",
+    default=JOURNAL_FILENAME,
+)
+@click.option(
+    "--no-journal",
+    help="Don't keep a journal of the processed files",
+    is_flag=True,
+)
+@click.option(
+    "--retry-failed",
+    help="Retry files which failed to process in a previous attempt",
+    is_flag=True,
+)
+@click.option(
+    "--report",
+    "report_only",
+    help="Summarise the journal and exit with an error if any files are unprocessed",
+    is_flag=True,
+)
 @click.argument("file_pattern", default="wrfout_*")
-def main(file_pattern: str, watch: bool, timeout: float, verify_steps: bool):
+def main(
+    file_pattern: str,
+    watch: bool,
+    poll: bool,
+    poll_interval: float,
+    timeout: float,
+    verify_steps: bool,
+    workers: int,
+    max_chunk_bytes: int,
+    variable_workers: int,
+    complevel: int,
+    chunk_sizes: str | None,
+    significant_digits: int | None,
+    include: str | None,
+    exclude: str | None,
+    journal_path: str,
+    no_journal: bool,
+    retry_failed: bool,
+    report_only: bool,
+):
     """
     Average raw WRF out files into hourly timesteps
     """
+    journal = None if no_journal else ProcessingJournal(journal_path)
+
+    if report_only:
+        if journal is None:
+            raise click.UsageError("--report requires a journal")
+        if not report(journal, file_pattern):
+            raise SystemExit(1)
+        return
+
     if verify_steps:
         expected_steps = EXPECTED_TIMESTEPS
     else:
         logger.info("Not verifying the number of time steps in the wrf output")
         expected_steps = None
 
+    average_kwargs = dict(
+        max_chunk_bytes=max_chunk_bytes,
+        n_workers=variable_workers,
+        encoding=NetCDFEncoding(
+            complevel=complevel,
+            chunk_sizes=parse_chunk_sizes(chunk_sizes),
+            significant_digits=significant_digits,
+        ),
+        include=parse_patterns(include),
+        exclude=parse_patterns(exclude),
+    )
+
     if watch:
-        # Keep checking until the process is killed
-        while True:
-            time.sleep(1)
-            process_files(file_pattern, expected_steps=expected_steps, timeout=timeout)
+        # Keep checking until the process is killed.
+        # SIGTERM (from the run script) exits through processor.close(),
+        # so no workers are left writing averages once the process has gone
+        signal.signal(signal.SIGTERM, exit_on_signal)
+        processor = FileProcessor(
+            expected_steps,
+            workers=workers,
+            journal=journal,
+            retry_failed=retry_failed,
+            **average_kwargs,
+        )
+        try:
+            watch_files(
+                file_pattern,
+                processor,
+                timeout=timeout,
+                use_inotify=not poll,
+                poll_interval=poll_interval,
+            )
+        finally:
+            processor.close()
     else:
-        process_files(file_pattern, expected_steps=expected_steps, timeout=timeout)
+        process_files(
+            file_pattern,
+            expected_steps=expected_steps,
+            timeout=timeout,
+            workers=workers,
+            journal=journal,
+            retry_failed=retry_failed,
+            **average_kwargs,
+        )
 
 
 if __name__ == "__main__":
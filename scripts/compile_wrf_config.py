@@ -0,0 +1,45 @@
+"""
+Compile a WRF configuration file
+
+Resolves the variables of the configuration, validates it and writes the result
+(along with the checksum of the configuration file and the environment variables
+it was built from) to a compiled file.
+`load_wrf_config` reuses the compiled file, rather than resolving the configuration again,
+while the configuration file and the environment variables are unchanged.
+"""
+
+import click
+import dotenv
+
+from setup_runs.wrf.read_config_wrf import compile_wrf_config
+
+
+@click.command()
+@click.option(
+    "-c",
+    "--configfile",
+    help="Path to configuration file",
+    default="config/wrf/config.nci.json",
+    type=click.Path(file_okay=True, dir_okay=False, readable=True, exists=True),
+)
+@click.option(
+    "-o",
+    "--output",
+    help="Path of the compiled configuration. Only the default path "
+    "(e.g. config.nci.compiled.json for config.nci.json) is used by load_wrf_config",
+    default=None,
+    type=click.Path(file_okay=True, dir_okay=False),
+)
+def main(configfile: str, output: str | None):
+    """
+    Compile a WRF configuration file
+    """
+    # Use the same environment as setup_for_wrf.py
+    dotenv.load_dotenv(dotenv.find_dotenv(raise_error_if_not_found=False))
+
+    output = compile_wrf_config(configfile, output)
+    print(f"Wrote the compiled configuration to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import datetime
+import functools
 import re
 import os
 import math
@@ -6,18 +7,84 @@ import f90nml
 import shutil
 import glob
 import copy
-import stat
+import shlex
 import netCDF4
-from setup_runs.wrf.fetch_fnl import download_gdas_fnl_data
-from setup_runs.wrf.namelists import validate_wrf_namelists
+from setup_runs.wrf.fetch_fnl import BandwidthLimit, download_gdas_fnl_data
+from setup_runs.wrf.fnl_cache import AnalysisCache
+from setup_runs.wrf.geo_em_store import (
+    GeoEmStore,
+    geo_em_filenames,
+    geometry_key,
+    geometry_settings,
+)
+from setup_runs.wrf.integrity import Manifest, sha256sum
+from setup_runs.wrf.namelists import NamelistRenderer, validate_wrf_namelists
+from setup_runs.wrf.prefetch import AnalysisPrefetcher
 from setup_runs.wrf.read_config_wrf import load_wrf_config, WRFConfig
-from setup_runs.utils import compress_nc_file, run_command, purge
+from setup_runs.wrf.stage_cache import (
+    StageCache,
+    file_digest,
+    file_fingerprint,
+    input_key,
+    namelist_section,
+)
+from setup_runs.netcdf import NETCDF_LOCK
+from setup_runs.scheduler import Pipeline, Stage
+from setup_runs.templates import Template, render_files, write_if_changed
+from setup_runs.utils import (
+    compress_nc_file,
+    file_lock,
+    purge,
+    run_command,
+    run_commands,
+    stream_command,
+)
 import click
 import dotenv
 import prettyprinter
 
 prettyprinter.install_extras(["attrs"])
 
+GEOGRID_LOCK_FILE = ".geogrid.lock"
+"""Lock file in the geo_em directory, held while the geo_em files are created"""
+METEM_LOCK_FILE = ".met_em.lock"
+"""Lock file in the met_em directory, held while files are added, linked or deleted"""
+WPS_WORK_DIR = "wps"
+"""Directory (within the run directory) where geogrid, and WPS in campaign mode, are run"""
+WPS_TIME_SETTINGS = ("start_date", "end_date", "interval_seconds")
+"""Settings of the WPS &share section which are set for each period"""
+STEPS = (
+    "geogrid",
+    "ungrib_sst",
+    "download",
+    "ungrib",
+    "metgrid",
+    "namelist",
+    "real",
+    "scripts",
+)
+"""Steps of the setup, in the order they run (see `--from` and `--until`)"""
+
+WRF_JOB_NAMELIST_VARIABLES = [
+    ("time_control", f"{prefix}_{unit}")
+    for prefix in ["start", "end"]
+    for unit in ["year", "month", "day", "hour", "minute", "second"]
+] + [
+    ("time_control", "restart"),
+    ("domains", "num_metgrid_levels"),
+    ("domains", "num_metgrid_soil_levels"),
+]
+"""Variables of the WRF namelist set for each job (see `write_job_namelist`)"""
+
+UNGRIB_NAMELIST_VARIABLES = [
+    ("share", "start_date"),
+    ("share", "end_date"),
+    ("ungrib", "prefix"),
+    ("share", "interval_seconds"),
+    ("metgrid", "fg_name"),
+]
+"""Variables of the WPS namelist set for each period (see `run_ungrib`)"""
+
 
 def move_pattern_to_dir(sourceDir, pattern, destDir):
     for f in os.listdir(sourceDir):
@@ -34,11 +101,213 @@ def link_pattern_to_dir(sourceDir, pattern, destDir):
                 os.symlink(src, dst)
 
 
-def grep_lines(regex, lines):
-    if isinstance(lines, str):
-        lines = lines.split("\n")
-    out = [line for line in lines if line.find(regex) >= 0]
-    return out
+def job_metem_times(job_start, run_length_hours):
+    """Times of the met_em files needed by a job, every 6 hours"""
+    return [
+        job_start + datetime.timedelta(seconds=hour * 3600)
+        for hour in range(0, run_length_hours + 1, 6)
+    ]
+
+
+def metem_filenames(metem_time, nDom):
+    """Names of the met_em files of each domain at a time"""
+    metem_time_str = metem_time.strftime("%Y-%m-%d_%H:%M:%S")
+    return [
+        "met_em.d0{}.{}.nc".format(iDom + 1, metem_time_str) for iDom in range(nDom)
+    ]
+
+
+def metgrid_fg_name(wrf_config: WRFConfig) -> list[str]:
+    """Prefixes of the intermediate files read by metgrid"""
+    fg_name = ["ERA"]
+    if wrf_config.use_high_res_sst_data:
+        fg_name.append("SST")
+    return fg_name
+
+
+def geogrid_key(wrf_config: WRFConfig, WPSnml: f90nml.Namelist) -> str:
+    """Hash of the settings and files which determine the geo_em files"""
+    return input_key(
+        geogrid=namelist_section(WPSnml, "geogrid", exclude=("geog_data_path",)),
+        share=namelist_section(WPSnml, "share", exclude=WPS_TIME_SETTINGS),
+        geog_data_path=wrf_config.geog_data_path,
+        geogrid_tbl=file_digest(wrf_config.geogrid_tbl),
+        geogrid_exe=file_fingerprint(wrf_config.geogrid_exe),
+    )
+
+
+def metem_keys(
+    wrf_config: WRFConfig, WPSnml: f90nml.Namelist, metem_times
+) -> dict[str, str]:
+    """
+    Hash of the inputs of each met_em file
+
+    The analyses are identified by their source and time
+    (they are downloaded or read from an archive which doesn't change).
+
+    Returns
+    -------
+        The key of each met_em file, by file name
+    """
+    nDom = WPSnml["share"]["max_dom"]
+    settings = dict(
+        geo_em=geogrid_key(wrf_config, WPSnml),
+        share=namelist_section(WPSnml, "share", exclude=WPS_TIME_SETTINGS),
+        ungrib=namelist_section(WPSnml, "ungrib", exclude=("prefix",)),
+        metgrid={
+            **namelist_section(WPSnml, "metgrid"),
+            "fg_name": metgrid_fg_name(wrf_config),
+        },
+        analysis_source=wrf_config.analysis_source,
+        analysis_patterns=[
+            wrf_config.analysis_pattern_surface,
+            wrf_config.analysis_pattern_upper,
+        ],
+        analysis_vtable=file_digest(wrf_config.analysis_vtable),
+        regional_subset=wrf_config.regional_subset_of_grib_data,
+        sst_vtable=(
+            file_digest(wrf_config.sst_vtable)
+            if wrf_config.use_high_res_sst_data
+            else None
+        ),
+        metgrid_tbl=file_digest(wrf_config.metgrid_tbl),
+        ungrib_exe=file_fingerprint(wrf_config.ungrib_exe),
+        metgrid_exe=file_fingerprint(wrf_config.metgrid_exe),
+    )
+    keys = {}
+    for metem_time in metem_times:
+        key = input_key(time=metem_time, **settings)
+        for metem_file in metem_filenames(metem_time, nDom):
+            keys[metem_file] = key
+    return keys
+
+
+def real_key(
+    wrf_config: WRFConfig,
+    WRFnml: f90nml.Namelist,
+    job_metem_keys: dict[str, str],
+    job_start: datetime.datetime,
+    job_end: datetime.datetime,
+) -> str:
+    """Hash of the inputs of real.exe for a job"""
+    return input_key(
+        namelist=WRFnml,
+        restart=wrf_config.restart,
+        met_em=job_metem_keys,
+        start=job_start,
+        end=job_end,
+        real_exe=file_fingerprint(wrf_config.real_exe),
+    )
+
+
+def metem_files_current(metem_dir, job_metem_keys):
+    """Check that the met_em files exist and were produced from the current inputs"""
+    metem_stages = StageCache(metem_dir)
+    return all(
+        metem_stages.is_current(metem_file, key, [os.path.join(metem_dir, metem_file)])
+        for metem_file, key in job_metem_keys.items()
+    )
+
+
+def store_metem_files(sourceDir, metem_dir, job_metem_keys):
+    """Move newly produced met_em files into metem_dir and record their inputs"""
+    move_pattern_to_dir(sourceDir=sourceDir, pattern="met_em*", destDir=metem_dir)
+    metem_stages = StageCache(metem_dir)
+    for metem_file, key in job_metem_keys.items():
+        path = os.path.join(metem_dir, metem_file)
+        if os.path.exists(path):
+            metem_stages.record(metem_file, key, [path])
+
+
+def link_metem_files(metem_dir, job_metem_keys, destDir):
+    """
+    Link to the met_em files of a job if they are all current in metem_dir
+
+    Hard links are used where possible, so the job keeps its files
+    if another job deletes them from the shared directory.
+    Returns whether the files were linked.
+    """
+    if not metem_files_current(metem_dir, job_metem_keys):
+        return False
+    for metem_file in job_metem_keys:
+        src = os.path.join(metem_dir, metem_file)
+        dst = os.path.join(destDir, metem_file)
+        ## replace any link left from an earlier run, as the file may have been updated
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            os.symlink(src, dst)
+    return True
+
+
+def job_times(wrf_config: WRFConfig, ind_job: int):
+    """
+    Start (including the spin-up), usable start and end times of a job
+    """
+    job_start = (
+        wrf_config.start_date
+        + datetime.timedelta(seconds=3600 * ind_job * int(wrf_config.num_hours_per_run))
+        - datetime.timedelta(seconds=3600 * int(wrf_config.num_hours_spin_up))
+    )
+
+    job_start_usable = wrf_config.start_date + datetime.timedelta(
+        seconds=3600 * ind_job * int(wrf_config.num_hours_per_run)
+    )
+
+    job_end = wrf_config.start_date + datetime.timedelta(
+        seconds=3600 * (ind_job + 1) * int(wrf_config.num_hours_per_run)
+    )
+    return job_start, job_start_usable, job_end
+
+
+def job_run_dir(wrf_config: WRFConfig, ind_job: int) -> str:
+    """Run directory of a job, named after its usable start time"""
+    _, job_start_usable, _ = job_times(wrf_config, ind_job)
+    return os.path.join(wrf_config.run_dir, job_start_usable.strftime("%Y%m%d%H"))
+
+
+def wrf_init_files(run_dir, nDom):
+    """Paths of the boundary, initial and SST input files written by real.exe"""
+    wrfInitFiles = [os.path.join(run_dir, "wrfbdy_d01")]  ## the BCs
+    for iDom in range(nDom):
+        dom = "d0{}".format(iDom + 1)
+        wrfInitFiles.append(os.path.join(run_dir, "wrfinput_{}".format(dom)))  ## ICs
+        wrfInitFiles.append(os.path.join(run_dir, "wrflowinp_{}".format(dom)))  ## SSTs
+    return wrfInitFiles
+
+
+def wrf_init_files_current(
+    wrf_config: WRFConfig,
+    WPSnml: f90nml.Namelist,
+    WRFnml: f90nml.Namelist,
+    ind_job: int,
+) -> tuple[bool, str]:
+    """
+    Check if the WRF initialisation files of a job exist and are up to date
+
+    Returns
+    -------
+        Whether the files are current, and the key of the real.exe stage
+    """
+    nDom = WPSnml["share"]["max_dom"]
+    run_length_total_hours = wrf_config.num_hours_per_run + wrf_config.num_hours_spin_up
+    job_start, _, job_end = job_times(wrf_config, ind_job)
+    run_dir = job_run_dir(wrf_config, ind_job)
+    job_metem_keys = metem_keys(
+        wrf_config, WPSnml, job_metem_times(job_start, run_length_total_hours)
+    )
+    key = real_key(wrf_config, WRFnml, job_metem_keys, job_start, job_end)
+    current = StageCache(run_dir).is_current("real", key, wrf_init_files(run_dir, nDom))
+    return current, key
+
+
+def wps_timeout(wrf_config: WRFConfig) -> float | None:
+    """Number of seconds ungrib.exe and metgrid.exe may run for (None for no limit)"""
+    if wrf_config.wps_timeout_minutes > 0:
+        return wrf_config.wps_timeout_minutes * 60
+    return None
 
 
 def symlink_file(input_directory, output_directory, filename):
@@ -49,6 +318,1271 @@ def symlink_file(input_directory, output_directory, filename):
         os.symlink(src, dst)
 
 
+def run_geogrid(wrf_config: WRFConfig, WPSnml: f90nml.Namelist, run_dir: str):
+    """
+    Run geogrid in a run directory
+
+    Returns
+    -------
+        Paths to the (compressed) geo_em files in the run directory
+    """
+    WPSnml = copy.deepcopy(WPSnml)
+    nDom = WPSnml["share"]["max_dom"]
+
+    ## copy the WPS namelist substituting the geog_data_path
+    WPSnml["geogrid"]["geog_data_path"] = wrf_config.geog_data_path
+    dst = os.path.join(run_dir, "namelist.wps")
+    WPSnml.write(dst)
+    ## copy the geogrid table
+    src = wrf_config.geogrid_tbl
+    assert os.path.exists(src), "Cannot find GEOGRID.TBL at {} ...".format(src)
+
+    geogridFolder = os.path.join(run_dir, "geogrid")
+    os.makedirs(geogridFolder, exist_ok=True)
+
+    ##
+    dst = os.path.join(run_dir, "geogrid", "GEOGRID.TBL")
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.symlink(src, dst)
+    ## link to the geogrid.exe program
+    src = wrf_config.geogrid_exe
+    assert os.path.exists(src), "Cannot find geogrid.exe at {} ...".format(src)
+    dst = os.path.join(run_dir, "geogrid.exe")
+    if not os.path.exists(dst):
+        os.symlink(src, dst)
+    ## run geogrid.exe in the run directory
+    print(
+        "\t\tRun geogrid at {}".format(
+            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        )
+    )
+
+    run_command(
+        ["./geogrid.exe"],
+        log_prefix="geogrid.log",
+        cwd=run_dir,
+    )
+
+    ## check that it ran
+    dom = "d0{}".format(nDom)
+    geoFile = "geo_em.{}.nc".format(dom)
+    assert os.path.exists(
+        os.path.join(run_dir, geoFile)
+    ), "./geogrid.exe did not produce expected output..."
+    ##
+    src = os.path.join(run_dir, "namelist.wps")
+    dst = os.path.join(run_dir, "namelist.wps.geogrid")
+    os.rename(src, dst)
+    ## compress the output
+    print("\tCompress the geo_em files")
+    geoPaths = [os.path.join(run_dir, geoFile) for geoFile in geo_em_filenames(nDom)]
+    for geoPath in geoPaths:
+        compress_nc_file(geoPath)
+    return geoPaths
+
+
+def prepare_geo_em_files(
+    wrf_config: WRFConfig, WPSnml: f90nml.Namelist, run_dir: str
+) -> None:
+    """
+    Link the geo_em files into a run directory, running geogrid if they don't exist yet
+
+    If `wrf_config.geo_em_store_dir` is set, the files are taken from the geo_em store
+    (see `setup_runs.wrf.geo_em_store`), otherwise from `wrf_config.geo_em_dir`.
+
+    Parameters
+    ----------
+    wrf_config
+        Configuration of the run
+    WPSnml
+        WPS namelist (not modified)
+    run_dir
+        Directory to link the files into (and where geogrid is run)
+    """
+    nDom = WPSnml["share"]["max_dom"]
+    geoPaths = [
+        os.path.join(wrf_config.geo_em_dir, geoFile)
+        for geoFile in geo_em_filenames(nDom)
+    ]
+    geoKey = geogrid_key(wrf_config, WPSnml)
+
+    if wrf_config.geo_em_store_dir:
+        store = GeoEmStore(wrf_config.geo_em_store_dir)
+        storeKey = geometry_key(WPSnml, wrf_config.geogrid_tbl)
+        ## only one job checks for (and if needed creates) the files of a geometry at a time
+        with store.lock(storeKey):
+            print("\tCheck that the geo_em files exist in the store")
+            if store.contains(storeKey, nDom):
+                print(
+                    "\t\tThe geo_em files were found at {}".format(store.path(storeKey))
+                )
+            elif StageCache(wrf_config.geo_em_dir).is_current(
+                "geogrid", geoKey, geoPaths
+            ):
+                print(
+                    "\t\tAdd the geo_em files from {} to the store".format(
+                        wrf_config.geo_em_dir
+                    )
+                )
+                store.add(storeKey, geoPaths, settings=geometry_settings(WPSnml))
+            else:
+                print("\t\tThe geo_em files did not exist - create them")
+                store.add(
+                    storeKey,
+                    run_geogrid(wrf_config, WPSnml, run_dir),
+                    settings=geometry_settings(WPSnml),
+                    move=True,
+                )
+        store.link(storeKey, nDom, run_dir)
+        return
+
+    ## the geo_em directory is shared by the jobs, so only one of them
+    ## checks for (and if needed creates) the geo_em files at a time
+    os.makedirs(wrf_config.geo_em_dir, exist_ok=True)
+    with file_lock(os.path.join(wrf_config.geo_em_dir, GEOGRID_LOCK_FILE)):
+        # Check that the topography files exist and match the geogrid settings
+        print("\tCheck that the geo_em files exist")
+        geoStages = StageCache(wrf_config.geo_em_dir)
+        geoFilesExist = geoStages.is_current("geogrid", geoKey, geoPaths)
+        ## If not, produce them
+        if geoFilesExist:
+            print("\t\tThe geo_em files were indeed found")
+        else:
+            print("\t\tThe geo_em files did not exist or are out of date - create them")
+            for src in run_geogrid(wrf_config, WPSnml, run_dir):
+                ## move the file to the namelist directory
+                dst = os.path.join(wrf_config.geo_em_dir, os.path.basename(src))
+                shutil.move(src, dst)
+            geoStages.record("geogrid", geoKey, geoPaths)
+    ##
+    ## link to the geo files
+    for geoFile in geo_em_filenames(nDom):
+        src = os.path.join(wrf_config.geo_em_dir, geoFile)
+        dst = os.path.join(run_dir, geoFile)
+        if not os.path.exists(dst):
+            os.symlink(src, dst)
+
+
+def link_ungrib_programs(wrf_config: WRFConfig, run_dir: str) -> None:
+    """Link the link_grib script and ungrib executable into a run directory"""
+    ## copy the link_grib script
+    src = wrf_config.linkgrib_script
+    assert os.path.exists(src), "Cannot find link_grib.csh at {} ...".format(src)
+    dst = os.path.join(run_dir, "link_grib.csh")
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.symlink(src, dst)
+    ## link the ungrib executabble
+    src = wrf_config.ungrib_exe
+    assert os.path.exists(src), "Cannot find ungrib.exe at {} ...".format(src)
+    dst = os.path.join(run_dir, "ungrib.exe")
+    if not os.path.exists(dst):
+        os.symlink(src, dst)
+
+
+def wps_days(wps_start: datetime.datetime, wps_end: datetime.datetime):
+    """First day, last day and number of days of input data used for a period"""
+    wpsStrDate = (wps_start - datetime.timedelta(days=1)).date()
+    wpsEndDate = (wps_end + datetime.timedelta(days=1)).date()
+    nDaysWps = (wpsEndDate - wpsStrDate).days + 1
+    return wpsStrDate, wpsEndDate, nDaysWps
+
+
+def fnl_files(
+    run_dir: str, wps_start: datetime.datetime, wps_end: datetime.datetime
+) -> tuple[list[datetime.datetime], list[str]]:
+    """Times of the FNL analyses needed for a period, and their paths in a run directory"""
+    nIntervals = int(round((wps_end - wps_start).total_seconds() / 3600.0 / 6.0)) + 1
+    FNLtimes = [
+        wps_start + datetime.timedelta(hours=6 * hi) for hi in range(nIntervals)
+    ]
+    FNLfiles = [
+        os.path.join(
+            run_dir,
+            time.strftime("gdas1.fnl0p25.%Y%m%d%H.f00.grib2"),
+        )
+        for time in FNLtimes
+    ]
+    return FNLtimes, FNLfiles
+
+
+def run_ungrib_sst(
+    wrf_config: WRFConfig,
+    WPSnml: f90nml.Namelist,
+    run_dir: str,
+    wps_start: datetime.datetime,
+    wps_end: datetime.datetime,
+) -> None:
+    """
+    Run ungrib for the high-resolution SST data of a period
+
+    The intermediate (`SST:*`) files are left in `run_dir`.
+    """
+    WPSnml = copy.deepcopy(WPSnml)
+    nDom = WPSnml["share"]["max_dom"]
+    wpsNamelistPath = os.path.join(run_dir, "namelist.wps")
+    link_ungrib_programs(wrf_config, run_dir)
+    wpsStrDate, _, nDaysWps = wps_days(wps_start, wps_end)
+
+    ## configure the namelist
+    ## EDIT: the following are the substitutions used for the WPS namelist
+    WPSnml["share"]["start_date"] = [wps_start.strftime("%Y-%m-%d_00:00:00")] * nDom
+    WPSnml["share"]["end_date"] = [
+        (wps_end.date() + datetime.timedelta(days=1)).strftime("%Y-%m-%d_%H:%M:%S")
+    ] * nDom
+    WPSnml["share"]["interval_seconds"] = 6 * 60 * 60  ## 24*60*60
+    WPSnml["ungrib"]["prefix"] = "SST"
+    WPSnml["geogrid"]["geog_data_path"] = wrf_config.geog_data_path
+    ## end edit section #####################################################
+    ## write out the namelist
+    if os.path.exists(wpsNamelistPath):
+        os.remove(wpsNamelistPath)
+    ##
+    WPSnml.write(wpsNamelistPath)
+
+    sstDir = os.path.join(run_dir, "sst_tmp")
+    if not os.path.exists(sstDir):
+        os.makedirs(sstDir, exist_ok=True)
+    ##
+    for iDayWps in range(nDaysWps):
+        wpsDate = wpsStrDate + datetime.timedelta(days=iDayWps)
+        ## check for the monthly file
+        monthlyFile = wpsDate.strftime(wrf_config.sst_monthly_pattern)
+        monthlyFileSrc = os.path.join(wrf_config.sst_monthly_dir, monthlyFile)
+        monthlyFileDst = os.path.join(sstDir, monthlyFile)
+        if os.path.exists(monthlyFileSrc) and (not os.path.exists(monthlyFileDst)):
+            if not os.path.exists(monthlyFileDst):
+                os.symlink(monthlyFileSrc, monthlyFileDst)
+        ## check for the daily file
+        dailyFile = wpsDate.strftime(wrf_config.sst_daily_pattern)
+        dailyFileSrc = os.path.join(wrf_config.sst_daily_dir, dailyFile)
+        dailyFileDst = os.path.join(sstDir, dailyFile)
+        if os.path.exists(dailyFileSrc) and (not os.path.exists(dailyFileDst)):
+            if not os.path.exists(dailyFileDst):
+                os.symlink(dailyFileSrc, dailyFileDst)
+    ##
+    purge(run_dir, "GRIBFILE*")
+    print(
+        "\t\tRun link_grib for the SST data at {}".format(
+            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        )
+    )
+
+    run_command(
+        ["./link_grib.csh", os.path.join(sstDir, "*")],
+        log_prefix="link_grib_sst.log",
+        cwd=run_dir,
+    )
+
+    ## check that it ran
+    ## time.sleep(0.2)
+    gribmatches = [
+        f for f in os.listdir(run_dir) if re.search("GRIBFILE", f) is not None
+    ]
+    if len(gribmatches) == 0:
+        raise RuntimeError("Gribfiles not linked successfully...")
+    ## link to the SST Vtable
+    src = wrf_config.sst_vtable
+    assert os.path.exists(src), "SST Vtable expected at {}".format(src)
+    dst = os.path.join(run_dir, "Vtable")
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.symlink(src, dst)
+    purge(run_dir, "SST:*")
+    purge(run_dir, "PFILE:*")
+    ## run ungrib on the SST files
+    print(
+        "\t\tRun ungrib for the SST data at {}".format(
+            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        )
+    )
+    result = stream_command(
+        ["./ungrib.exe"],
+        log_prefix="ungrib_sst.log",
+        cwd=run_dir,
+        timeout=wps_timeout(wrf_config),
+        success_pattern="Successful completion of ungrib",
+    )
+
+    ## check that it ran
+    if not result.succeeded:
+        raise RuntimeError("Success message not found in ungrib logfile...")
+
+    src = wpsNamelistPath
+    dst = os.path.join(run_dir, "namelist.wps.sst")
+    os.rename(src, dst)
+
+
+def fetch_analyses(
+    wrf_config: WRFConfig,
+    WPSnml: f90nml.Namelist,
+    run_dir: str,
+    wps_start: datetime.datetime,
+    wps_end: datetime.datetime,
+    fnl_cache: AnalysisCache | None = None,
+    prefetcher: AnalysisPrefetcher | None = None,
+    bandwidth: BandwidthLimit | None = None,
+) -> None:
+    """
+    Make the analyses of a period available in a run directory
+
+    The ERA Interim analyses are linked from the archive,
+    while the FNL analyses are downloaded (and optionally subset to the domain).
+
+    Parameters
+    ----------
+    wrf_config
+        Configuration of the run
+    WPSnml
+        Template WPS namelist (not modified)
+    run_dir
+        Directory where WPS is run
+    wps_start
+        Time of the first met_em file
+    wps_end
+        Time of the last met_em file
+    fnl_cache
+        Cache of the downloaded FNL analyses, shared between the jobs
+    prefetcher
+        Background downloads of the FNL analyses, which are told the period is now needed
+    bandwidth
+        Limit on the download rate of the FNL analyses
+    """
+    wpsStrDate, wpsEndDate, nDaysWps = wps_days(wps_start, wps_end)
+
+    ## should we use ERA-Interim analyses?
+    if wrf_config.analysis_source == "ERAI":
+        analysisDir = os.path.join(run_dir, "analysis_tmp")
+        if not os.path.exists(analysisDir):
+            os.makedirs(analysisDir, exist_ok=True)
+
+        for pattern in [
+            wrf_config.analysis_pattern_surface,
+            wrf_config.analysis_pattern_upper,
+        ]:
+            files = set([])
+            for iDayWps in range(nDaysWps):
+                wpsDate = wpsStrDate + datetime.timedelta(days=iDayWps)
+                patternWithDates = wpsDate.strftime(pattern)
+                files = files.union(
+                    set(glob.glob(os.path.join(run_dir, patternWithDates)))
+                )
+            ##
+            files = list(files)
+            files.sort()
+            if pattern == "analysis_pattern_upper":
+                ## for the upper-level files, be selective and use only those that contain the relevant range of dates
+                for ifile, filename in enumerate(files):
+                    fileStartDateStr = os.path.basename(filename).split("_")[-2]
+                    fileEndDateStr = os.path.basename(filename).split("_")[-1]
+                    fileStartDate = datetime.datetime.strptime(
+                        fileStartDateStr, "%Y%m%d"
+                    ).date()
+                    fileEndDate = datetime.datetime.strptime(
+                        fileEndDateStr, "%Y%m%d"
+                    ).date()
+                    ##
+                    if fileStartDate <= wpsStrDate and wpsStrDate <= fileEndDate:
+                        ifileStart = ifile
+                    ##
+                    if fileStartDate <= wpsEndDate and wpsEndDate <= fileEndDate:
+                        ifileEnd = ifile
+            else:
+                ## for the surface files use all those that match
+                ifileStart = 0
+                ifileEnd = len(files) - 1
+            ##
+            for ifile in range(ifileStart, ifileEnd + 1):
+                src = files[ifile]
+                dst = os.path.join(analysisDir, os.path.basename(src))
+                if not os.path.exists(dst):
+                    os.symlink(src, dst)
+        return
+
+    ## consider the case that we are using the FNL data
+    FNLtimes, FNLfiles = fnl_files(run_dir, wps_start, wps_end)
+    if prefetcher is not None:
+        prefetcher.claim(FNLtimes)
+    ## if the FNL data exists and is intact, don't bother downloading
+    FNLmanifest = Manifest(run_dir)
+    allFNLfilesExist = all([FNLmanifest.verify(FNLfile) for FNLfile in FNLfiles])
+    if allFNLfilesExist:
+        print("\t\tAll FNL files were found - do not repeat the download")
+    else:
+        ## otherwise download all the required FNL files
+        download_gdas_fnl_data(
+            target_dir=run_dir,
+            download_dts=FNLtimes,
+            chunk_size=wrf_config.fnl_download_chunk_bytes,
+            cache=fnl_cache,
+            concurrency=wrf_config.fnl_download_concurrency,
+            subset_vtable=(
+                wrf_config.analysis_vtable
+                if wrf_config.fnl_download_mode == "inventory"
+                else None
+            ),
+            bandwidth=bandwidth,
+        )
+    ## optionally take a regional subset
+    if wrf_config.regional_subset_of_grib_data:
+        prepare_geo_em_files(wrf_config, WPSnml, run_dir)
+        geoFile = os.path.join(run_dir, "geo_em.d01.nc")
+        ## find the geographical region, and add a few degrees on either side
+        geoStrs = {}
+        with NETCDF_LOCK, netCDF4.Dataset(geoFile) as nc:
+            coords_by_var = {
+                varname: nc.variables[varname][:] for varname in ["XLAT_M", "XLONG_M"]
+            }
+        for varname, coords in coords_by_var.items():
+            coords = [coords.min(), coords.max()]
+            coords = [
+                math.floor((coords[0]) / 5.0 - 1) * 5,
+                math.ceil((coords[1]) / 5.0 + 1) * 5,
+            ]
+            coordStr = "{}:{}".format(coords[0], coords[1])
+            geoStrs[varname] = coordStr
+        ## use wgrib2 to subset the files, running one process per file
+        for FNLfile in FNLfiles:
+            print(
+                "\t\tSubset the grib file",
+                os.path.basename(FNLfile),
+            )
+        results = run_commands(
+            [
+                [
+                    "wgrib2",
+                    FNLfile,
+                    "-small_grib",
+                    geoStrs["XLONG_M"],
+                    geoStrs["XLAT_M"],
+                    FNLfile + ".subset",
+                ]
+                for FNLfile in FNLfiles
+            ],
+            max_concurrency=wrf_config.fnl_download_concurrency,
+        )
+        for FNLfile, result in zip(FNLfiles, results):
+            if len(result.stderr_tail) > 0:
+                print("\n".join(result.stderr_tail))
+                raise RuntimeError("Errors found when running wgrib2...")
+            ## use the subset instead - replacing the original
+            ## (only the link is replaced if it came from the cache)
+            os.replace(FNLfile + ".subset", FNLfile)
+            FNLmanifest.record(FNLfile, sha256sum(FNLfile))
+
+
+def run_ungrib(
+    wrf_config: WRFConfig,
+    WPSnml: f90nml.Namelist,
+    run_dir: str,
+    wps_start: datetime.datetime,
+    wps_end: datetime.datetime,
+    wps_namelist: NamelistRenderer,
+) -> None:
+    """
+    Run ungrib for the analyses of a period (see `fetch_analyses`)
+
+    The intermediate (`ERA:*`) files and the WPS namelist used by metgrid
+    are left in `run_dir`. Downloaded FNL analyses are deleted once they have been used.
+    The WPS namelist is rendered by `wps_namelist`
+    (for the variables in `UNGRIB_NAMELIST_VARIABLES`).
+    """
+    nDom = WPSnml["share"]["max_dom"]
+    wpsNamelistPath = os.path.join(run_dir, "namelist.wps")
+    link_ungrib_programs(wrf_config, run_dir)
+
+    ## prepare to run link_grib.csh
+    if wrf_config.analysis_source == "ERAI":
+        linkGribCmds = ["./link_grib.csh", os.path.join(run_dir, "analysis_tmp", "*")]
+    else:
+        _, FNLfiles = fnl_files(run_dir, wps_start, wps_end)
+        linkGribCmds = ["./link_grib.csh"] + FNLfiles
+
+    ## EDIT: the following are the substitutions used for the WPS namelist
+    values = {
+        ("share", "start_date"): [wps_start.strftime("%Y-%m-%d_%H:%M:%S")] * nDom,
+        ("share", "end_date"): [wps_end.strftime("%Y-%m-%d_%H:%M:%S")] * nDom,
+        ("ungrib", "prefix"): "ERA",
+        ("share", "interval_seconds"): 6 * 60 * 60,
+        ("metgrid", "fg_name"): metgrid_fg_name(wrf_config),
+    }
+    ## end edit section #####################################################
+
+    ## write out the namelist
+    write_if_changed(wpsNamelistPath, wps_namelist.render(values))
+    ##
+    purge(run_dir, "GRIBFILE*")
+    print(
+        "\t\tRun link_grib for the FNL data at {}".format(
+            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        )
+    )
+    run_command(linkGribCmds, log_prefix="link_grib_fnl.log", cwd=run_dir)
+
+    ## check that it ran
+    gribmatches = [
+        f for f in os.listdir(run_dir) if re.search("GRIBFILE", f) is not None
+    ]
+    if len(gribmatches) == 0:
+        raise RuntimeError("Gribfiles not linked successfully...")
+
+    ## link to the relevant Vtable
+    src = wrf_config.analysis_vtable
+    assert os.path.exists(src), "Analysis Vtable expected at {}".format(src)
+    dst = os.path.join(run_dir, "Vtable")
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.symlink(src, dst)
+
+    purge(run_dir, "ERA:*")
+    ## with open('ungrib.log.era', 'w') as output_f:
+    print(
+        "\t\tRun ungrib for the ERA data at {}".format(
+            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        )
+    )
+    result = stream_command(
+        ["./ungrib.exe"],
+        log_prefix="ungrib_era.log",
+        cwd=run_dir,
+        timeout=wps_timeout(wrf_config),
+        success_pattern="Successful completion of ungrib",
+    )
+    if not result.succeeded:
+        raise RuntimeError("Success message not found in ungrib logfile...")
+
+    ## if we are using the FNL analyses, delete the downloaded FNL files
+    if wrf_config.analysis_source == "FNL":
+        for FNLfile in FNLfiles:
+            os.remove(FNLfile)
+
+
+def run_metgrid(wrf_config: WRFConfig, run_dir: str) -> None:
+    """
+    Run metgrid on the intermediate files in a run directory (see `run_ungrib`)
+
+    The met_em files are left in `run_dir`, which must already contain the geo_em files.
+    """
+    print(
+        "\t\tRun metgrid at {}".format(
+            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        )
+    )
+    metgriddir = os.path.join(run_dir, "metgrid")
+    os.makedirs(metgriddir, exist_ok=True)
+
+    ## link to the relevant METGRID.TBL
+    src = wrf_config.metgrid_tbl
+    assert os.path.exists(src), "Cannot find METGRID.TBL at {} ...".format(src)
+    dst = os.path.join(metgriddir, "METGRID.TBL")
+    if not os.path.exists(dst):
+        os.symlink(src, dst)
+    ## link to metgrid.exe
+    src = wrf_config.metgrid_exe
+    assert os.path.exists(src), "Cannot find metgrid.exe at {} ...".format(src)
+    dst = os.path.join(run_dir, "metgrid.exe")
+    if not os.path.exists(dst):
+        os.symlink(src, dst)
+    ##
+    ## logfile = 'metgrid_stderr_stdout.log'
+    ## with open(logfile, 'w') as output_f:
+    result = stream_command(
+        ["./metgrid.exe"],
+        log_prefix="metgrid.log",
+        cwd=run_dir,
+        timeout=wps_timeout(wrf_config),
+        success_pattern="Successful completion of metgrid",
+    )
+    if not result.succeeded:
+        raise RuntimeError("Success message not found in metgrid logfile...")
+
+    purge(run_dir, "ERA:*")
+    if wrf_config.use_high_res_sst_data:
+        purge(run_dir, "SST:*")
+    purge(run_dir, "FILE:*")
+    purge(run_dir, "PFILE:*")
+    purge(run_dir, "GRIB:*")
+    purge(run_dir, "fort.*")
+
+
+def metgrid_stage(
+    wrf_config: WRFConfig,
+    WPSnml: f90nml.Namelist,
+    run_dir: str,
+    period_metem_keys: dict[str, str],
+    link_dir: str | None = None,
+) -> None:
+    """
+    Run metgrid and move the met_em files of a period into the met_em directory
+
+    Parameters
+    ----------
+    wrf_config
+        Configuration of the run
+    WPSnml
+        Template WPS namelist (not modified)
+    run_dir
+        Directory where WPS is run
+    period_metem_keys
+        Key of each met_em file of the period (see `metem_keys`)
+    link_dir
+        If given, the met_em files are also linked into this directory
+        (while the met_em directory is still locked, so they can't be deleted in between)
+    """
+    prepare_geo_em_files(wrf_config, WPSnml, run_dir)
+    run_metgrid(wrf_config, run_dir)
+    os.makedirs(wrf_config.metem_dir, exist_ok=True)
+    with file_lock(os.path.join(wrf_config.metem_dir, METEM_LOCK_FILE)):
+        ## move the met_em files into the combined METEM_DIR directory
+        store_metem_files(run_dir, wrf_config.metem_dir, period_metem_keys)
+        if link_dir is not None:
+            ## link to the met_em files
+            print("\t\tlink to the met_em files")
+            assert link_metem_files(
+                wrf_config.metem_dir, period_metem_keys, link_dir
+            ), "Cannot find met_em files in {} ...".format(wrf_config.metem_dir)
+
+
+def split_wps_chunks(
+    times: list[datetime.datetime], max_times: int
+) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    """
+    Split 6-hourly times into contiguous chunks, each processed by one pass of WPS
+
+    Parameters
+    ----------
+    times
+        Times of the met_em files to produce
+    max_times
+        Maximum number of times in a chunk
+
+    Returns
+    -------
+        First and last time of each chunk
+    """
+    chunks = []
+    chunk = []
+    for time in sorted(times):
+        if chunk and (
+            time - chunk[-1] > datetime.timedelta(hours=6) or len(chunk) >= max_times
+        ):
+            chunks.append((chunk[0], chunk[-1]))
+            chunk = []
+        chunk.append(time)
+    if chunk:
+        chunks.append((chunk[0], chunk[-1]))
+    return chunks
+
+
+def add_wps_stages(
+    pipeline: Pipeline,
+    wrf_config: WRFConfig,
+    WPSnml: f90nml.Namelist,
+    run_dir: str,
+    label: str,
+    wps_start: datetime.datetime,
+    wps_end: datetime.datetime,
+    fnl_cache: AnalysisCache | None = None,
+    prefetcher: AnalysisPrefetcher | None = None,
+    bandwidth: BandwidthLimit | None = None,
+    link_dir: str | None = None,
+    wps_namelist: NamelistRenderer | None = None,
+) -> str:
+    """
+    Add the stages producing the met_em files of a period to a pipeline
+
+    The SST ungrib and the fetching of the analyses are independent,
+    so they can run at the same time (and alongside the stages of other periods).
+
+    Parameters
+    ----------
+    pipeline
+        Pipeline to add the stages to
+    wrf_config
+        Configuration of the run
+    WPSnml
+        Template WPS namelist (not modified)
+    run_dir
+        Directory where WPS is run
+    label
+        Label of the period, used to name the stages
+    wps_start
+        Time of the first met_em file
+    wps_end
+        Time of the last met_em file
+    fnl_cache
+        Cache of the downloaded FNL analyses
+    prefetcher
+        Background downloads of the FNL analyses, to which the period is added
+    bandwidth
+        Limit on the download rate of the FNL analyses
+    link_dir
+        If given, the met_em files are linked into this directory once produced
+    wps_namelist
+        Renderer of the WPS namelist used by ungrib, which can be shared between periods
+        (by default one is compiled from `WPSnml`)
+
+    Returns
+    -------
+        Name of the met_em artifact of the period
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    period_hours = int((wps_end - wps_start).total_seconds() / 3600)
+    period_metem_keys = metem_keys(
+        wrf_config, WPSnml, job_metem_times(wps_start, period_hours)
+    )
+    period = (wrf_config, WPSnml, run_dir, wps_start, wps_end)
+    if wps_namelist is None:
+        wps_namelist = NamelistRenderer(WPSnml, UNGRIB_NAMELIST_VARIABLES)
+
+    ungrib_inputs = [f"analyses:{label}"]
+    if wrf_config.analysis_source == "ERAI" and wrf_config.use_high_res_sst_data:
+        pipeline.add(
+            Stage(
+                f"ungrib_sst {label}",
+                "ungrib_sst",
+                functools.partial(run_ungrib_sst, *period),
+                outputs=[f"sst:{label}"],
+            )
+        )
+        ungrib_inputs.append(f"sst:{label}")
+    if wrf_config.analysis_source == "FNL" and prefetcher is not None:
+        prefetcher.add_window(fnl_files(run_dir, wps_start, wps_end)[0])
+    ## the geo_em files are used to subset the FNL analyses to the domain
+    subset = (
+        wrf_config.analysis_source == "FNL" and wrf_config.regional_subset_of_grib_data
+    )
+    pipeline.add(
+        Stage(
+            f"download {label}",
+            "download",
+            functools.partial(
+                fetch_analyses, *period, fnl_cache, prefetcher, bandwidth
+            ),
+            inputs=["geo_em"] if subset else [],
+            outputs=[f"analyses:{label}"],
+        )
+    )
+    pipeline.add(
+        Stage(
+            f"ungrib {label}",
+            "ungrib",
+            functools.partial(run_ungrib, *period, wps_namelist),
+            inputs=ungrib_inputs,
+            outputs=[f"intermediate:{label}"],
+        )
+    )
+    pipeline.add(
+        Stage(
+            f"metgrid {label}",
+            "metgrid",
+            functools.partial(
+                metgrid_stage,
+                wrf_config,
+                WPSnml,
+                run_dir,
+                period_metem_keys,
+                link_dir,
+            ),
+            inputs=[f"intermediate:{label}", "geo_em"],
+            outputs=[f"met_em:{label}"],
+        )
+    )
+    return f"met_em:{label}"
+
+
+def main_script_substitutions(
+    wrf_config: WRFConfig, number_of_jobs: int
+) -> dict[str, str]:
+    """Values of the placeholders of the main coordination script"""
+    ############## EDIT: the following are the substitutions used for the main run script
+    substitutions = {
+        "STARTDATE": wrf_config.start_date.strftime("%Y%m%d%H"),
+        "njobs": "{}".format(number_of_jobs),
+        "nhours": "{}".format(wrf_config.num_hours_per_run),
+        "RUNNAME": wrf_config.run_name,
+        "NUDGING": "{}".format(not wrf_config.restart).lower(),
+        "runAsOneJob": "{}".format(wrf_config.run_as_one_job).lower(),
+        "RUN_DIR": wrf_config.run_dir,
+    }
+    ############## end edit section #####################################################
+    return substitutions
+
+
+def link_job_metem_files(
+    wrf_config: WRFConfig, WPSnml: f90nml.Namelist, ind_job: int, relink: bool = True
+) -> str:
+    """
+    Link to the met_em files of a job from the met_em directory
+
+    Parameters
+    ----------
+    wrf_config
+        Configuration of the run
+    WPSnml
+        Template WPS namelist (not modified)
+    ind_job
+        Index of the job
+    relink
+        Whether to replace links which already exist
+        (otherwise the files are only linked if the first of them is missing)
+
+    Returns
+    -------
+        Path of the link to the first of the job's met_em files
+    """
+    run_length_total_hours = wrf_config.num_hours_per_run + wrf_config.num_hours_spin_up
+    job_start, _, _ = job_times(wrf_config, ind_job)
+    run_dir_with_date = job_run_dir(wrf_config, ind_job)
+    job_metem_keys = metem_keys(
+        wrf_config, WPSnml, job_metem_times(job_start, run_length_total_hours)
+    )
+    metemfile = os.path.join(run_dir_with_date, next(iter(job_metem_keys)))
+    if relink or not os.path.exists(metemfile):
+        print("\t\tlink to the met_em files")
+        with file_lock(os.path.join(wrf_config.metem_dir, METEM_LOCK_FILE)):
+            assert link_metem_files(
+                wrf_config.metem_dir, job_metem_keys, run_dir_with_date
+            ), "Cannot find met_em files in {} ...".format(wrf_config.metem_dir)
+    return metemfile
+
+
+def write_job_namelist(
+    ind_job: int,
+    wrf_config: WRFConfig,
+    WPSnml: f90nml.Namelist,
+    wrf_namelist: NamelistRenderer,
+    use_metem_files: bool,
+) -> None:
+    """
+    Write the WRF namelist of a job and link the programs, tables and scripts it uses
+
+    Parameters
+    ----------
+    ind_job
+        Index of the job
+    wrf_config
+        Configuration of the run
+    WPSnml
+        Template WPS namelist (not modified)
+    wrf_namelist
+        Renderer of the WRF namelist (for the variables in `WRF_JOB_NAMELIST_VARIABLES`)
+    use_metem_files
+        Whether real.exe will be run, in which case the job's met_em files are linked
+        (if they haven't been already) and the number of levels is read from them
+    """
+    nDom = WPSnml["share"]["max_dom"]
+    job_start, _, job_end = job_times(wrf_config, ind_job)
+    run_dir_with_date = job_run_dir(wrf_config, ind_job)
+
+    if use_metem_files:
+        metemfile = link_job_metem_files(wrf_config, WPSnml, ind_job, relink=False)
+        ## read the number of atmospheric and soil levels from one of the job's met_em files
+        ## (rather than the shared directory, which other jobs may be emptying)
+        with NETCDF_LOCK, netCDF4.Dataset(metemfile) as nc:
+            nz_metem = len(nc.dimensions["num_metgrid_levels"])
+            nz_soil = len(nc.dimensions["num_st_layers"])
+    else:
+        if wrf_config.analysis_source == "ERAI":
+            nz_metem = 38
+            nz_soil = 4
+        elif wrf_config.analysis_source == "FNL":
+            nz_metem = 27
+            nz_soil = 4
+
+    ## configure the WRF namelist
+    print("\t\tconfigure the WRF namelist")
+    values = {}
+    ########## EDIT: the following are the substitutions used for the WRF namelist
+    for prefix, time in [("start", job_start), ("end", job_end)]:
+        for unit in ["year", "month", "day", "hour", "minute", "second"]:
+            values[("time_control", f"{prefix}_{unit}")] = [getattr(time, unit)] * nDom
+    ########## end edit section #####################################################
+    ##
+    values[("time_control", "restart")] = wrf_config.restart
+    ##
+    values[("domains", "num_metgrid_levels")] = nz_metem
+    values[("domains", "num_metgrid_soil_levels")] = nz_soil
+    ##
+    nmlfile = os.path.join(run_dir_with_date, "namelist.input")
+    write_if_changed(nmlfile, wrf_namelist.render(values))
+    ##
+    # Get real.exe and WRF.exe
+    src = wrf_config.real_exe
+    assert os.path.exists(src), "Cannot find real.exe at {} ...".format(src)
+    dst = os.path.join(run_dir_with_date, "real.exe")
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.symlink(src, dst)
+    ##
+    src = wrf_config.wrf_exe
+    assert os.path.exists(src), "Cannot find wrf.exe at {} ...".format(src)
+    dst = os.path.join(run_dir_with_date, "wrf.exe")
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.symlink(src, dst)
+
+    # get background checking script to initiate averaging
+    src = wrf_config.check_wrfout_in_background_script
+    assert os.path.exists(src), "Cannot find wrfout checking  script at {} ...".format(
+        src
+    )
+    dst = os.path.join(run_dir_with_date, "checkWrfoutInBackground.py")
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.symlink(src, dst)
+
+    # Get tables
+    link_pattern_to_dir(
+        sourceDir=wrf_config.wrf_run_dir,
+        pattern=wrf_config.wrf_run_tables_pattern,
+        destDir=run_dir_with_date,
+    )
+
+    # link to scripts from the namelist and target directories
+    for input_directory, scripts_to_copy in (
+        (wrf_config.target_dir, wrf_config.scripts_to_copy_from_target_dir),
+        (wrf_config.nml_dir, wrf_config.scripts_to_copy_from_nml_dir),
+    ):
+        scripts_to_copy = scripts_to_copy.split(",")
+
+        for script_to_copy in scripts_to_copy:
+            symlink_file(input_directory, run_dir_with_date, script_to_copy)
+
+
+def run_job_real(
+    ind_job: int, wrf_config: WRFConfig, WPSnml: f90nml.Namelist, realKey: str
+) -> None:
+    """
+    Run real.exe for a job and record its inputs (see `wrf_init_files_current`)
+
+    The job's met_em files are linked first, as the links are removed after each run
+    (and the namelist step, which also links them, may not have been run).
+    """
+    nDom = WPSnml["share"]["max_dom"]
+    run_dir_with_date = job_run_dir(wrf_config, ind_job)
+    link_job_metem_files(wrf_config, WPSnml, ind_job)
+    run_wrf(wrf_config, run_dir_with_date)
+    StageCache(run_dir_with_date).record(
+        "real", realKey, wrf_init_files(run_dir_with_date, nDom)
+    )
+    ## clean up the links to the met_em files, as they are no longer needed
+    purge(run_dir_with_date, "met_em*")
+
+
+def job_script_substitutions(
+    ind_job: int, wrf_config: WRFConfig, check_wrfout_options: str
+) -> dict[str, str]:
+    """Values of the placeholders of the run and cleanup scripts of a job"""
+    _, job_start_usable, _ = job_times(wrf_config, ind_job)
+
+    ########## EDIT: the following are the substitutions used for the per-run cleanup and run scripts
+    substitutions = {
+        "RUN_DIR": job_run_dir(wrf_config, ind_job),
+        "RUNSHORT": wrf_config.run_name[:8],
+        "STARTDATE": job_start_usable.strftime("%Y%m%d"),
+        "firstTimeToKeep": job_start_usable.strftime("%Y-%m-%dT%H%M"),
+        "checkWrfoutOptions": check_wrfout_options,
+    }
+    ########## end edit section #####################################################
+    return substitutions
+
+
+def write_scripts(
+    wrf_config: WRFConfig,
+    scripts: dict[str, Template],
+    number_of_jobs: int,
+    check_wrfout_options: str,
+) -> None:
+    """
+    Write the main coordination script and the run and cleanup scripts of every job
+
+    Scripts which are already up to date are left untouched (see `setup_runs.templates`).
+    """
+    print("\tGenerate the main, run and cleanup scripts")
+    files = [
+        (
+            os.path.join(wrf_config.run_dir, "main.sh"),
+            scripts["main"],
+            main_script_substitutions(wrf_config, number_of_jobs),
+        )
+    ]
+    for ind_job in range(number_of_jobs):
+        substitutions = job_script_substitutions(
+            ind_job, wrf_config, check_wrfout_options
+        )
+        for script_name in ["run", "cleanup"]:
+            files.append(
+                (
+                    os.path.join(substitutions["RUN_DIR"], "{}.sh".format(script_name)),
+                    scripts[script_name],
+                    substitutions,
+                )
+            )
+    written = render_files(files, executable=True)
+    print("\t\t{} of {} scripts were updated".format(len(written), len(files)))
+
+
+def purge_metem_dir(wrf_config: WRFConfig) -> None:
+    """Delete the met_em files, once all the jobs have used them"""
+    if os.path.exists(wrf_config.metem_dir):
+        with file_lock(os.path.join(wrf_config.metem_dir, METEM_LOCK_FILE)):
+            purge(wrf_config.metem_dir, "met_em*")
+
+
+def build_pipeline(
+    wrf_config: WRFConfig,
+    scripts: dict[str, Template],
+    WPSnml: f90nml.Namelist,
+    WRFnml: f90nml.Namelist,
+    number_of_jobs: int,
+    check_wrfout_options: str,
+    fnl_cache: AnalysisCache | None = None,
+    prefetcher: AnalysisPrefetcher | None = None,
+    bandwidth: BandwidthLimit | None = None,
+    jobs: int = 1,
+    purge_metem_links: bool = True,
+) -> Pipeline:
+    """
+    Plan the stages needed to prepare the jobs
+
+    Stages are only added for outputs which are missing or out of date
+    (see `setup_runs.wrf.stage_cache`).
+    The met_em files are produced for each job (`wps_mode` "job")
+    or once for all the jobs (`wps_mode` "campaign"),
+    in which case the times are split into at most `jobs` chunks (see `split_wps_chunks`),
+    or more if the times have gaps or the chunks are limited by `wps_chunk_hours`.
+
+    Parameters
+    ----------
+    wrf_config
+        Configuration of the run
+    scripts
+        Compiled template scripts (see `setup_runs.templates`)
+    WPSnml
+        Template WPS namelist (not modified)
+    WRFnml
+        Template WRF namelist (not modified)
+    number_of_jobs
+        Number of WRF jobs
+    check_wrfout_options
+        Options passed to the background processing of the WRF output
+    fnl_cache
+        Cache of the downloaded FNL analyses, shared between the jobs
+    prefetcher
+        Background downloads of the FNL analyses, to which the periods are added
+    bandwidth
+        Limit on the download rate of the FNL analyses
+    jobs
+        Number of stages which will be run at once
+    purge_metem_links
+        Whether to remove the links to met_em files left in the job directories
+        by an interrupted run (only once the namelist step, which relinks them, will run)
+
+    Returns
+    -------
+        Pipeline of the stages (see `setup_runs.scheduler`)
+    """
+    nDom = WPSnml["share"]["max_dom"]
+    run_length_total_hours = wrf_config.num_hours_per_run + wrf_config.num_hours_spin_up
+    wps_work_dir = os.path.join(wrf_config.run_dir, WPS_WORK_DIR)
+    ## the namelists are compiled once and rendered for each job and period
+    wrf_namelist = NamelistRenderer(WRFnml, WRF_JOB_NAMELIST_VARIABLES)
+    wps_namelist = NamelistRenderer(WPSnml, UNGRIB_NAMELIST_VARIABLES)
+
+    ## check which jobs need their WRF initialisation files (re)created
+    real_keys = {}
+    for ind_job in range(number_of_jobs):
+        run_dir_with_date = job_run_dir(wrf_config, ind_job)
+        os.makedirs(run_dir_with_date, exist_ok=True)
+        ## remove any links to met_em files left by an interrupted run
+        if purge_metem_links:
+            purge(run_dir_with_date, "met_em*")
+        if wrf_config.only_edit_namelists:
+            continue
+        wrfInitFilesExist, realKey = wrf_init_files_current(
+            wrf_config, WPSnml, WRFnml, ind_job
+        )
+        if not wrfInitFilesExist:
+            real_keys[ind_job] = realKey
+    print(
+        "{} of {} jobs need their WRF initialisation files created".format(
+            len(real_keys), number_of_jobs
+        )
+    )
+
+    ## the stages producing the met_em files, and the met_em artifacts needed by each job
+    wps_pipeline = Pipeline(STEPS)
+    job_metem_inputs = {ind_job: [] for ind_job in real_keys}
+    if real_keys:
+        os.makedirs(wrf_config.metem_dir, exist_ok=True)
+        metem_lock = os.path.join(wrf_config.metem_dir, METEM_LOCK_FILE)
+    if real_keys and wrf_config.wps_mode == "campaign":
+        times = set()
+        for ind_job in real_keys:
+            job_start, _, _ = job_times(wrf_config, ind_job)
+            times.update(job_metem_times(job_start, run_length_total_hours))
+        all_metem_keys = metem_keys(wrf_config, WPSnml, times)
+        with file_lock(metem_lock):
+            missing_times = [
+                time
+                for time in sorted(times)
+                if not metem_files_current(
+                    wrf_config.metem_dir,
+                    {
+                        metem_file: all_metem_keys[metem_file]
+                        for metem_file in metem_filenames(time, nDom)
+                    },
+                )
+            ]
+        print(
+            "{} of {} met_em times were found".format(
+                len(times) - len(missing_times), len(times)
+            )
+        )
+        if missing_times:
+            max_times = math.ceil(len(missing_times) / jobs)
+            if wrf_config.wps_chunk_hours > 0:
+                max_times = min(max_times, wrf_config.wps_chunk_hours // 6 + 1)
+            for wps_start, wps_end in split_wps_chunks(missing_times, max_times):
+                label = "{}-{}".format(
+                    wps_start.strftime("%Y%m%d%H"), wps_end.strftime("%Y%m%d%H")
+                )
+                artifact = add_wps_stages(
+                    wps_pipeline,
+                    wrf_config,
+                    WPSnml,
+                    os.path.join(wps_work_dir, label),
+                    label,
+                    wps_start,
+                    wps_end,
+                    fnl_cache,
+                    prefetcher,
+                    bandwidth,
+                    wps_namelist=wps_namelist,
+                )
+                ## the jobs which need met_em files from the chunk
+                for ind_job in real_keys:
+                    job_start, _, _ = job_times(wrf_config, ind_job)
+                    job_end = job_start + datetime.timedelta(
+                        hours=run_length_total_hours
+                    )
+                    if wps_start <= job_end and job_start <= wps_end:
+                        job_metem_inputs[ind_job].append(artifact)
+    elif real_keys:
+        for ind_job in real_keys:
+            job_start, job_start_usable, job_end = job_times(wrf_config, ind_job)
+            run_dir_with_date = job_run_dir(wrf_config, ind_job)
+            job_metem_keys = metem_keys(
+                wrf_config, WPSnml, job_metem_times(job_start, run_length_total_hours)
+            )
+            ## the met_em directory is shared by the jobs (and emptied by them if
+            ## delete_metem_files is set), so the files are checked for and linked at once
+            with file_lock(metem_lock):
+                metemFilesExist = link_metem_files(
+                    wrf_config.metem_dir, job_metem_keys, run_dir_with_date
+                )
+            if not metemFilesExist:
+                job_metem_inputs[ind_job].append(
+                    add_wps_stages(
+                        wps_pipeline,
+                        wrf_config,
+                        WPSnml,
+                        run_dir_with_date,
+                        job_start_usable.strftime("%Y%m%d%H"),
+                        job_start,
+                        job_end,
+                        fnl_cache,
+                        prefetcher,
+                        bandwidth,
+                        link_dir=run_dir_with_date,
+                        wps_namelist=wps_namelist,
+                    )
+                )
+
+    ## the stages are added in the order they are preferred when more are ready than can run:
+    ## geogrid first, as most of the others wait for it, then the WPS and job stages
+    pipeline = Pipeline(STEPS)
+    if any("geo_em" in stage.inputs for stage in wps_pipeline.stages.values()):
+        os.makedirs(wps_work_dir, exist_ok=True)
+        pipeline.add(
+            Stage(
+                "geogrid",
+                "geogrid",
+                functools.partial(
+                    prepare_geo_em_files, wrf_config, WPSnml, wps_work_dir
+                ),
+                outputs=["geo_em"],
+            )
+        )
+    for stage in wps_pipeline.stages.values():
+        pipeline.add(stage)
+
+    for ind_job in range(number_of_jobs):
+        _, job_start_usable, _ = job_times(wrf_config, ind_job)
+        label = job_start_usable.strftime("%Y%m%d%H")
+        pipeline.add(
+            Stage(
+                f"namelist {label}",
+                "namelist",
+                functools.partial(
+                    write_job_namelist,
+                    ind_job,
+                    wrf_config,
+                    WPSnml,
+                    wrf_namelist,
+                    ind_job in real_keys,
+                ),
+                inputs=job_metem_inputs.get(ind_job, []),
+                outputs=[f"namelist:{label}"],
+            )
+        )
+        if ind_job in real_keys:
+            pipeline.add(
+                Stage(
+                    f"real {label}",
+                    "real",
+                    functools.partial(
+                        run_job_real, ind_job, wrf_config, WPSnml, real_keys[ind_job]
+                    ),
+                    inputs=[f"namelist:{label}"],
+                    outputs=[f"wrfinput:{label}"],
+                )
+            )
+
+    pipeline.add(
+        Stage(
+            "scripts",
+            "scripts",
+            functools.partial(
+                write_scripts, wrf_config, scripts, number_of_jobs, check_wrfout_options
+            ),
+        )
+    )
+
+    ## the met_em files are kept until all the jobs have used them in campaign mode
+    if (
+        wrf_config.wps_mode == "campaign"
+        and wrf_config.delete_metem_files
+        and not wrf_config.only_edit_namelists
+    ):
+        pipeline.add(
+            Stage(
+                "purge met_em",
+                "real",
+                functools.partial(purge_metem_dir, wrf_config),
+                inputs=[
+                    output
+                    for stage in pipeline.stages.values()
+                    if stage.step == "real"
+                    for output in stage.outputs
+                ],
+            )
+        )
+    return pipeline
+
+
 @click.command()
 @click.option(
     "-c",
@@ -57,7 +1591,34 @@ def symlink_file(input_directory, output_directory, filename):
     default="config/wrf/config.nci.json",
     type=click.Path(file_okay=True, dir_okay=False, readable=True, exists=True),
 )
-def run_setup_for_wrf(configfile: str) -> None:
+@click.option(
+    "-j",
+    "--jobs",
+    help="Number of stages to run at once",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--from",
+    "first_step",
+    help="First step to run (the outputs of earlier steps must already exist)",
+    default=None,
+    type=click.Choice(STEPS),
+)
+@click.option(
+    "--until",
+    "last_step",
+    help="Last step to run",
+    default=None,
+    type=click.Choice(STEPS),
+)
+def run_setup_for_wrf(
+    configfile: str,
+    jobs: int,
+    first_step: str | None,
+    last_step: str | None,
+) -> None:
     """
     Run the setup for WRF script.
 
@@ -65,6 +1626,12 @@ def run_setup_for_wrf(configfile: str) -> None:
     ----------
     configfile
         The path to the configuration file to be used.
+    jobs
+        Number of stages to run in parallel.
+    first_step
+        First step to run (defaults to the first step, see `STEPS`).
+    last_step
+        Last step to run (defaults to the last step).
 
     """
     wrf_config = load_wrf_config(configfile)
@@ -73,7 +1640,6 @@ def run_setup_for_wrf(configfile: str) -> None:
     prettyprinter.cpprint(wrf_config)
 
     scripts = {}
-    dailyScriptNames = ["run", "cleanup"]
     script_names = ["main", "run", "cleanup"]
     script_paths = [
         wrf_config.main_script_template,
@@ -81,14 +1647,12 @@ def run_setup_for_wrf(configfile: str) -> None:
         wrf_config.cleanup_script_template,
     ]
     for script_name, script_path in zip(script_names, script_paths):
-        ## read the template run script
+        ## read and compile the template script
         assert os.path.exists(
             script_path
         ), f"No template script was found at {script_path}"
         try:
-            f = open(script_path, "rt")
-            scripts[script_name] = f.readlines()
-            f.close()
+            scripts[script_name] = Template.from_file(script_path)
         except Exception as e:
             print("Problem reading in template {} script".format(script_name))
             print(str(e))
@@ -117,758 +1681,86 @@ def run_setup_for_wrf(configfile: str) -> None:
 
     validate_wrf_namelists(WPSnml, WRFnml)
 
-    ## get the number of domains
-    nDom = WPSnml["share"]["max_dom"]
-
-    ## get the total run length
-    run_length_total_hours = wrf_config.num_hours_per_run + wrf_config.num_hours_spin_up
-
     ## check that the output directory exists - if not, create it
     os.makedirs(wrf_config.run_dir, exist_ok=True)
 
-    print("\t\tGenerate the main coordination script")
-
-    ## write out the main coordination script
-
-    ############## EDIT: the following are the substitutions used for the main run script
-    substitutions = {
-        "STARTDATE": wrf_config.start_date.strftime("%Y%m%d%H"),
-        "njobs": "{}".format(number_of_jobs),
-        "nhours": "{}".format(wrf_config.num_hours_per_run),
-        "RUNNAME": wrf_config.run_name,
-        "NUDGING": "{}".format(not wrf_config.restart).lower(),
-        "runAsOneJob": "{}".format(wrf_config.run_as_one_job).lower(),
-        "RUN_DIR": wrf_config.run_dir,
-    }
-    ############## end edit section #####################################################
-
-    ## do the substitutions
-    thisScript = copy.copy(scripts["main"])
-    for avail_key in list(substitutions.keys()):
-        key = "${%s}" % avail_key
-        value = substitutions[avail_key]
-        thisScript = [item.replace(key, value) for item in thisScript]
-    ## write out the lines
-    scriptFile = "{}.sh".format("main")
-    scriptPath = os.path.join(wrf_config.run_dir, scriptFile)
-    f = open(scriptPath, "w")
-    f.writelines(thisScript)
-    f.close()
-    ## make executable
-    os.chmod(scriptPath, os.stat(scriptPath).st_mode | stat.S_IEXEC)
-
-    ## loop through the different days
-    for ind_job in range(number_of_jobs):
-        job_start = (
-            wrf_config.start_date
-            + datetime.timedelta(
-                seconds=3600 * ind_job * int(wrf_config.num_hours_per_run)
-            )
-            - datetime.timedelta(seconds=3600 * int(wrf_config.num_hours_spin_up))
-        )
-
-        job_start_usable = wrf_config.start_date + datetime.timedelta(
-            seconds=3600 * ind_job * int(wrf_config.num_hours_per_run)
-        )
-
-        job_end = wrf_config.start_date + datetime.timedelta(
-            seconds=3600 * (ind_job + 1) * int(wrf_config.num_hours_per_run)
+    ## options passed to the background averaging of the WRF output
+    check_wrfout_options = " ".join(
+        f"--{option} {shlex.quote(value)}"
+        for option, value in (
+            ("include", wrf_config.wrfout_include_variables),
+            ("exclude", wrf_config.wrfout_exclude_variables),
         )
+        if value
+    )
 
-        print(
-            "Start preparation for the run beginning {}".format(job_start_usable.date())
+    ## cache of the downloaded FNL analyses, shared between the jobs
+    fnl_cache = None
+    if wrf_config.analysis_source == "FNL" and wrf_config.fnl_cache_dir:
+        fnl_cache = AnalysisCache(
+            wrf_config.fnl_cache_dir,
+            max_bytes=int(wrf_config.fnl_cache_max_gb * 1024**3),
         )
-        ##
-        yyyymmddhh_start = job_start_usable.strftime("%Y%m%d%H")
-        run_dir_with_date: str = os.path.join(wrf_config.run_dir, yyyymmddhh_start)
-
-        os.makedirs(run_dir_with_date, exist_ok=True)
-        os.chdir(run_dir_with_date)
-
-        ## check that the WRF initialisation files exist
-        print("\tCheck that the WRF initialisation files exist")
-        wrfbdyPath = os.path.join(run_dir_with_date, "wrfbdy_d01")  ## check for the BCs
-        wrfInitFilesExist = os.path.exists(wrfbdyPath)
-        for iDom in range(nDom):
-            dom = "d0{}".format(iDom + 1)
-            wrfinputPath = os.path.join(
-                run_dir_with_date, "wrfinput_{}".format(dom)
-            )  ## check for the ICs
-            wrfInitFilesExist = wrfInitFilesExist and os.path.exists(wrfinputPath)
-            wrflowinpPath = os.path.join(
-                run_dir_with_date, "wrflowinp_{}".format(dom)
-            )  ## check for SSTs
-            wrfInitFilesExist = wrfInitFilesExist and os.path.exists(wrflowinpPath)
-        ##
-        if not wrf_config.only_edit_namelists:
-            if not wrfInitFilesExist:
-                print("\t\tThe WRF initialisation files did not exist...")
-                # Check that the topography files exist
-                geoFilesExist = True
-                print("\tCheck that the geo_em files exist")
-                for iDom in range(nDom):
-                    dom = "d0{}".format(iDom + 1)
-                    geoFile = "geo_em.{}.nc".format(dom)
-                    geoPath = os.path.join(wrf_config.geo_em_dir, geoFile)
-                    if not os.path.exists(geoPath):
-                        geoFilesExist = False
-                ## If not, produce them
-                if geoFilesExist:
-                    print("\t\tThe geo_em files were indeed found")
-                else:
-                    print("\t\tThe geo_em files did not exist - create them")
-                    ## copy the WPS namelist substituting the geog_data_path
-                    WPSnml["geogrid"]["geog_data_path"] = wrf_config.geog_data_path
-                    dst = os.path.join(run_dir_with_date, "namelist.wps")
-                    WPSnml.write(dst)
-                    ## copy the geogrid table
-                    src = wrf_config.geogrid_tbl
-                    assert os.path.exists(
-                        src
-                    ), "Cannot find GEOGRID.TBL at {} ...".format(src)
-
-                    geogridFolder = os.path.join(run_dir_with_date, "geogrid")
-                    os.makedirs(geogridFolder, exist_ok=True)
-
-                    ##
-                    dst = os.path.join(run_dir_with_date, "geogrid", "GEOGRID.TBL")
-                    if os.path.exists(dst):
-                        os.remove(dst)
-                    os.symlink(src, dst)
-                    ## link to the geogrid.exe program
-                    src = wrf_config.geogrid_exe
-                    assert os.path.exists(
-                        src
-                    ), "Cannot find geogrid.exe at {} ...".format(src)
-                    dst = os.path.join(run_dir_with_date, "geogrid.exe")
-                    if not os.path.exists(dst):
-                        os.symlink(src, dst)
-                    ## move to the directory and run geogrid.exe
-                    os.chdir(run_dir_with_date)
-                    print(
-                        "\t\tRun geogrid at {}".format(
-                            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                        )
-                    )
-
-                    run_command(["./geogrid.exe"], log_prefix="geogrid.log")
-
-                    ## check that it ran
-                    dom = "d0{}".format(nDom)
-                    geoFile = "geo_em.{}.nc".format(dom)
-                    assert os.path.exists(
-                        geoFile
-                    ), "./geogrid.exe did not produce expected output..."
-                    ##
-                    src = "namelist.wps"
-                    dst = "namelist.wps.geogrid"
-                    os.rename(src, dst)
-                    ## compress the output
-                    print("\tCompress the geo_em files")
-                    for iDom in range(nDom):
-                        dom = "d0{}".format(iDom + 1)
-                        geoFile = "geo_em.{}.nc".format(dom)
-                        compress_nc_file(geoFile)
-                        ## move the file to the namelist directory
-                        src = os.path.join(run_dir_with_date, geoFile)
-                        dst = os.path.join(wrf_config.geo_em_dir, geoFile)
-                        shutil.move(src, dst)
-                ##
-                ## link to the geo files
-                for iDom in range(nDom):
-                    dom = "d0{}".format(iDom + 1)
-                    geoFile = "geo_em.{}.nc".format(dom)
-                    ## move the file to the namelist directory
-                    src = os.path.join(wrf_config.geo_em_dir, geoFile)
-                    dst = os.path.join(run_dir_with_date, geoFile)
-                    if not os.path.exists(dst):
-                        os.symlink(src, dst)
-                ##
-                print("\tCheck that the met_em files exist")
-                if not os.path.exists(wrf_config.metem_dir):
-                    os.makedirs(wrf_config.metem_dir, exist_ok=True)
-                    metemFilesExist = False
-                else:
-                    metemFilesExist = True
-                    ## check if the met_em files exist
-                    for hour in range(0, run_length_total_hours + 1, 6):
-                        metem_time = job_start + datetime.timedelta(seconds=hour * 3600)
-                        metem_time_str = metem_time.strftime("%Y-%m-%d_%H:%M:%S")
-                        for iDom in range(nDom):
-                            dom = "d0{}".format(iDom + 1)
-                            metem_file = os.path.join(
-                                wrf_config.metem_dir,
-                                "met_em.{}.{}.nc".format(dom, metem_time_str),
-                            )
-                            metemFilesExist = metemFilesExist and os.path.exists(
-                                metem_file
-                            )
-                ##
-                if not metemFilesExist:
-                    print("\t\tThe met_em files did not exist - create them")
-                    ##
-                    os.chdir(run_dir_with_date)
-                    ## deal with SSTs first
-                    ##
-                    ## copy the link_grib script
-                    src = wrf_config.linkgrib_script
-                    assert os.path.exists(
-                        src
-                    ), "Cannot find link_grib.csh at {} ...".format(src)
-                    dst = os.path.join(run_dir_with_date, "link_grib.csh")
-                    if os.path.exists(dst):
-                        os.remove(dst)
-                    os.symlink(src, dst)
-                    ## link the ungrib executabble
-                    src = wrf_config.ungrib_exe
-                    assert os.path.exists(
-                        src
-                    ), "Cannot find ungrib.exe at {} ...".format(src)
-                    dst = os.path.join(run_dir_with_date, "ungrib.exe")
-                    if not os.path.exists(dst):
-                        os.symlink(src, dst)
-
-                    wpsStrDate = (job_start - datetime.timedelta(days=1)).date()
-                    wpsEndDate = (job_end + datetime.timedelta(days=1)).date()
-                    nDaysWps = (wpsEndDate - wpsStrDate).days + 1
-
-                    ## should we use ERA-Interim analyses?
-                    if wrf_config.analysis_source == "ERAI":
-                        if wrf_config.use_high_res_sst_data:
-                            ## configure the namelist
-                            ## EDIT: the following are the substitutions used for the WPS namelist
-                            WPSnml["share"]["start_date"] = [
-                                job_start.strftime("%Y-%m-%d_00:00:00")
-                            ] * nDom
-                            WPSnml["share"]["end_date"] = [
-                                (job_end.date() + datetime.timedelta(days=1)).strftime(
-                                    "%Y-%m-%d_%H:%M:%S"
-                                )
-                            ] * nDom
-                            WPSnml["share"]["interval_seconds"] = (
-                                6 * 60 * 60
-                            )  ## 24*60*60
-                            WPSnml["ungrib"]["prefix"] = "SST"
-                            WPSnml["geogrid"]["geog_data_path"] = (
-                                wrf_config.geog_data_path
-                            )
-                            ## end edit section #####################################################
-                            ## write out the namelist
-                            if os.path.exists("namelist.wps"):
-                                os.remove("namelist.wps")
-                            ##
-                            WPSnml.write("namelist.wps")
-
-                            sstDir = "sst_tmp"
-                            if not os.path.exists(sstDir):
-                                os.makedirs(sstDir, exist_ok=True)
-                            ##
-                            for iDayWps in range(nDaysWps):
-                                wpsDate = wpsStrDate + datetime.timedelta(days=iDayWps)
-                                ## check for the monthly file
-                                monthlyFile = wpsDate.strftime(
-                                    wrf_config.sst_monthly_pattern
-                                )
-                                monthlyFileSrc = os.path.join(
-                                    wrf_config.sst_monthly_dir, monthlyFile
-                                )
-                                monthlyFileDst = os.path.join(sstDir, monthlyFile)
-                                if os.path.exists(monthlyFileSrc) and (
-                                    not os.path.exists(monthlyFileDst)
-                                ):
-                                    if not os.path.exists(monthlyFileDst):
-                                        os.symlink(monthlyFileSrc, monthlyFileDst)
-                                ## check for the daily file
-                                dailyFile = wpsDate.strftime(
-                                    wrf_config.sst_daily_pattern
-                                )
-                                dailyFileSrc = os.path.join(
-                                    wrf_config.sst_daily_dir, dailyFile
-                                )
-                                dailyFileDst = os.path.join(sstDir, dailyFile)
-                                if os.path.exists(dailyFileSrc) and (
-                                    not os.path.exists(dailyFileDst)
-                                ):
-                                    if not os.path.exists(dailyFileDst):
-                                        os.symlink(dailyFileSrc, dailyFileDst)
-                            ##
-                            purge(run_dir_with_date, "GRIBFILE*")
-                            print(
-                                "\t\tRun link_grib for the SST data at {}".format(
-                                    datetime.datetime.utcnow().strftime(
-                                        "%Y-%m-%d %H:%M:%S"
-                                    )
-                                )
-                            )
-
-                            run_command(
-                                ["./link_grib.csh", os.path.join(sstDir, "*")],
-                                log_prefix="link_grib_sst.log",
-                            )
-
-                            ## check that it ran
-                            ## time.sleep(0.2)
-                            gribmatches = [
-                                f
-                                for f in os.listdir(run_dir_with_date)
-                                if re.search("GRIBFILE", f) is not None
-                            ]
-                            if len(gribmatches) == 0:
-                                raise RuntimeError(
-                                    "Gribfiles not linked successfully..."
-                                )
-                            ## link to the SST Vtable
-                            src = wrf_config.sst_vtable
-                            assert os.path.exists(
-                                src
-                            ), "SST Vtable expected at {}".format(src)
-                            dst = "Vtable"
-                            if os.path.exists(dst):
-                                os.remove(dst)
-                            os.symlink(src, dst)
-                            purge(run_dir_with_date, "SST:*")
-                            purge(run_dir_with_date, "PFILE:*")
-                            ## run ungrib on the SST files
-                            print(
-                                "\t\tRun ungrib for the SST data at {}".format(
-                                    datetime.datetime.utcnow().strftime(
-                                        "%Y-%m-%d %H:%M:%S"
-                                    )
-                                )
-                            )
-                            stdout, _ = run_command(
-                                ["./ungrib.exe"], log_prefix="ungrib_sst.log"
-                            )
-
-                            ## check that it ran
-                            ## matches = grep_file('Successful completion of ungrib', logfile)
-                            matches = grep_lines(
-                                "Successful completion of ungrib", stdout
-                            )
-                            if len(matches) == 0:
-                                raise RuntimeError(
-                                    "Success message not found in ungrib logfile..."
-                                )
-
-                            src = "namelist.wps"
-                            dst = "namelist.wps.sst"
-                            os.rename(src, dst)
-
-                        analysisDir = "analysis_tmp"
-                        if not os.path.exists(analysisDir):
-                            os.makedirs(analysisDir, exist_ok=True)
-
-                    for pattern in [
-                        wrf_config.analysis_pattern_surface,
-                        wrf_config.analysis_pattern_upper,
-                    ]:
-                        files = set([])
-                        for iDayWps in range(nDaysWps):
-                            wpsDate = wpsStrDate + datetime.timedelta(days=iDayWps)
-                            patternWithDates = wpsDate.strftime(pattern)
-                            files = files.union(set(glob.glob(patternWithDates)))
-                        ##
-                        files = list(files)
-                        files.sort()
-                        if pattern == "analysis_pattern_upper":
-                            ## for the upper-level files, be selective and use only those that contain the relevant range of dates
-                            for ifile, filename in enumerate(files):
-                                fileStartDateStr = os.path.basename(filename).split(
-                                    "_"
-                                )[-2]
-                                fileEndDateStr = os.path.basename(filename).split("_")[
-                                    -1
-                                ]
-                                fileStartDate = datetime.datetime.strptime(
-                                    fileStartDateStr, "%Y%m%d"
-                                ).date()
-                                fileEndDate = datetime.datetime.strptime(
-                                    fileEndDateStr, "%Y%m%d"
-                                ).date()
-                                ##
-                                if (
-                                    fileStartDate <= wpsStrDate
-                                    and wpsStrDate <= fileEndDate
-                                ):
-                                    ifileStart = ifile
-                                ##
-                                if (
-                                    fileStartDate <= wpsEndDate
-                                    and wpsEndDate <= fileEndDate
-                                ):
-                                    ifileEnd = ifile
-                        else:
-                            ## for the surface files use all those that match
-                            ifileStart = 0
-                            ifileEnd = len(files) - 1
-                        ##
-                        for ifile in range(ifileStart, ifileEnd + 1):
-                            src = files[ifile]
-                            dst = os.path.join(analysisDir, os.path.basename(src))
-                            if not os.path.exists(dst):
-                                os.symlink(src, dst)
-
-                            ## prepare to run link_grib.csh
-                            linkGribCmds = [
-                                "./link_grib.csh",
-                                os.path.join(analysisDir, "*"),
-                            ]
-
-                    else:
-                        ## consider the case that we are using the FNL datax
-                        nIntervals = (
-                            int(
-                                round(
-                                    (job_end - job_start).total_seconds() / 3600.0 / 6.0
-                                )
-                            )
-                            + 1
-                        )
-                        FNLtimes = [
-                            job_start + datetime.timedelta(hours=6 * hi)
-                            for hi in range(nIntervals)
-                        ]
-                        FNLfiles = [
-                            time.strftime("gdas1.fnl0p25.%Y%m%d%H.f00.grib2")
-                            for time in FNLtimes
-                        ]
-                        ## if the FNL data exists, don't bother downloading
-                        allFNLfilesExist = all(
-                            [os.path.exists(FNLfile) for FNLfile in FNLfiles]
-                        )
-                        if allFNLfilesExist:
-                            print(
-                                "\t\tAll FNL files were found - do not repeat the download"
-                            )
-                        else:
-                            ## otherwise download all the required FNL files
-                            FNLfiles = download_gdas_fnl_data(
-                                target_dir=run_dir_with_date,
-                                download_dts=FNLtimes,
-                            )
-                        linkGribCmds = ["./link_grib.csh"] + FNLfiles
-                        ## optionally take a regional subset
-                        if wrf_config.regional_subset_of_grib_data:
-                            geoFile = "geo_em.d01.nc"
-                            ## find the geographical region, and add a few degrees on either side
-                            geoStrs = {}
-                            nc = netCDF4.Dataset(geoFile)
-                            for varname in ["XLAT_M", "XLONG_M"]:
-                                coords = nc.variables[varname][:]
-                                coords = [coords.min(), coords.max()]
-                                coords = [
-                                    math.floor((coords[0]) / 5.0 - 1) * 5,
-                                    math.ceil((coords[1]) / 5.0 + 1) * 5,
-                                ]
-                                coordStr = "{}:{}".format(coords[0], coords[1])
-                                geoStrs[varname] = coordStr
-                            nc.close()
-                            ## use wgrib2 that
-                            for FNLfile in FNLfiles:
-                                tmpfile = os.path.join(
-                                    "/tmp", os.path.basename(FNLfile)
-                                )
-                                print(
-                                    "\t\tSubset the grib file",
-                                    os.path.basename(FNLfile),
-                                )
-                                _, stderr = run_command(
-                                    [
-                                        "wgrib2",
-                                        FNLfile,
-                                        "-small_grib",
-                                        geoStrs["XLONG_M"],
-                                        geoStrs["XLAT_M"],
-                                        tmpfile,
-                                    ]
-                                )
-                                if len(stderr) > 0:
-                                    print(stderr)
-                                    raise RuntimeError(
-                                        "Errors found when running wgrib2..."
-                                    )
-                                ## use the subset instead - delete the original and put the subset in its place
-                                os.remove(FNLfile)
-                                shutil.copyfile(tmpfile, FNLfile)
-
-                    ## EDIT: the following are the substitutions used for the WPS namelist
-                    WPSnml["share"]["start_date"] = [
-                        job_start.strftime("%Y-%m-%d_%H:%M:%S")
-                    ] * nDom
-                    WPSnml["share"]["end_date"] = [
-                        job_end.strftime("%Y-%m-%d_%H:%M:%S")
-                    ] * nDom
-                    WPSnml["ungrib"]["prefix"] = "ERA"
-                    WPSnml["share"]["interval_seconds"] = 6 * 60 * 60
-                    ## end edit section #####################################################
-
-                    ## write out the namelist
-                    if os.path.exists("namelist.wps"):
-                        os.remove("namelist.wps")
-                    WPSnml.write("namelist.wps")
-                    ##
-                    purge(run_dir_with_date, "GRIBFILE*")
-                    print(
-                        "\t\tRun link_grib for the FNL data at {}".format(
-                            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                        )
-                    )
-                    run_command(linkGribCmds, log_prefix="link_grib_fnl.log")
-
-                    ## check that it ran
-                    gribmatches = [
-                        f
-                        for f in os.listdir(run_dir_with_date)
-                        if re.search("GRIBFILE", f) is not None
-                    ]
-                    if len(gribmatches) == 0:
-                        raise RuntimeError("Gribfiles not linked successfully...")
-
-                    ###################
-                    # Run ungrib
-                    ###################
-
-                    ## link to the relevant Vtable
-                    src = wrf_config.analysis_vtable
-                    assert os.path.exists(src), "Analysis Vtable expected at {}".format(
-                        src
-                    )
-                    dst = os.path.join(run_dir_with_date, "Vtable")
-                    if os.path.exists(dst):
-                        os.remove(dst)
-                    os.symlink(src, dst)
-
-                    purge(run_dir_with_date, "ERA:*")
-                    ## with open('ungrib.log.era', 'w') as output_f:
-                    print(
-                        "\t\tRun ungrib for the ERA data at {}".format(
-                            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                        )
-                    )
-                    stdout, _ = run_command(
-                        ["./ungrib.exe"], log_prefix="ungrib_era.log"
-                    )
-
-                    ## FIXME: check that it worked
-                    matches = grep_lines("Successful completion of ungrib", stdout)
-                    if len(matches) == 0:
-                        print(stdout)
-                        raise RuntimeError(
-                            "Success message not found in ungrib logfile..."
-                        )
-
-                    ## if we are using the FNL analyses, delete the downloaded FNL files
-                    if wrf_config.analysis_source == "FNL":
-                        for FNLfile in FNLfiles:
-                            os.remove(FNLfile)
-
-                    #############
-                    # Run metgrid
-                    #############
-                    print(
-                        "\t\tRun metgrid at {}".format(
-                            datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                        )
-                    )
-                    metgriddir = os.path.join(run_dir_with_date, "metgrid")
-                    os.makedirs(metgriddir, exist_ok=True)
-
-                    WPSnml["metgrid"]["fg_name"] = ["ERA"]
-                    if wrf_config.use_high_res_sst_data:
-                        WPSnml["metgrid"]["fg_name"].append("SST")
-                    ##
-                    ## link to the relevant METGRID.TBL
-                    src = wrf_config.metgrid_tbl
-                    assert os.path.exists(
-                        src
-                    ), "Cannot find METGRID.TBL at {} ...".format(src)
-                    dst = os.path.join(metgriddir, "METGRID.TBL")
-                    if not os.path.exists(dst):
-                        os.symlink(src, dst)
-                    ## link to metgrid.exe
-                    src = wrf_config.metgrid_exe
-                    assert os.path.exists(
-                        src
-                    ), "Cannot find metgrid.exe at {} ...".format(src)
-                    dst = os.path.join(run_dir_with_date, "metgrid.exe")
-                    if not os.path.exists(dst):
-                        os.symlink(src, dst)
-                    ##
-                    ## logfile = 'metgrid_stderr_stdout.log'
-                    ## with open(logfile, 'w') as output_f:
-                    stdout, _ = run_command(["./metgrid.exe"], log_prefix="metgrid.log")
-
-                    matches = grep_lines("Successful completion of metgrid", stdout)
-                    if len(matches) == 0:
-                        raise RuntimeError(
-                            "Success message not found in metgrid logfile..."
-                        )
-
-                    purge(run_dir_with_date, "ERA:*")
-                    if wrf_config.use_high_res_sst_data:
-                        purge(run_dir_with_date, "SST:*")
-                    purge(run_dir_with_date, "FILE:*")
-                    purge(run_dir_with_date, "PFILE:*")
-                    purge(run_dir_with_date, "GRIB:*")
-                    purge(run_dir_with_date, "fort.*")
-
-                    ## move the met_em files into the combined METEM_DIR directory
-                    move_pattern_to_dir(
-                        sourceDir=run_dir_with_date,
-                        pattern="met_em*",
-                        destDir=wrf_config.metem_dir,
-                    )
-
-                ## link to the met_em files
-                os.chdir(run_dir_with_date)
-                print("\t\tlink to the met_em files")
-                for hour in range(0, run_length_total_hours + 1, 6):
-                    metem_time = job_start + datetime.timedelta(seconds=hour * 3600)
-                    metem_time_str = metem_time.strftime("%Y-%m-%d_%H:%M:%S")
-                    for iDom in range(nDom):
-                        dom = "d0{}".format(iDom + 1)
-                        metem_file = "met_em.{}.{}.nc".format(dom, metem_time_str)
-                        src = os.path.join(wrf_config.metem_dir, metem_file)
-                        assert os.path.exists(
-                            src
-                        ), "Cannot find met_em file at {} ...".format(src)
-                        dst = os.path.join(run_dir_with_date, metem_file)
-                        if not os.path.exists(dst):
-                            os.symlink(src, dst)
-
-        if (not wrf_config.only_edit_namelists) and (not wrfInitFilesExist):
-            ## find a met_em file and read the number of atmospheric and soil levels
-            metempattern = os.path.join(wrf_config.metem_dir, "met_em.d*.nc")
-            ##
-            metemfiles = glob.glob(metempattern)
-            assert len(metemfiles) > 0, "No met_em files found..."
-            metemfile = metemfiles[0]
-            nc = netCDF4.Dataset(metemfile)
-            nz_metem = len(nc.dimensions["num_metgrid_levels"])
-            nz_soil = len(nc.dimensions["num_st_layers"])
-            nc.close()
+    ## limit on the rate the FNL analyses are downloaded at
+    bandwidth = None
+    if wrf_config.fnl_download_max_mb_per_s > 0:
+        bandwidth = BandwidthLimit(wrf_config.fnl_download_max_mb_per_s * 1024**2)
+    ## download the analyses of later jobs in the background while earlier jobs run WPS
+    prefetcher = None
+    if wrf_config.fnl_prefetch_max_gb > 0 and wrf_config.analysis_source == "FNL":
+        if fnl_cache is None:
+            print("The FNL analyses are only prefetched if fnl_cache_dir is set")
         else:
-            if wrf_config.analysis_source == "ERAI":
-                nz_metem = 38
-                nz_soil = 4
-            elif wrf_config.analysis_source == "FNL":
-                nz_metem = 27
-                nz_soil = 4
-
-        ## configure the WRF namelist
-        print("\t\tconfigure the WRF namelist")
-        ########## EDIT: the following are the substitutions used for the WRF namelist
-        WRFnml["time_control"]["start_year"] = [job_start.year] * nDom
-        WRFnml["time_control"]["start_month"] = [job_start.month] * nDom
-        WRFnml["time_control"]["start_day"] = [job_start.day] * nDom
-        WRFnml["time_control"]["start_hour"] = [job_start.hour] * nDom
-        WRFnml["time_control"]["start_minute"] = [job_start.minute] * nDom
-        WRFnml["time_control"]["start_second"] = [job_start.second] * nDom
-        ##
-        WRFnml["time_control"]["end_year"] = [job_end.year] * nDom
-        WRFnml["time_control"]["end_month"] = [job_end.month] * nDom
-        WRFnml["time_control"]["end_day"] = [job_end.day] * nDom
-        WRFnml["time_control"]["end_hour"] = [job_end.hour] * nDom
-        WRFnml["time_control"]["end_minute"] = [job_end.minute] * nDom
-        WRFnml["time_control"]["end_second"] = [job_end.second] * nDom
-        ########## end edit section #####################################################
-        ##
-        WRFnml["time_control"]["restart"] = wrf_config.restart
-        ##
-        WRFnml["domains"]["num_metgrid_levels"] = nz_metem
-        WRFnml["domains"]["num_metgrid_soil_levels"] = nz_soil
-        ##
-        nmlfile = "namelist.input"
-        if os.path.exists(nmlfile):
-            os.remove(nmlfile)
-        WRFnml.write(nmlfile)
-        ##
-        # Get real.exe and WRF.exe
-        src = wrf_config.real_exe
-        assert os.path.exists(src), "Cannot find real.exe at {} ...".format(src)
-        dst = os.path.join(run_dir_with_date, "real.exe")
-        if os.path.exists(dst):
-            os.remove(dst)
-        os.symlink(src, dst)
-        ##
-        src = wrf_config.wrf_exe
-        assert os.path.exists(src), "Cannot find wrf.exe at {} ...".format(src)
-        dst = os.path.join(run_dir_with_date, "wrf.exe")
-        if os.path.exists(dst):
-            os.remove(dst)
-        os.symlink(src, dst)
-
-        # get background checking script to initiate averaging
-        src = wrf_config.check_wrfout_in_background_script
-        assert os.path.exists(
-            src
-        ), "Cannot find wrfout checking  script at {} ...".format(src)
-        dst = os.path.join(run_dir_with_date, "checkWrfoutInBackground.py")
-        if os.path.exists(dst):
-            os.remove(dst)
-        os.symlink(src, dst)
-
-        # Get tables
-        link_pattern_to_dir(
-            sourceDir=wrf_config.wrf_run_dir,
-            pattern=wrf_config.wrf_run_tables_pattern,
-            destDir=run_dir_with_date,
-        )
+            prefetcher = AnalysisPrefetcher(
+                fnl_cache,
+                max_bytes=int(wrf_config.fnl_prefetch_max_gb * 1024**3),
+                chunk_size=wrf_config.fnl_download_chunk_bytes,
+                concurrency=wrf_config.fnl_download_concurrency,
+                subset_vtable=(
+                    wrf_config.analysis_vtable
+                    if wrf_config.fnl_download_mode == "inventory"
+                    else None
+                ),
+                bandwidth=bandwidth,
+            )
 
-        # link to scripts from the namelist and target directories
-        for input_directory, scripts_to_copy in (
-            (wrf_config.target_dir, wrf_config.scripts_to_copy_from_target_dir),
-            (wrf_config.nml_dir, wrf_config.scripts_to_copy_from_nml_dir),
-        ):
-            scripts_to_copy = scripts_to_copy.split(",")
-
-            for script_to_copy in scripts_to_copy:
-                symlink_file(input_directory, run_dir_with_date, script_to_copy)
-
-        if (not wrf_config.only_edit_namelists) and (not wrfInitFilesExist):
-            run_wrf(wrf_config)
-
-        ## clean up the links to the met_em files regardless, as they are no longer needed
-        purge(run_dir_with_date, "met_em*")
-
-        ## generate the run and cleanup scripts
-        print("\t\tGenerate the run and cleanup script")
-
-        ########## EDIT: the following are the substitutions used for the per-run cleanup and run scripts
-        substitutions = {
-            "RUN_DIR": run_dir_with_date,
-            "RUNSHORT": wrf_config.run_name[:8],
-            "STARTDATE": job_start_usable.strftime("%Y%m%d"),
-            "firstTimeToKeep": job_start_usable.strftime("%Y-%m-%dT%H%M"),
-        }
-        ########## end edit section #####################################################
-
-        ## write out the run and cleanup script
-        for dailyScriptName in dailyScriptNames:
-            ## do the substitutions
-            thisScript = copy.copy(scripts[dailyScriptName])
-            for avail_key in list(substitutions.keys()):
-                key = "${%s}" % avail_key
-                value = substitutions[avail_key]
-                thisScript = [item.replace(key, value) for item in thisScript]
-            ## write out the lines
-            scriptFile = "{}.sh".format(dailyScriptName)
-            scriptPath = os.path.join(run_dir_with_date, scriptFile)
-            f = open(scriptPath, "w")
-            f.writelines(thisScript)
-            f.close()
-            ## make executable
-            os.chmod(scriptPath, os.stat(scriptPath).st_mode | stat.S_IEXEC)
-
-
-def run_wrf(wrf_config: WRFConfig):
+    ## links to met_em files are only cleared up front if the namelist step will relink them
+    selected_steps = STEPS[
+        STEPS.index(first_step or STEPS[0]) : STEPS.index(last_step or STEPS[-1]) + 1
+    ]
+    pipeline = build_pipeline(
+        wrf_config,
+        scripts,
+        WPSnml,
+        WRFnml,
+        number_of_jobs,
+        check_wrfout_options,
+        fnl_cache,
+        prefetcher,
+        bandwidth,
+        jobs,
+        purge_metem_links="namelist" in selected_steps,
+    ).select(first_step, last_step)
+    print("Run {} stages".format(len(pipeline.stages)))
+    if prefetcher is not None and any(
+        stage.step == "download" for stage in pipeline.stages.values()
+    ):
+        with prefetcher:
+            pipeline.run(max_workers=jobs)
+    else:
+        pipeline.run(max_workers=jobs)
+
+
+def run_wrf(wrf_config: WRFConfig, run_dir: str):
     print(
         "\t\tRun real.exe at {}".format(
             datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
         )
     )
-    run_command(["mpirun", "-np", "1", "./real.exe"], log_prefix="real.log")
-    rsloutfile = "rsl.out.0000"
+    run_command(
+        ["mpirun", "-np", "1", "./real.exe"], log_prefix="real.log", cwd=run_dir
+    )
+    rsloutfile = os.path.join(run_dir, "rsl.out.0000")
 
     complete_message = "SUCCESS COMPLETE REAL_EM INIT"
     with open(rsloutfile) as fh:
@@ -880,19 +1772,19 @@ def run_wrf(wrf_config: WRFConfig):
             "Success message not found in real.exe logfile (rsl.out.0000)..."
         )
     # Clean up symlinks
-    if os.path.exists("link_grib.csh"):
-        os.remove("link_grib.csh")
-    if os.path.exists("Vtable"):
-        os.remove("Vtable")
-    if os.path.exists("metgrid"):
-        shutil.rmtree("metgrid")
-    if os.path.exists("metgrid.exe"):
-        os.remove("metgrid.exe")
-    if os.path.exists("ungrib.exe"):
-        os.remove("ungrib.exe")
+    for filename in ["link_grib.csh", "Vtable", "metgrid.exe", "ungrib.exe"]:
+        path = os.path.join(run_dir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+    if os.path.exists(os.path.join(run_dir, "metgrid")):
+        shutil.rmtree(os.path.join(run_dir, "metgrid"))
     ## optionally delete the met_em files once they have been used
-    if wrf_config.delete_metem_files:
-        purge(wrf_config.metem_dir, "met_em*")
+    ## (jobs running at the same time hold their own links to the files they need).
+    ## In campaign mode the files are needed by later jobs, so they are deleted
+    ## once all the jobs have been prepared
+    if wrf_config.delete_metem_files and wrf_config.wps_mode == "job":
+        with file_lock(os.path.join(wrf_config.metem_dir, METEM_LOCK_FILE)):
+            purge(wrf_config.metem_dir, "met_em*")
 
 
 if __name__ == "__main__":
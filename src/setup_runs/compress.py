@@ -0,0 +1,269 @@
+"""
+Compress netCDF3 files into netCDF4 files
+
+Replaces the `ncks`/`nccopy` commands previously used to compress the WRF output
+and geo_em files. The files are copied variable by variable into a netCDF4 file
+with the compression, chunking and quantization of a `NetCDFEncoding`,
+and several files can be compressed at once in a pool of processes.
+
+Usage:
+
+    python -m setup_runs.compress --workers 4 <files or directories>
+
+Only netCDF3 files (detected from the header of the file) are compressed,
+so directories can be given and files which are already compressed are skipped.
+"""
+
+import concurrent.futures
+import os
+import shutil
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+import netCDF4
+
+from setup_runs.netcdf import NETCDF_LOCK, NetCDFEncoding, parse_chunk_sizes
+
+NETCDF3_FORMATS = {
+    b"CDF\x01": "NETCDF3_CLASSIC",
+    b"CDF\x02": "NETCDF3_64BIT_OFFSET",
+    b"CDF\x05": "NETCDF3_64BIT_DATA",
+}
+"""netCDF3 formats, keyed by the first bytes of the files"""
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+"""First bytes of the netCDF4 (HDF5) files"""
+
+DEFAULT_ENCODING = NetCDFEncoding(complevel=1, compressed_dtypes=None)
+"""Lossless compression of every variable (equivalent to `nccopy -d1 -s`)"""
+
+DEFAULT_MAX_CHUNK_BYTES = 256 * 1024**2
+"""Upper bound on the amount of data copied from a variable at once (256 MiB)"""
+
+
+def netcdf_format(path: str | Path) -> str | None:
+    """
+    Format of a netCDF file, detected from its header
+
+    Parameters
+    ----------
+    path
+        Path to the file
+
+    Returns
+    -------
+        One of the netCDF3 formats (e.g. "NETCDF3_CLASSIC"), "NETCDF4" for HDF5 files,
+        or None if the file isn't a netCDF file
+    """
+    with open(path, "rb") as f:
+        header = f.read(len(HDF5_SIGNATURE))
+    if header == HDF5_SIGNATURE:
+        return "NETCDF4"
+    return NETCDF3_FORMATS.get(header[:4])
+
+
+def find_netcdf3_files(paths: Iterable[str | Path]) -> Iterator[Path]:
+    """
+    Find the netCDF3 files among files and directories (searched recursively)
+    """
+    for path in map(Path, paths):
+        if path.is_dir():
+            files = sorted(p for p in path.rglob("*") if p.is_file())
+        else:
+            files = [path]
+        for file in files:
+            if (
+                not file.is_symlink()
+                and netcdf_format(file) in NETCDF3_FORMATS.values()
+            ):
+                yield file
+
+
+def _copy_variable(
+    src: netCDF4.Variable, trg: netCDF4.Variable, max_chunk_bytes: int
+) -> None:
+    """Copy the data of a variable, slab by slab along its first dimension"""
+    if src.ndim == 0:
+        trg.assignValue(src.getValue())
+        return
+    if src.size == 0:
+        return
+    slab_bytes = src.dtype.itemsize * (src.size // src.shape[0])
+    step = max(1, max_chunk_bytes // max(slab_bytes, 1))
+    for start in range(0, src.shape[0], step):
+        # The slice is bounded explicitly, as it would otherwise extend unlimited dimensions
+        stop = min(start + step, src.shape[0])
+        trg[start:stop] = src[start:stop]
+
+
+def compress_file(
+    path: str | Path,
+    encoding: NetCDFEncoding = DEFAULT_ENCODING,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+) -> bool:
+    """
+    Compress a netCDF3 file into a netCDF4 file, in place
+
+    The compressed file is written next to the original under a temporary name,
+    then renamed over it, so the original is only replaced once it is complete.
+    The netCDF library is only used by one thread of the process at a time
+    (see `setup_runs.netcdf.NETCDF_LOCK`).
+
+    Parameters
+    ----------
+    path
+        Path to the file to compress
+    encoding
+        Compression, chunking and quantization of the variables
+    max_chunk_bytes
+        Maximum number of bytes to copy from a variable at once
+
+    Returns
+    -------
+        True if the file was compressed,
+        False if it was skipped as it isn't a netCDF3 file
+    """
+    path = Path(path)
+    if netcdf_format(path) not in NETCDF3_FORMATS.values():
+        return False
+
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with NETCDF_LOCK, netCDF4.Dataset(path) as src, netCDF4.Dataset(
+            tmp, mode="w", format="NETCDF4"
+        ) as trg:
+            # Copy the stored values, rather than unpacking and repacking them
+            src.set_auto_maskandscale(False)
+            trg.setncatts({a: src.getncattr(a) for a in src.ncattrs()})
+            for name, dim in src.dimensions.items():
+                trg.createDimension(name, None if dim.isunlimited() else len(dim))
+            for name, var in src.variables.items():
+                attributes = {a: var.getncattr(a) for a in var.ncattrs()}
+                fill_value = attributes.pop("_FillValue", None)
+                out = trg.createVariable(
+                    name,
+                    var.dtype,
+                    var.dimensions,
+                    fill_value=fill_value,
+                    **encoding.variable_kwargs(
+                        var.dtype, var.dimensions, [max(n, 1) for n in var.shape]
+                    ),
+                )
+                out.set_auto_maskandscale(False)
+                out.setncatts(attributes)
+                _copy_variable(var, out, max_chunk_bytes)
+        shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return True
+
+
+def compress_files(
+    paths: Iterable[str | Path],
+    encoding: NetCDFEncoding = DEFAULT_ENCODING,
+    workers: int = 1,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+) -> list[Path]:
+    """
+    Compress the netCDF3 files among files and directories
+
+    Parameters
+    ----------
+    paths
+        Files and directories (searched recursively) to compress
+    encoding
+        Compression, chunking and quantization of the variables
+    workers
+        Number of files compressed at once, each in its own process
+    max_chunk_bytes
+        Maximum number of bytes to copy from a variable at once (in each process)
+
+    Returns
+    -------
+        Paths to the files which were compressed
+    """
+    files = list(find_netcdf3_files(paths))
+    compressed = []
+    if workers <= 1:
+        for file in files:
+            if compress_file(file, encoding, max_chunk_bytes):
+                print(file)
+                compressed.append(file)
+        return compressed
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(compress_file, file, encoding, max_chunk_bytes): file
+            for file in files
+        }
+        for future in concurrent.futures.as_completed(futures):
+            if future.result():
+                print(futures[future])
+                compressed.append(futures[future])
+    return sorted(compressed)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Compress netCDF3 files into netCDF4 files, in place."
+    )
+    parser.add_argument(
+        "paths", help="Files or directories (searched recursively)", nargs="+"
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of files compressed at once",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--complevel",
+        help="Deflate level of the variables (0 disables compression)",
+        type=int,
+        default=DEFAULT_ENCODING.complevel,
+    )
+    parser.add_argument(
+        "--no-shuffle",
+        help="Don't apply the shuffle filter before compressing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--chunk-sizes",
+        help="Chunk lengths of the variables, e.g. Time=1,bottom_top=1",
+    )
+    parser.add_argument(
+        "--least-significant-digit",
+        help="Quantize floats, retaining this decimal digit",
+        type=int,
+    )
+    parser.add_argument(
+        "--significant-digits",
+        help="Quantize floats to this number of significant digits (like ncks --ppc)",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-chunk-bytes",
+        help="Maximum number of bytes to copy from a variable at once",
+        type=int,
+        default=DEFAULT_MAX_CHUNK_BYTES,
+    )
+
+    args = parser.parse_args()
+    compressed = compress_files(
+        args.paths,
+        encoding=NetCDFEncoding(
+            complevel=args.complevel,
+            shuffle=not args.no_shuffle,
+            compressed_dtypes=None,
+            chunk_sizes=parse_chunk_sizes(args.chunk_sizes),
+            least_significant_digit=args.least_significant_digit,
+            significant_digits=args.significant_digits,
+        ),
+        workers=args.workers,
+        max_chunk_bytes=args.max_chunk_bytes,
+    )
+    print(f"Compressed {len(compressed)} files")
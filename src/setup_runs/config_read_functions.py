@@ -1,9 +1,13 @@
 import json
 import datetime
+import re
 from typing import Mapping
 
 import pytz
 
+VARIABLE_PATTERN = re.compile(r"\$\{([A-Za-z_][A-Za-z0-9_]*)\}")
+"""Pattern of the references to other keys in the configuration values"""
+
 
 def boolean_converter(
     value: str | bool,
@@ -63,12 +67,32 @@ def add_environment_variables(
     return config
 
 
+class SubstitutionError(ValueError):
+    """
+    The variables of a configuration can't be substituted (undefined or circular references)
+    """
+
+
+def _find_cycle(dependencies: dict[str, set[str]]) -> list[str]:
+    """Follow the dependencies of keys which are all part of, or lead to, a cycle"""
+    key = next(iter(dependencies))
+    path = []
+    while key not in path:
+        path.append(key)
+        key = min(dependencies[key])
+    return path[path.index(key) :] + [key]
+
+
 def substitute_variables(
     config: dict[str, str | bool | int],
 ) -> dict[str, str | bool | int]:
     """
     Perform variable substitutions in the configuration dictionary.
 
+    Values can refer to other keys as `${key}`.
+    The references are parsed once and the values are resolved in dependency order,
+    so each value is only substituted once however long the chains of references are.
+
     Parameters
     ----------
     config
@@ -77,28 +101,54 @@ def substitute_variables(
     Returns
     -------
         The updated configuration dictionary after variable substitutions.
+
+    Raises
+    ------
+    SubstitutionError
+        If a value refers to a key which isn't in the configuration,
+        or values refer to each other in a cycle.
     """
-    avail_keys = list(config.keys())
-    iteration_count = 0
-    while iteration_count < 10:
-        ## check if any entries in the config dictionary need populating
-        foundToken = False
-        for value in config.values():
-            if isinstance(value, str) and value.find("${") >= 0:
-                foundToken = True
-        if not foundToken:
-            break
-        for avail_key in avail_keys:
-            key = "${%s}" % avail_key
-            value = config[avail_key]
-            for k in avail_keys:
-                if isinstance(config[k], str) and config[k].find(key) >= 0:
-                    config[k] = config[k].replace(key, value)
-
-        iteration_count += 1
-
-    # Iteration count for filling variables
-    assert iteration_count < 10, "Config key substitution exceeded iteration limit."
+    ## split the values with references into alternating text and referenced keys
+    templates = {
+        key: VARIABLE_PATTERN.split(value)
+        for key, value in config.items()
+        if isinstance(value, str) and VARIABLE_PATTERN.search(value)
+    }
+    dependencies = {}
+    for key, tokens in templates.items():
+        names = set(tokens[1::2])
+        for name in sorted(names):
+            if name not in config:
+                raise SubstitutionError(
+                    f"Config key {key} refers to an undefined variable: {name}"
+                )
+        dependencies[key] = {name for name in names if name in templates}
+
+    dependents = {key: [] for key in templates}
+    for key, names in dependencies.items():
+        for name in names:
+            dependents[name].append(key)
+    waiting = {key: len(names) for key, names in dependencies.items()}
+    ready = [key for key, count in waiting.items() if count == 0]
+    while ready:
+        key = ready.pop()
+        tokens = templates.pop(key)
+        config[key] = "".join(
+            token if i % 2 == 0 else str(config[token])
+            for i, token in enumerate(tokens)
+        )
+        for dependent in dependents[key]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                ready.append(dependent)
+
+    if templates:
+        cycle = _find_cycle(
+            {key: dependencies[key] & set(templates) for key in templates}
+        )
+        raise SubstitutionError(
+            "Config keys refer to each other in a cycle: {}".format(" -> ".join(cycle))
+        )
 
     return config
 
@@ -0,0 +1,114 @@
+"""Settings for writing compressed netCDF4 output"""
+
+import threading
+
+import numpy
+from attrs import define, field, validators
+
+NETCDF_LOCK = threading.RLock()
+"""
+Lock held while netCDF files are opened, read or written in a process
+
+netCDF4 releases the GIL during I/O, but the netCDF-C and HDF5 libraries
+aren't thread-safe (unless built to be), so threads of a process
+(such as the stages of `setup_runs.scheduler.Pipeline`) must not use them at the same time.
+Separate processes don't need the lock.
+"""
+
+
+def parse_chunk_sizes(value: str | None) -> dict[str, int]:
+    """
+    Parse chunk lengths from a string of the form "Time=1,bottom_top=1"
+
+    Parameters
+    ----------
+    value
+        Comma-separated list of `dimension=length` pairs
+
+    Returns
+    -------
+        Chunk length for each of the named dimensions
+    """
+    chunk_sizes = {}
+    if not value:
+        return chunk_sizes
+    for item in value.split(","):
+        dim, _, length = item.partition("=")
+        if not length:
+            raise ValueError(f"Chunk size should be given as dimension=length: {item}")
+        chunk_sizes[dim.strip()] = int(length)
+    return chunk_sizes
+
+
+@define
+class NetCDFEncoding:
+    """
+    Compression, chunking and quantization applied when creating netCDF4 variables
+
+    The defaults reproduce the historical behaviour of the averaged WRF output:
+    only single precision floats are deflated (at level 4, with shuffling)
+    and the library default chunking is used.
+    """
+
+    complevel: int = field(default=4, validator=validators.in_(range(10)))
+    """Deflate compression level (0 disables compression)"""
+    shuffle: bool = True
+    """Apply the HDF5 shuffle filter before compressing"""
+    compressed_dtypes: tuple[str, ...] | None = ("f4",)
+    """Data types (e.g. "f4", "i4") to compress, or None to compress every variable"""
+    chunk_sizes: dict[str, int] = field(factory=dict)
+    """
+    Chunk length for each named dimension
+
+    Dimensions that are not listed use their full length.
+    If empty, the netCDF library chooses the chunking.
+    """
+    least_significant_digit: int | None = None
+    """Quantize floats so that the given decimal digit is retained"""
+    significant_digits: int | None = None
+    """Quantize floats to the given number of significant digits (ncks `--ppc` equivalent)"""
+    quantize_mode: str = field(
+        default="BitGroom",
+        validator=validators.in_(["BitGroom", "BitRound", "GranularBitRound"]),
+    )
+    """Algorithm used when quantizing to `significant_digits`"""
+
+    def variable_kwargs(
+        self, dtype: numpy.dtype, dimensions: tuple[str, ...], dimlens
+    ) -> dict:
+        """
+        Keyword arguments for `netCDF4.Dataset.createVariable`
+
+        Parameters
+        ----------
+        dtype
+            Data type of the variable
+        dimensions
+            Names of the dimensions of the variable
+        dimlens
+            Length of each of the dimensions (unlimited dimensions counted as 1)
+
+        Returns
+        -------
+            Encoding keyword arguments
+        """
+        dtype = numpy.dtype(dtype)
+        kwargs = {}
+        if self.complevel > 0 and (
+            self.compressed_dtypes is None or dtype.str[1:] in self.compressed_dtypes
+        ):
+            kwargs["zlib"] = True
+            kwargs["complevel"] = self.complevel
+            kwargs["shuffle"] = self.shuffle
+        if self.chunk_sizes and len(dimensions):
+            kwargs["chunksizes"] = [
+                max(1, min(self.chunk_sizes.get(dim, dimlen), dimlen))
+                for dim, dimlen in zip(dimensions, dimlens)
+            ]
+        if dtype.kind == "f":
+            if self.least_significant_digit is not None:
+                kwargs["least_significant_digit"] = self.least_significant_digit
+            if self.significant_digits is not None:
+                kwargs["significant_digits"] = self.significant_digits
+                kwargs["quantize_mode"] = self.quantize_mode
+        return kwargs
@@ -0,0 +1,207 @@
+"""
+Run a pipeline of stages with declared inputs and outputs
+
+Each stage declares the artifacts it needs (`inputs`) and those it produces (`outputs`).
+A stage depends on the stages producing its inputs,
+and inputs which no stage produces are assumed to exist already.
+Stages whose dependencies have completed are run concurrently
+(in threads, as the stages mostly wait on external programs and downloads).
+The netCDF libraries aren't thread-safe, so stages which read or write netCDF files
+in the process must hold `setup_runs.netcdf.NETCDF_LOCK` while doing so.
+
+Every stage also belongs to a step of the pipeline (for example "ungrib"),
+so part of the pipeline can be re-run by selecting a range of steps.
+"""
+
+import concurrent.futures
+import heapq
+from collections.abc import Callable, Sequence
+
+from attrs import define, field
+
+
+class PipelineError(ValueError):
+    """
+    The stages of a pipeline are inconsistent (unknown steps, duplicated outputs or cycles)
+    """
+
+
+@define
+class Stage:
+    name: str
+    """Unique name of the stage"""
+    step: str
+    """Step of the pipeline the stage belongs to"""
+    action: Callable[[], object]
+    """Function run by the stage"""
+    inputs: tuple[str, ...] = field(default=(), converter=tuple)
+    """Artifacts needed by the stage"""
+    outputs: tuple[str, ...] = field(default=(), converter=tuple)
+    """Artifacts produced by the stage"""
+
+
+class Pipeline:
+    """
+    Set of stages run in dependency order
+
+    Parameters
+    ----------
+    steps
+        Names of the steps, in the order they run
+    """
+
+    def __init__(self, steps: Sequence[str]):
+        self.steps = tuple(steps)
+        self.stages: dict[str, Stage] = {}
+        self._producers: dict[str, str] = {}
+
+    def add(self, stage: Stage) -> Stage:
+        """
+        Add a stage to the pipeline
+
+        Returns
+        -------
+            The stage that was added
+        """
+        if stage.step not in self.steps:
+            raise PipelineError(f"Unknown step {stage.step!r} of stage {stage.name!r}")
+        if stage.name in self.stages:
+            raise PipelineError(f"Duplicate stage {stage.name!r}")
+        for output in stage.outputs:
+            if output in self._producers:
+                raise PipelineError(
+                    f"{output!r} is produced by both {self._producers[output]!r} and {stage.name!r}"
+                )
+        self.stages[stage.name] = stage
+        for output in stage.outputs:
+            self._producers[output] = stage.name
+        return stage
+
+    def dependencies(self, name: str) -> set[str]:
+        """
+        Names of the stages producing the inputs of a stage
+        """
+        return {
+            self._producers[item]
+            for item in self.stages[name].inputs
+            if item in self._producers
+        }
+
+    def select(self, first: str | None = None, last: str | None = None) -> "Pipeline":
+        """
+        Select the stages of a range of steps
+
+        The outputs of the stages which aren't selected are assumed to exist already.
+
+        Parameters
+        ----------
+        first
+            First step to run (defaults to the first step)
+        last
+            Last step to run (defaults to the last step)
+
+        Returns
+        -------
+            A pipeline of the selected stages
+        """
+        for step in (first, last):
+            if step is not None and step not in self.steps:
+                raise PipelineError(f"Unknown step {step!r}")
+        start = 0 if first is None else self.steps.index(first)
+        stop = len(self.steps) if last is None else self.steps.index(last) + 1
+        selected_steps = self.steps[start:stop]
+
+        pipeline = Pipeline(self.steps)
+        for stage in self.stages.values():
+            if stage.step in selected_steps:
+                pipeline.add(stage)
+        return pipeline
+
+    def _dependents(self) -> tuple[dict[str, int], dict[str, list[str]]]:
+        """Number of dependencies of each stage, and the stages depending on each stage"""
+        waiting = {}
+        dependents = {name: [] for name in self.stages}
+        for name in self.stages:
+            dependencies = self.dependencies(name)
+            waiting[name] = len(dependencies)
+            for dependency in dependencies:
+                dependents[dependency].append(name)
+        return waiting, dependents
+
+    def order(self) -> list[Stage]:
+        """
+        Stages in an order which satisfies their dependencies
+
+        Of the stages which are ready, the one added first comes first.
+
+        Raises
+        ------
+        PipelineError
+            If the stages depend on each other in a cycle
+        """
+        index = {name: i for i, name in enumerate(self.stages)}
+        waiting, dependents = self._dependents()
+        ready = [index[name] for name, count in waiting.items() if count == 0]
+        heapq.heapify(ready)
+        names = list(self.stages)
+        ordered = []
+        while ready:
+            name = names[heapq.heappop(ready)]
+            ordered.append(self.stages[name])
+            for dependent in dependents[name]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    heapq.heappush(ready, index[dependent])
+        if len(ordered) < len(self.stages):
+            raise PipelineError(
+                "Stages depend on each other in a cycle: {}".format(
+                    ", ".join(name for name, count in waiting.items() if count > 0)
+                )
+            )
+        return ordered
+
+    def run(self, max_workers: int = 1) -> None:
+        """
+        Run the stages, each once its dependencies have completed
+
+        When more stages are ready than there are workers,
+        those added first (such as the stages of earlier jobs) are started first.
+        If a stage fails, no further stages are started
+        and the exception is raised once the running stages have finished.
+
+        Parameters
+        ----------
+        max_workers
+            Maximum number of stages to run at once.
+            With one worker the stages are run in order in the calling thread.
+        """
+        ordered = self.order()
+        if max_workers == 1:
+            for stage in ordered:
+                stage.action()
+            return
+
+        index = {name: i for i, name in enumerate(self.stages)}
+        names = list(self.stages)
+        waiting, dependents = self._dependents()
+        ready = [index[name] for name, count in waiting.items() if count == 0]
+        heapq.heapify(ready)
+        running = {}
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            while ready or running:
+                while ready and len(running) < max_workers:
+                    name = names[heapq.heappop(ready)]
+                    running[executor.submit(self.stages[name].action)] = name
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    name = running.pop(future)
+                    future.result()
+                    for dependent in dependents[name]:
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0:
+                            heapq.heappush(ready, index[dependent])
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,128 @@
+"""
+Render the template scripts of a run
+
+Templates contain `${NAME}` placeholders, which are replaced by the value of `NAME`.
+Placeholders without a value, and shell expansions such as `${NCPUS:-1}`,
+are left as they are, so the templates can use shell variables.
+
+Each template is split into literal text and placeholders once (`Template`),
+so rendering it for many jobs is a single join per file.
+The rendered files are only written if their content changed (`write_if_changed`),
+which keeps the modification times of up-to-date files
+and makes regenerating the scripts of a long run cheap.
+"""
+
+import os
+import re
+import stat
+from collections.abc import Iterable, Mapping
+from pathlib import Path
+
+PLACEHOLDER_PATTERN = re.compile(r"\$\{([A-Za-z_][A-Za-z0-9_]*)\}")
+"""Pattern of the placeholders in the templates"""
+
+
+class Template:
+    """
+    Template compiled into literal text and placeholders
+
+    Args:
+        text: Content of the template
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        # Alternating literal text and placeholder names, starting with literal text
+        self._tokens = PLACEHOLDER_PATTERN.split(text)
+
+    @classmethod
+    def from_file(cls, path: str | Path) -> "Template":
+        """Read a template from a file"""
+        with open(path) as f:
+            return cls(f.read())
+
+    @property
+    def names(self) -> set[str]:
+        """Names of the placeholders in the template"""
+        return set(self._tokens[1::2])
+
+    def render(self, substitutions: Mapping[str, str]) -> str:
+        """
+        Replace the placeholders by their values
+
+        Args:
+            substitutions: Value of each placeholder.
+                Placeholders which aren't given are left in place.
+
+        Returns:
+            The rendered text
+        """
+        return "".join(
+            token if i % 2 == 0 else substitutions.get(token, "${%s}" % token)
+            for i, token in enumerate(self._tokens)
+        )
+
+
+def write_if_changed(path: str | Path, content: str, executable: bool = False) -> bool:
+    """
+    Write a file, unless it already has the given content
+
+    The content is written to a temporary file which is renamed over the file,
+    so the file is never left partially written.
+
+    Args:
+        path: Path to the file
+        content: Content of the file
+        executable: Make the file executable by its owner
+
+    Returns:
+        True if the file was written, False if it was already up to date
+    """
+    path = Path(path)
+    try:
+        current_mode = path.stat().st_mode
+        with open(path) as f:
+            unchanged = f.read() == content
+    except FileNotFoundError:
+        current_mode = None
+        unchanged = False
+
+    if unchanged:
+        if executable and not current_mode & stat.S_IEXEC:
+            os.chmod(path, current_mode | stat.S_IEXEC)
+        return False
+
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "w") as f:
+            f.write(content)
+        mode = os.stat(tmp).st_mode if current_mode is None else current_mode
+        if executable:
+            mode |= stat.S_IEXEC
+        os.chmod(tmp, stat.S_IMODE(mode))
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return True
+
+
+def render_files(
+    files: Iterable[tuple[str | Path, Template, Mapping[str, str]]],
+    executable: bool = False,
+) -> list[Path]:
+    """
+    Render a batch of templates into files, writing only the files which changed
+
+    Args:
+        files: Path, template and substitutions of each file
+        executable: Make the files executable by their owner
+
+    Returns:
+        Paths to the files which were written
+    """
+    written = []
+    for path, template, substitutions in files:
+        if write_if_changed(path, template.render(substitutions), executable):
+            written.append(Path(path))
+    return written
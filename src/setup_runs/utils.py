@@ -1,20 +1,60 @@
 """Utility functions used by a number of different functions"""
 
+import asyncio
+import codecs
+import collections
+import contextlib
+import fcntl
+import io
+import json
 import pathlib
 import subprocess
 import os
 import re
+import threading
+from collections.abc import Callable, Sequence
+
+from attrs import define, field
+
+from setup_runs.compress import compress_file
+from setup_runs.netcdf import NetCDFEncoding
+
+STREAM_CHUNK_SIZE = 64 * 1024
+"""Number of bytes read from the output of a command at a time"""
+
+DEFAULT_TAIL_LINES = 20
+"""Number of lines of output kept by `run_command_async` for error messages"""
 
 
 def run_command(
-    command_list: list[str], log_prefix: str | None = None, verbose: bool = False
+    command_list: list[str],
+    log_prefix: str | None = None,
+    verbose: bool = False,
+    cwd: str | pathlib.Path | None = None,
 ) -> tuple[str, str]:
-    p = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    """
+    Run a command, capturing its output
+
+    Args:
+        command_list: Command and its arguments
+        log_prefix: If given, the output is also written to `{log_prefix}.stdout`
+            and `{log_prefix}.stderr` (relative to `cwd`)
+        verbose: Print the output even if the command succeeds
+        cwd: Directory to run the command in (defaults to the current directory)
+
+    Returns:
+        The stdout and stderr of the command
+    """
+    p = subprocess.Popen(
+        command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd
+    )
     stdout, stderr = p.communicate()
     stdout = stdout.decode()
     stderr = stderr.decode()
 
     if log_prefix:
+        if cwd is not None:
+            log_prefix = os.path.join(cwd, log_prefix)
         with open(f"{log_prefix}.stdout", "w") as f:
             f.write(stdout)
         with open(f"{log_prefix}.stderr", "w") as f:
@@ -29,8 +69,226 @@ def run_command(
     return stdout, stderr
 
 
+@define
+class CommandResult:
+    """
+    Outcome of a command run with `run_command_async`
+
+    Only the lines matching the patterns and the last lines of output are kept,
+    the full output is in the log files.
+    """
+
+    command: list[str]
+    """Command and its arguments"""
+    returncode: int
+    """Exit code of the command"""
+    success_pattern: str | None = None
+    """Pattern which had to appear in the output for the command to succeed"""
+    success_line: str | None = None
+    """First line of output matching `success_pattern`"""
+    failure_line: str | None = None
+    """First line of output matching one of the failure patterns"""
+    stdout_tail: list[str] = field(factory=list)
+    """Last lines written to stdout"""
+    stderr_tail: list[str] = field(factory=list)
+    """Last lines written to stderr"""
+
+    @property
+    def succeeded(self) -> bool:
+        """
+        Whether the command succeeded
+
+        A command fails if its output matched a failure pattern.
+        Otherwise it succeeds if its output matched the success pattern,
+        or, without a success pattern, if it exited with code 0.
+        """
+        if self.failure_line is not None:
+            return False
+        if self.success_pattern is not None:
+            return self.success_line is not None
+        return self.returncode == 0
+
+
+async def _pump(
+    stream: asyncio.StreamReader,
+    log: io.BufferedWriter | None,
+    on_line: Callable[[str], None],
+) -> None:
+    """Copy a stream to a log file as it is read, passing each line to `on_line`"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    partial = ""
+    while chunk := await stream.read(STREAM_CHUNK_SIZE):
+        if log is not None:
+            log.write(chunk)
+            log.flush()
+        *lines, partial = (partial + decoder.decode(chunk)).split("\n")
+        for line in lines:
+            on_line(line)
+    partial += decoder.decode(b"", final=True)
+    if partial:
+        on_line(partial)
+
+
+async def run_command_async(
+    command_list: list[str],
+    log_prefix: str | None = None,
+    verbose: bool = False,
+    cwd: str | pathlib.Path | None = None,
+    timeout: float | None = None,
+    success_pattern: str | None = None,
+    failure_patterns: Sequence[str] = (),
+    tail_lines: int = DEFAULT_TAIL_LINES,
+) -> CommandResult:
+    """
+    Run a command, streaming its output to log files
+
+    Unlike `run_command`, the output isn't held in memory:
+    it is written to the log files as it is produced
+    and each line is matched against the patterns as it arrives.
+    Several commands can be run at once with `asyncio.gather` (see `run_commands`).
+
+    Args:
+        command_list: Command and its arguments
+        log_prefix: If given, the output is written to `{log_prefix}.stdout`
+            and `{log_prefix}.stderr` (relative to `cwd`)
+        verbose: Print the output as it is produced
+        cwd: Directory to run the command in (defaults to the current directory)
+        timeout: Number of seconds after which the command is killed
+            (defaults to no limit)
+        success_pattern: Regular expression which has to match a line of the output
+            for the command to succeed
+        failure_patterns: Regular expressions which mark the command as failed
+            if they match a line of the output
+        tail_lines: Number of lines of stdout and stderr to keep
+
+    Returns:
+        The outcome of the command. Failures are printed along with the last lines of output.
+
+    Raises:
+        subprocess.TimeoutExpired: If the command ran for longer than `timeout`
+    """
+    if log_prefix and cwd is not None:
+        log_prefix = os.path.join(cwd, log_prefix)
+    success_regex = re.compile(success_pattern) if success_pattern else None
+    failure_regexes = [re.compile(pattern) for pattern in failure_patterns]
+    result = CommandResult(
+        command=list(command_list), returncode=-1, success_pattern=success_pattern
+    )
+    tails = {
+        "stdout": collections.deque(maxlen=tail_lines),
+        "stderr": collections.deque(maxlen=tail_lines),
+    }
+
+    def on_line(name: str, line: str) -> None:
+        tails[name].append(line)
+        if verbose:
+            print(line)
+        if (
+            success_regex is not None
+            and result.success_line is None
+            and success_regex.search(line)
+        ):
+            result.success_line = line
+        if result.failure_line is None and any(
+            regex.search(line) for regex in failure_regexes
+        ):
+            result.failure_line = line
+
+    with contextlib.ExitStack() as stack:
+        logs = {
+            name: stack.enter_context(open(f"{log_prefix}.{name}", "wb"))
+            if log_prefix
+            else None
+            for name in tails
+        }
+        process = await asyncio.create_subprocess_exec(
+            *command_list,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+        )
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    _pump(
+                        process.stdout,
+                        logs["stdout"],
+                        lambda line: on_line("stdout", line),
+                    ),
+                    _pump(
+                        process.stderr,
+                        logs["stderr"],
+                        lambda line: on_line("stderr", line),
+                    ),
+                    process.wait(),
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(command_list, timeout) from None
+        finally:
+            # Don't leave the command running if it timed out or was cancelled
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    result.returncode = process.returncode
+    result.stdout_tail = list(tails["stdout"])
+    result.stderr_tail = list(tails["stderr"])
+    if not result.succeeded:
+        print(f"Log from command: {command_list}")
+        print(f"Exit Code: {result.returncode}")
+        if result.failure_line is not None:
+            print(f"Failure: {result.failure_line}")
+        print("stdout (last lines): {}".format("\n".join(result.stdout_tail)))
+        print("stderr (last lines): {}".format("\n".join(result.stderr_tail)))
+    return result
+
+
+def stream_command(command_list: list[str], **kwargs) -> CommandResult:
+    """
+    Run a command, streaming its output to log files
+
+    Synchronous version of `run_command_async`, which takes the same arguments.
+    """
+    return asyncio.run(run_command_async(command_list, **kwargs))
+
+
+def run_commands(
+    command_lists: Sequence[list[str]],
+    max_concurrency: int | None = None,
+    **kwargs,
+) -> list[CommandResult]:
+    """
+    Run several commands at once
+
+    Args:
+        command_lists: Commands to run, each with its arguments
+        max_concurrency: Maximum number of commands running at once
+            (defaults to running them all at once)
+        kwargs: Other arguments of `run_command_async`, used for every command.
+            `log_prefix` isn't supported, as the commands would share the log files.
+
+    Returns:
+        The outcome of each command, in the same order as `command_lists`
+    """
+    if "log_prefix" in kwargs:
+        raise ValueError("The commands can't share the same log files")
+
+    async def run_all() -> list[CommandResult]:
+        semaphore = asyncio.Semaphore(max_concurrency or max(len(command_lists), 1))
+
+        async def run_one(command_list: list[str]) -> CommandResult:
+            async with semaphore:
+                return await run_command_async(command_list, **kwargs)
+
+        return await asyncio.gather(*map(run_one, command_lists))
+
+    return asyncio.run(run_all())
+
+
 def compress_nc_file(filename: str, ppc: int | None = None) -> None:
-    """Compress a netCDF3 file to netCDF4 using ncks
+    """Compress a netCDF3 file to netCDF4 (see `setup_runs.compress`)
 
     Args:
         filename: Path to the netCDF3 file to compress
@@ -41,28 +299,85 @@ def compress_nc_file(filename: str, ppc: int | None = None) -> None:
     """
 
     if os.path.exists(filename):
-        print(f"Compress file {filename} with ncks")
-        command = f"ncks -4 -L4 -O {filename} {filename}"
-        print("\t" + command)
-        command_list = command.split(" ")
+        print(f"Compress file {filename}")
         if ppc is not None:
             if not isinstance(ppc, int):
                 raise RuntimeError("Argument ppc should be an integer...")
             elif ppc < 1 or ppc > 6:
                 raise RuntimeError("Argument ppc should be between 1 and 6...")
-            else:
-                ppc_text = "--ppc default={}".format(ppc)
-                command_list = (
-                    [command_list[0]] + ppc_text.split(" ") + command_list[1:]
-                )
-        stdout, stderr = run_command(command_list)
-
-        if len(stderr) > 0 or len(stdout) > 0:
-            raise RuntimeError("Error from ncks...")
+        encoding = NetCDFEncoding(
+            complevel=4, compressed_dtypes=None, significant_digits=ppc
+        )
+        if not compress_file(filename, encoding):
+            print("File {} is not a netCDF3 file...".format(filename))
     else:
         print("File {} not found...".format(filename))
 
 
+@contextlib.contextmanager
+def file_lock(path: str | pathlib.Path):
+    """
+    Hold an exclusive lock on a file while in the context
+
+    Used to stop concurrent processes from working on a shared resource at the same time.
+    The lock file is created if needed and left in place afterwards.
+    """
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def fingerprint(path: str | pathlib.Path) -> tuple[int, int]:
+    """
+    Size and modification time of a file
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def load_json_entries(path: str | pathlib.Path) -> dict[str, dict]:
+    """
+    Read a JSON file of named entries, which is empty if the file doesn't exist
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+_json_update_lock = threading.Lock()
+
+
+def update_json_entry(path: str | pathlib.Path, name: str, entry: dict | None):
+    """
+    Set (or remove if `entry` is None) an entry of a JSON file of named entries
+
+    The file is read, modified and replaced while holding a lock
+    (between the threads of a process and between processes),
+    so concurrent updates don't clobber each other's entries
+    and readers never see a partial file.
+    The lock and temporary files are hidden files next to the JSON file.
+    """
+    path = pathlib.Path(path)
+    hidden_name = path.name if path.name.startswith(".") else f".{path.name}"
+    with _json_update_lock, file_lock(path.with_name(f"{hidden_name}.lock")):
+        entries = load_json_entries(path)
+        if entry is None:
+            if name not in entries:
+                return
+            del entries[name]
+        else:
+            entries[name] = entry
+        tmp_path = path.with_name(f"{hidden_name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+
 def purge(directory: str | pathlib.Path, pattern: str):
     for f in os.listdir(directory):
         if re.search(pattern, f) is not None:
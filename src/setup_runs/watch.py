@@ -0,0 +1,128 @@
+"""
+Watch a directory for files that have finished being written
+
+On Linux, inotify is used to report files as soon as the writer closes them
+(or they are moved into the directory).
+Other platforms need to fall back to polling the directory.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+from pathlib import Path
+
+IN_CLOSE_WRITE = 0x00000008
+"""A file opened for writing was closed"""
+IN_MOVED_TO = 0x00000080
+"""A file was moved into the watched directory"""
+IN_Q_OVERFLOW = 0x00004000
+"""The event queue overflowed and events were lost"""
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def inotify_available() -> bool:
+    """
+    Check if inotify can be used on this platform
+    """
+    return _libc is not None
+
+
+class InotifyWatcher:
+    """
+    Report the names of files which are closed after writing or moved into a directory
+
+    Usage:
+
+        with InotifyWatcher(".") as watcher:
+            while True:
+                for name in watcher.read_events(timeout=60):
+                    ...
+    """
+
+    def __init__(self, directory: str | Path, mask: int = IN_CLOSE_WRITE | IN_MOVED_TO):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self.directory = Path(directory)
+        self.overflowed = False
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        wd = _libc.inotify_add_watch(self._fd, os.fsencode(self.directory), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, os.strerror(err), str(self.directory))
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def read_events(self, timeout: float | None = None) -> list[str]:
+        """
+        Wait for events and return the names of the files they refer to
+
+        Parameters
+        ----------
+        timeout
+            Maximum number of seconds to wait for an event.
+            If None, wait indefinitely.
+
+        Returns
+        -------
+            Names (relative to the watched directory) of the files,
+            in the order the events occurred.
+            Empty if the timeout expired.
+            If events were lost, `overflowed` is set.
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset < len(buffer):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif name and os.fsdecode(name) not in names:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,487 @@
+"""
+Aggregate many WRF output files into daily or monthly means
+
+The frames of each input file are binned into periods using the `Times` variable.
+Running sums for each period are kept on disk in a "sums" file next to the output,
+so the input files are read once, a variable at a time,
+and never concatenated in memory.
+Newly arrived files can later be folded into an existing partial aggregate.
+Each time is counted once: the file each frame came from is recorded in the sums file,
+and a period is rebuilt if a later file provides a frame for a time already folded in.
+"""
+
+import datetime
+import logging
+import os
+import re
+from pathlib import Path
+
+import netCDF4
+import numpy
+
+from setup_runs.netcdf import NetCDFEncoding
+from setup_runs.wrf.average_fields import DEFAULT_MAX_CHUNK_BYTES, select_variables
+
+PERIOD_FORMATS = {"daily": "%Y-%m-%d", "monthly": "%Y-%m"}
+"""Format of the period identifier for each of the supported aggregation periods"""
+
+WRF_TIME_FORMAT = "%Y-%m-%d_%H:%M:%S"
+
+SUMS_SUFFIX = ".sums.nc"
+
+COUNT_SUFFIX = "_aggregate_count"
+"""Suffix of the variables of a sums file counting the valid values of a masked variable"""
+
+logger = logging.getLogger(__name__)
+
+
+def read_times(nc: netCDF4.Dataset) -> list[str]:
+    """
+    Read the time-strings of each frame in a WRF output file
+    """
+    times = numpy.ma.getdata(nc.variables["Times"][:])
+    return [b"".join(row).decode() for row in times]
+
+
+def period_key(time_str: str, period: str) -> str:
+    """
+    Identifier of the period that a WRF time-string belongs to
+
+    Parameters
+    ----------
+    time_str
+        WRF time-string (format %Y-%m-%d_%H:%M:%S)
+    period
+        One of "daily" or "monthly"
+
+    Returns
+    -------
+        Period identifier, for example "2022-07-22" for daily periods
+    """
+    date = datetime.datetime.strptime(time_str, WRF_TIME_FORMAT)
+    return date.strftime(PERIOD_FORMATS[period])
+
+
+def period_start(key: str, period: str) -> str:
+    """
+    WRF time-string of the start of a period
+    """
+    date = datetime.datetime.strptime(key, PERIOD_FORMATS[period])
+    return date.strftime(WRF_TIME_FORMAT)
+
+
+def domain_name(path: Path) -> str:
+    """
+    Domain (e.g. "d01") of a WRF output file, derived from the filename
+    """
+    match = re.search(r"_(d\d\d)_", path.name)
+    return match.group(1) if match else "d01"
+
+
+def source_id(path: Path) -> str:
+    """
+    Identifier of an input file recorded in the sums file (with the times it provided)
+
+    The resolved path is used, as files from different run directories
+    can have the same name.
+    """
+    return str(path.resolve())
+
+
+def output_filename(domain: str, key: str, period: str) -> str:
+    """
+    Filename of the aggregate for a given domain and period
+    """
+    return f"WRFOUT_{domain}_{key}_{period}.nc"
+
+
+def is_aggregate(path: Path) -> bool:
+    """
+    Check if a file is an aggregate (or the running sums of one)
+    """
+    return path.name.endswith(SUMS_SUFFIX) or any(
+        path.name.endswith(f"_{period}.nc") for period in PERIOD_FORMATS
+    )
+
+
+def find_files(paths: list[str | Path], pattern: str) -> list[Path]:
+    """
+    Expand a list of files and directories into a sorted list of files
+
+    Directories are searched recursively for files matching `pattern`.
+    Existing aggregates found in the directories are ignored.
+    """
+    files = set()
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.update(
+                p for p in path.rglob(pattern) if p.is_file() and not is_aggregate(p)
+            )
+        else:
+            files.add(path)
+    return sorted(files)
+
+
+def group_frames(
+    files: list[Path], period: str
+) -> dict[tuple[str, str], dict[str, tuple[Path, int]]]:
+    """
+    Find the frames of each time within each period
+
+    Where several files have a frame at the same time, the last of them is used.
+
+    Returns
+    -------
+        For each (domain, period) pair, the file and frame index of each time
+    """
+    groups = {}
+    for path in files:
+        with netCDF4.Dataset(path) as nc:
+            times = read_times(nc)
+        for iframe, time_str in enumerate(times):
+            key = (domain_name(path), period_key(time_str, period))
+            groups.setdefault(key, {})[time_str] = (path, iframe)
+    return groups
+
+
+def frames_by_file(frames: dict[str, tuple[Path, int]]) -> dict[Path, list[int]]:
+    """
+    Indices of the frames to read from each file, in order
+    """
+    by_file = {}
+    for path, iframe in frames.values():
+        by_file.setdefault(path, []).append(iframe)
+    return {path: sorted(indices) for path, indices in by_file.items()}
+
+
+def read_sources(sums_path: Path) -> dict[str, str]:
+    """
+    Identifier of the file each time of a partial aggregate was read from
+    """
+    with netCDF4.Dataset(sums_path) as nc:
+        lines = nc.getncattr("AGGREGATE_SOURCES").split("\n")
+    return dict(line.split(" ", 1) for line in lines if line)
+
+
+def locate_frames(sources: dict[str, str]) -> dict[str, tuple[Path, int]]:
+    """
+    Find the frames recorded in a partial aggregate (see `read_sources`)
+
+    Raises
+    ------
+    FileNotFoundError
+        If a file, or the frame of a time within it, can no longer be found
+    """
+    frames = {}
+    for source in sorted(set(sources.values())):
+        path = Path(source)
+        if not path.exists():
+            raise FileNotFoundError(f"{source} was aggregated but no longer exists")
+        with netCDF4.Dataset(path) as nc:
+            times = read_times(nc)
+        for iframe, time_str in enumerate(times):
+            if sources.get(time_str) == source:
+                frames[time_str] = (path, iframe)
+    missing = sorted(set(sources) - set(frames))
+    if missing:
+        raise FileNotFoundError(f"Frames for {', '.join(missing)} could not be found")
+    return frames
+
+
+def _sum_frames(
+    var: netCDF4.Variable, frames: list[int], max_chunk_bytes: int | None
+) -> tuple[numpy.ndarray, numpy.ndarray | None]:
+    """
+    Sum the selected frames of a variable in double precision
+
+    At most `max_chunk_bytes` are read at once.
+    Masked values are left out of the sums, as in `time_mean`.
+
+    Returns
+    -------
+        The sums, and the number of valid values at each point
+        (None if none of the values were masked)
+    """
+    if var.dimensions[0] != "Time":
+        raise RuntimeError(f"Time should be the first dimension of {var.name}")
+    frame_bytes = var.dtype.itemsize * int(numpy.prod(var.shape[1:]))
+    if max_chunk_bytes is None:
+        frames_per_chunk = len(frames)
+    else:
+        frames_per_chunk = max(1, max_chunk_bytes // max(frame_bytes, 1))
+
+    total = numpy.zeros((1,) + var.shape[1:], dtype="f8")
+    count = None
+    for start in range(0, len(frames), frames_per_chunk):
+        selected = frames[start : start + frames_per_chunk]
+        nselected = len(selected)
+        if selected[-1] - selected[0] == nselected - 1:
+            selected = slice(selected[0], selected[-1] + 1)
+        slab = var[selected]
+        if numpy.ma.is_masked(slab):
+            ## only track the number of valid values once masked values show up
+            if count is None:
+                count = numpy.full(total.shape, start, dtype="i4")
+            count += (~numpy.ma.getmaskarray(slab)).sum(axis=0, keepdims=True)
+            data = numpy.ma.filled(slab, 0)
+        else:
+            if count is not None:
+                count += nselected
+            data = numpy.ma.getdata(slab)
+        total += data.sum(axis=0, keepdims=True, dtype="f8")
+    return total, count
+
+
+def _update_sums(
+    sums_path: Path,
+    frames: dict[str, tuple[Path, int]],
+    time_str: str,
+    max_chunk_bytes: int | None,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+):
+    """
+    Fold the frames of a batch of files into the running sums of a period
+
+    A new sums file is written alongside the existing one and then renamed over it,
+    so an interrupted update leaves the previous partial aggregate intact.
+    """
+    indices = frames_by_file(frames)
+    sources = {path: netCDF4.Dataset(path) for path in indices}
+    previous = netCDF4.Dataset(sums_path) if sums_path.exists() else None
+    template = previous if previous is not None else next(iter(sources.values()))
+
+    tmp_path = sums_path.with_name(sums_path.name + ".tmp")
+    trg = netCDF4.Dataset(tmp_path, mode="w")
+    try:
+        for name, dim in template.dimensions.items():
+            trg.createDimension(name, 1 if name == "Time" else len(dim))
+        ##
+        attributes = {a: template.getncattr(a) for a in template.ncattrs()}
+        nframes = int(attributes.pop("AGGREGATE_NFRAMES", 0))
+        folded = [s for s in attributes.pop("AGGREGATE_SOURCES", "").split("\n") if s]
+        attributes["AGGREGATE_NFRAMES"] = nframes + len(frames)
+        attributes["AGGREGATE_SOURCES"] = "\n".join(
+            folded
+            + [
+                f"{time} {source_id(path)}"
+                for time, (path, _) in sorted(frames.items())
+            ]
+        )
+        trg.setncatts(attributes)
+        ##
+        names = [name for name in template.variables if not name.endswith(COUNT_SUFFIX)]
+        for name in select_variables(names, include, exclude):
+            var = template.variables[name]
+            var_attributes = {
+                a: var.getncattr(a) for a in var.ncattrs() if a != "_FillValue"
+            }
+            if name == "Times":
+                trg.createVariable(name, "S1", var.dimensions)
+                trg.variables[name].setncatts(var_attributes)
+                trg.variables[name][:] = numpy.array(
+                    [c for c in time_str], dtype="|S1"
+                ).reshape((1, len(time_str)))
+            elif "Time" in var.dimensions:
+                ## running sums are kept in double precision
+                var_attributes.setdefault("aggregate_dtype", var.dtype.str[1:])
+                if "_FillValue" in var.ncattrs() and previous is None:
+                    var_attributes["aggregate_fill_value"] = var.getncattr("_FillValue")
+                trg.createVariable(name, "f8", var.dimensions)
+                trg.variables[name].setncatts(var_attributes)
+                total = numpy.zeros((1,) + var.shape[1:], dtype="f8")
+                count = None
+                if previous is not None:
+                    total += numpy.ma.getdata(previous.variables[name][:])
+                    if name + COUNT_SUFFIX in previous.variables:
+                        count = numpy.ma.getdata(
+                            previous.variables[name + COUNT_SUFFIX][:]
+                        ).astype("i4")
+                ## the number of valid values at each point is only kept
+                ## once masked values show up
+                nsummed = nframes
+                for path, frame_indices in indices.items():
+                    sums, valid = _sum_frames(
+                        sources[path].variables[name], frame_indices, max_chunk_bytes
+                    )
+                    total += sums
+                    if valid is not None and count is None:
+                        count = numpy.full(total.shape, nsummed, dtype="i4")
+                    if count is not None:
+                        count += len(frame_indices) if valid is None else valid
+                    nsummed += len(frame_indices)
+                trg.variables[name][:] = total
+                if count is not None:
+                    trg.createVariable(name + COUNT_SUFFIX, "i4", var.dimensions)
+                    trg.variables[name + COUNT_SUFFIX][:] = count
+            else:
+                ## static fields are copied once, from the first file of the period
+                fill_value = (
+                    var.getncattr("_FillValue")
+                    if "_FillValue" in var.ncattrs()
+                    else None
+                )
+                trg.createVariable(
+                    name, var.dtype.str[1:], var.dimensions, fill_value=fill_value
+                )
+                trg.variables[name].setncatts(var_attributes)
+                trg.variables[name][:] = var[:]
+    finally:
+        trg.close()
+        if previous is not None:
+            previous.close()
+        for nc in sources.values():
+            nc.close()
+    os.replace(tmp_path, sums_path)
+
+
+def _write_mean(sums_path: Path, out_path: Path, encoding: NetCDFEncoding):
+    """
+    Write the period mean from the running sums of a period
+    """
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    with netCDF4.Dataset(sums_path) as src, netCDF4.Dataset(tmp_path, "w") as trg:
+        dimensions = {name: len(dim) for name, dim in src.dimensions.items()}
+        for name, dimlen in dimensions.items():
+            trg.createDimension(name, dimlen)
+        nframes = int(src.getncattr("AGGREGATE_NFRAMES"))
+        trg.setncatts(
+            {a: src.getncattr(a) for a in src.ncattrs() if a != "AGGREGATE_SOURCES"}
+        )
+        for name, var in src.variables.items():
+            if name.endswith(COUNT_SUFFIX):
+                continue
+            var_attributes = {
+                a: var.getncattr(a) for a in var.ncattrs() if a != "_FillValue"
+            }
+            dtype = var_attributes.pop("aggregate_dtype", var.dtype.str[1:])
+            fill_value = var_attributes.pop(
+                "aggregate_fill_value",
+                var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None,
+            )
+            trg.createVariable(
+                name,
+                dtype,
+                var.dimensions,
+                fill_value=fill_value,
+                **encoding.variable_kwargs(
+                    dtype, var.dimensions, [dimensions[d] for d in var.dimensions]
+                ),
+            )
+            trg.variables[name].setncatts(var_attributes)
+            if name + COUNT_SUFFIX in src.variables:
+                count = numpy.ma.getdata(src.variables[name + COUNT_SUFFIX][:])
+                trg.variables[name][:] = (
+                    numpy.ma.masked_array(numpy.ma.getdata(var[:]), mask=(count == 0))
+                    / count
+                )
+            elif "Time" in var.dimensions and name != "Times":
+                trg.variables[name][:] = numpy.ma.getdata(var[:]) / nframes
+            else:
+                trg.variables[name][:] = var[:]
+    os.replace(tmp_path, out_path)
+
+
+def aggregate_fields(
+    files: list[str | Path],
+    output_dir: str | Path,
+    period: str = "daily",
+    incremental: bool = False,
+    max_chunk_bytes: int | None = DEFAULT_MAX_CHUNK_BYTES,
+    max_open_files: int = 32,
+    encoding: NetCDFEncoding | None = None,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> list[Path]:
+    """
+    Aggregate WRF output files into daily or monthly means
+
+    Each period produces a mean file (`WRFOUT_<domain>_<period key>_<period>.nc`)
+    and a file with the running sums used to compute it
+    (with the suffix `.sums.nc`).
+    The sums are accumulated in double precision and the means are written
+    with the data type of the inputs.
+
+    Parameters
+    ----------
+    files
+        WRF output files to aggregate.
+        These may be raw `wrfout` files or averaged `WRFOUT` files.
+    output_dir
+        Directory where the aggregates are written
+    period
+        Aggregation period, one of "daily" or "monthly"
+    incremental
+        Fold the files into any existing partial aggregates.
+        Frames which have already been folded in from the same file are skipped.
+        A frame from another file (such as a rerun) replaces the one already folded in
+        for its time, in which case the period is rebuilt from the files it was read from.
+        If False, existing aggregates for the periods are replaced.
+    max_chunk_bytes
+        Maximum number of bytes to read from a variable at once
+    max_open_files
+        Maximum number of input files that are open at once
+    encoding
+        Compression, chunking and quantization of the output files
+    include
+        Glob patterns of the variables to aggregate. If None, all variables are used.
+    exclude
+        Glob patterns of the variables to skip
+
+    Returns
+    -------
+        Paths of the aggregates that were written
+    """
+    if period not in PERIOD_FORMATS:
+        raise ValueError(f"period must be one of {', '.join(PERIOD_FORMATS)}")
+    if encoding is None:
+        encoding = NetCDFEncoding()
+    output_dir = Path(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    written = []
+    groups = group_frames([Path(f) for f in files], period)
+    for (domain, key), frames in sorted(groups.items()):
+        out_path = output_dir / output_filename(domain, key, period)
+        sums_path = out_path.with_name(out_path.name[: -len(".nc")] + SUMS_SUFFIX)
+
+        if sums_path.exists():
+            if incremental:
+                folded = read_sources(sums_path)
+                frames = {
+                    time: (path, iframe)
+                    for time, (path, iframe) in frames.items()
+                    if folded.get(time) != source_id(path)
+                }
+                if any(time in folded for time in frames):
+                    ## the sums can't be updated in place, so the period is rebuilt
+                    logger.info("Replacing frames of %s", out_path.name)
+                    frames = {**locate_frames(folded), **frames}
+                    os.remove(sums_path)
+            else:
+                os.remove(sums_path)
+        if not frames:
+            logger.debug("No new files for %s", out_path)
+            continue
+
+        paths = list(frames_by_file(frames))
+        logger.info("Aggregating %d files into %s", len(paths), out_path.name)
+        for start in range(0, len(paths), max_open_files):
+            batch_paths = set(paths[start : start + max_open_files])
+            batch = {
+                time: (path, iframe)
+                for time, (path, iframe) in frames.items()
+                if path in batch_paths
+            }
+            _update_sums(
+                sums_path,
+                batch,
+                period_start(key, period),
+                max_chunk_bytes,
+                include=include,
+                exclude=exclude,
+            )
+        _write_mean(sums_path, out_path, encoding)
+        written.append(out_path)
+
+    return written
@@ -1,10 +1,239 @@
+from fnmatch import fnmatchcase
 from pathlib import Path
 
 import netCDF4
 import numpy
+from joblib import Parallel, delayed
 
+from setup_runs.netcdf import NetCDFEncoding, parse_chunk_sizes
+
+DEFAULT_MAX_CHUNK_BYTES = 256 * 1024**2
+"""
+Default upper bound on the amount of data read from a variable at once (256 MiB)
+
+Variables larger than this are averaged slab by slab along the `Time` dimension.
+"""
+
+
+def _accumulator_dtype(dtype: numpy.dtype) -> numpy.dtype:
+    """
+    Data type used by `numpy.mean` to accumulate values of type `dtype`
+    """
+    if issubclass(dtype.type, (numpy.integer, numpy.bool_)):
+        return numpy.dtype("f8")
+    if issubclass(dtype.type, numpy.float16):
+        return numpy.dtype("f4")
+    return dtype
+
+
+def time_mean(
+    var: netCDF4.Variable, iTime: int, max_chunk_bytes: int | None = None
+) -> numpy.ndarray:
+    """
+    Average a variable over its time axis, reading at most `max_chunk_bytes` at once
+
+    The frames are accumulated one at a time in the same order and precision
+    as `numpy.mean`, so the result is identical to
+    `var[:].mean(axis=iTime, keepdims=True)`.
+
+    Parameters
+    ----------
+    var
+        Variable to average
+    iTime
+        Index of the `Time` dimension of the variable
+    max_chunk_bytes
+        Maximum number of bytes to read in a single slab.
+        At least one frame is always read at once.
+        If None, the entire variable is read in one go.
+
+    Returns
+    -------
+        Time-averaged values with a time dimension of length one
+    """
+    shape = var.shape
+    ntimes = shape[iTime]
+    frame_bytes = var.dtype.itemsize * int(numpy.prod(shape)) // max(ntimes, 1)
+    if max_chunk_bytes is None:
+        frames_per_chunk = ntimes
+    else:
+        frames_per_chunk = max(1, max_chunk_bytes // max(frame_bytes, 1))
+
+    ## small variables are read in one go
+    if ntimes <= frames_per_chunk or len(shape) == 1:
+        return var[:].mean(axis=iTime, keepdims=True)
+
+    total = None
+    count = None
+    nframes = 0
+    for start in range(0, ntimes, frames_per_chunk):
+        index = [slice(None)] * len(shape)
+        index[iTime] = slice(start, min(start + frames_per_chunk, ntimes))
+        slab = var[tuple(index)]
+        for frame in numpy.moveaxis(slab, iTime, 0):
+            if numpy.ma.is_masked(frame):
+                ## only track the number of valid values once masked values show up
+                if count is None:
+                    count = numpy.full(frame.shape, nframes, dtype=numpy.intp)
+                count += ~numpy.ma.getmaskarray(frame)
+                data = numpy.ma.filled(frame, 0)
+            else:
+                if count is not None:
+                    count += 1
+                data = numpy.ma.getdata(frame)
+            ##
+            if total is None:
+                total = data.astype(_accumulator_dtype(var.dtype))
+            else:
+                numpy.add(total, data, out=total, casting="unsafe")
+            nframes += 1
+
+    if count is None:
+        mean = numpy.true_divide(total, nframes, out=total, casting="unsafe")
+    else:
+        mean = numpy.ma.masked_array(total, mask=(count == 0)) * 1.0 / count
+    if issubclass(var.dtype.type, numpy.float16):
+        mean = mean.astype(var.dtype)
+
+    return numpy.expand_dims(mean, iTime)
+
+
+def select_variables(
+    names: list[str],
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+) -> list[str]:
+    """
+    Select variables using lists of glob patterns
+
+    The `Times` variable is always selected.
+
+    Parameters
+    ----------
+    names
+        Names of the available variables
+    include
+        Patterns of the variables to keep (e.g. ["T2", "U*"]).
+        If None or empty, all variables are kept.
+    exclude
+        Patterns of the variables to drop.
+        These take precedence over `include`.
+
+    Returns
+    -------
+        The selected variable names, in their original order
+    """
+    selected = []
+    for name in names:
+        if name != "Times":
+            if include and not any(fnmatchcase(name, p) for p in include):
+                continue
+            if exclude and any(fnmatchcase(name, p) for p in exclude):
+                continue
+        selected.append(name)
+    return selected
+
+
+def parse_patterns(value: str | None) -> list[str]:
+    """
+    Split a comma-separated list of glob patterns
+    """
+    if not value:
+        return []
+    return [p.strip() for p in value.split(",") if p.strip()]
+
+
+def copy_variable(
+    src: netCDF4.Variable, trg: netCDF4.Variable, max_chunk_bytes: int | None = None
+):
+    """
+    Copy the values of a variable, reading at most `max_chunk_bytes` at once
+
+    Slabs are read along the first dimension of the variable.
+    """
+    if len(src.shape) == 0 or max_chunk_bytes is None:
+        trg[:] = src[:]
+        return
+    row_bytes = src.dtype.itemsize * int(numpy.prod(src.shape[1:]))
+    rows_per_chunk = max(1, max_chunk_bytes // max(row_bytes, 1))
+    for start in range(0, src.shape[0], rows_per_chunk):
+        trg[start : start + rows_per_chunk] = src[start : start + rows_per_chunk]
+
+
+def _variable_average(
+    var: netCDF4.Variable, max_chunk_bytes: int | None
+) -> numpy.ndarray:
+    """
+    Average a time-varying variable over time
+    """
+    iTime = var.dimensions.index("Time")
+    return time_mean(var, iTime, max_chunk_bytes=max_chunk_bytes)
+
+
+def _average_variable_from_file(
+    inFile: str | Path, name: str, max_chunk_bytes: int | None
+) -> numpy.ndarray:
+    """
+    Average a single variable, opening a separate handle on the input file
+
+    Used by the worker pool so that each worker reads its own variables.
+    """
+    with netCDF4.Dataset(inFile) as src:
+        return _variable_average(src.variables[name], max_chunk_bytes)
+
+
+def average_fields(
+    inFile: str | Path,
+    outFile: str | Path,
+    outputTime: str,
+    max_chunk_bytes: int | None = DEFAULT_MAX_CHUNK_BYTES,
+    n_workers: int = 1,
+    encoding: NetCDFEncoding | None = None,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+):
+    """
+    Average all the time-varying fields of a WRF output file into a single time step
+
+    Each variable is read, averaged and written before moving onto the next one,
+    so the peak memory usage is bounded by `max_chunk_bytes`
+    (plus a single averaged field) rather than by the size of the file.
+
+    If `n_workers` is greater than one, the variables are split across a pool of
+    worker processes which each read and reduce their own variables
+    (processes rather than threads, as the netCDF/HDF5 libraries aren't thread-safe).
+    The averages are written by a single writer in the original variable order,
+    so the layout of the output file does not depend on the number of workers.
+    Each worker reads up to `max_chunk_bytes` at once.
+
+    Static variables (without a `Time` dimension) are copied directly to the output.
+    Variables which are not selected by `include`/`exclude` are neither read
+    nor written.
+
+    Parameters
+    ----------
+    inFile
+        WRF output file to average
+    outFile
+        Path of the averaged output file
+    outputTime
+        Time-string to write in the `Times` variable (format %Y-%m-%d_%H:%M:%S)
+    max_chunk_bytes
+        Maximum number of bytes to read from a variable at once.
+        If None, each variable is read in its entirety.
+    n_workers
+        Number of workers used to average the variables
+    encoding
+        Compression, chunking and quantization of the output variables.
+        Defaults to deflating the single precision variables.
+    include
+        Glob patterns of the variables to write. If None, all variables are written.
+    exclude
+        Glob patterns of the variables to skip
+    """
+    if encoding is None:
+        encoding = NetCDFEncoding()
 
-def average_fields(inFile: str | Path, outFile: str | Path, outputTime: str):
     dimensions = {}
     variables = {}
     attributes = {}
@@ -17,8 +246,9 @@ def average_fields(inFile: str | Path, outFile: str | Path, outputTime: str):
         dimensions[name] = dimlen
     # Get the global attributes
     attributes["global"] = {a: src.getncattr(a) for a in src.ncattrs()}
-    # Get the metadata about the variables
-    for name, var in src.variables.items():
+    # Get the metadata about the selected variables
+    for name in select_variables(list(src.variables), include, exclude):
+        var = src.variables[name]
         if "_FillValue" in var.ncattrs():
             fill_value = var.getncattr("_FillValue")
         else:
@@ -40,29 +270,7 @@ def average_fields(inFile: str | Path, outFile: str | Path, outputTime: str):
     variables["Times"]["dimlens"][0] = 1
     ## average to a _single_ time-step
     dimensions["Time"] = 1
-    average = {}
-    for name in variables.keys():
-        if name != "Times":
-            average[name] = numpy.zeros(variables[name]["dimlens"])
-    for name in variables.keys():
-        if name != "Times":
-            iTime = [
-                idim
-                for idim, dim in enumerate(variables[name]["dimensions"])
-                if dim == "Time"
-            ]
-            if len(iTime) == 0:
-                average[name] = src.variables[name][:]
-            elif len(iTime) == 1:
-                iTime = iTime[0]
-                average[name] = src.variables[name][:].mean(axis=iTime, keepdims=True)
-            else:
-                raise RuntimeError(
-                    "Multiple matches for the Time dimension for variable {}".format(
-                        name
-                    )
-                )
-    src.close()
+
     ## create an output file
     trg = netCDF4.Dataset(outFile, mode="w")
     for dim in dimensions.keys():
@@ -76,19 +284,49 @@ def average_fields(inFile: str | Path, outFile: str | Path, outputTime: str):
             name,
             variables[name]["dtype"].str[1:],
             variables[name]["dimensions"],
-            zlib=(variables[name]["dtype"].str[1:] == "f4"),
             fill_value=variables[name]["fill_value"],
+            **encoding.variable_kwargs(
+                variables[name]["dtype"],
+                variables[name]["dimensions"],
+                [dimensions[dim] for dim in variables[name]["dimensions"]],
+            ),
         )
         trg.variables[name].setncatts(attributes[name])
-        ## write out the data
-        if name == "Times":
-            trg.variables[name][:] = numpy.array(
-                [c for c in outputTime], dtype="|S1"
-            ).reshape(variables[name]["dimlens"])
-        else:
-            trg.variables[name][:] = average[name]
+    ##
+    trg.variables["Times"][:] = numpy.array(
+        [c for c in outputTime], dtype="|S1"
+    ).reshape(variables["Times"]["dimlens"])
+    ## copy the static variables
+    names = []
+    for name in variables.keys():
+        nTime = variables[name]["dimensions"].count("Time")
+        if nTime > 1:
+            raise RuntimeError(
+                "Multiple matches for the Time dimension for variable {}".format(name)
+            )
+        elif nTime == 0:
+            copy_variable(
+                src.variables[name],
+                trg.variables[name],
+                max_chunk_bytes=max_chunk_bytes,
+            )
+        elif name != "Times":
+            names.append(name)
+    ## average the time-varying variables and write out the data
+    if n_workers > 1:
+        averages = Parallel(n_jobs=n_workers, backend="loky", return_as="generator")(
+            delayed(_average_variable_from_file)(inFile, name, max_chunk_bytes)
+            for name in names
+        )
+    else:
+        averages = (
+            _variable_average(src.variables[name], max_chunk_bytes) for name in names
+        )
+    for name, average in zip(names, averages):
+        trg.variables[name][:] = average
     ##
     trg.close()
+    src.close()
 
 
 if __name__ == "__main__":
@@ -100,10 +338,76 @@ if __name__ == "__main__":
     parser.add_argument(
         "-t", "--time", help="Output time-string (format %Y-%m-%d_%H:%M:%S)"
     )
+    parser.add_argument(
+        "--max-chunk-bytes",
+        help="Maximum number of bytes to read from a variable at once",
+        type=int,
+        default=DEFAULT_MAX_CHUNK_BYTES,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of workers used to average the variables",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--complevel",
+        help="Deflate level of the output variables (0 disables compression)",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--no-shuffle",
+        help="Don't apply the shuffle filter before compressing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--compress-all",
+        help="Compress all variables rather than only single precision floats",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--chunk-sizes",
+        help="Chunk lengths of the output, e.g. Time=1,bottom_top=1",
+    )
+    parser.add_argument(
+        "--include",
+        help="Comma-separated glob patterns of the variables to write",
+    )
+    parser.add_argument(
+        "--exclude",
+        help="Comma-separated glob patterns of the variables to skip",
+    )
+    parser.add_argument(
+        "--least-significant-digit",
+        help="Quantize floats, retaining this decimal digit",
+        type=int,
+    )
+    parser.add_argument(
+        "--significant-digits",
+        help="Quantize floats to this number of significant digits",
+        type=int,
+    )
 
     args = parser.parse_args()
     inFile = args.input
     outFile = args.output
     outputTime = args.time
 
-    average_fields(inFile, outFile, outputTime)
+    average_fields(
+        inFile,
+        outFile,
+        outputTime,
+        max_chunk_bytes=args.max_chunk_bytes,
+        n_workers=args.workers,
+        encoding=NetCDFEncoding(
+            complevel=args.complevel,
+            shuffle=not args.no_shuffle,
+            compressed_dtypes=None if args.compress_all else ("f4",),
+            chunk_sizes=parse_chunk_sizes(args.chunk_sizes),
+            least_significant_digit=args.least_significant_digit,
+            significant_digits=args.significant_digits,
+        ),
+        include=parse_patterns(args.include),
+        exclude=parse_patterns(args.exclude),
+    )
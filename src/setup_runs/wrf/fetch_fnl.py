@@ -9,18 +9,42 @@
 # rpconroy@ucar.edu (Riley Conroy) for further assistance.
 #################################################################
 
+import asyncio
+import collections
+import hashlib
 import os
+import threading
+import time
+import typing
+import urllib.parse
+from pathlib import Path
 
 import requests
 import datetime
 import pytz
 
-from joblib import Parallel, delayed
 from tqdm import tqdm
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
 
-N_JOBS = 8
+from setup_runs.utils import file_lock
+from setup_runs.wrf.integrity import InvalidGribFile, Manifest, hash_file
+
+if typing.TYPE_CHECKING:
+    from setup_runs.wrf.fnl_cache import AnalysisCache
+
+DEFAULT_CONCURRENCY = 8
+"""Number of files downloaded at once from each host"""
+
+DATASET_ID = "ds083.3"
+"""Identifier of the dataset used to key the cached files"""
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+"""Number of bytes read from the connection at a time"""
+PART_SUFFIX = ".part"
+"""Suffix of files which are still being downloaded"""
+MAX_RESUME_ATTEMPTS = 5
+"""Number of times an interrupted download is resumed before giving up"""
 
 DATASET_URL = "https://tds.gdex.ucar.edu/thredds/fileServer/files/g/d083003/" # THREDDS
 # Backup data source
@@ -29,12 +53,64 @@ DATASET_URL = "https://tds.gdex.ucar.edu/thredds/fileServer/files/g/d083003/" #
 FNL_START_DATE = pytz.UTC.localize(datetime.datetime(2015, 7, 8, 0, 0, 0))
 
 
-def create_session() -> requests.Session:
+class BandwidthLimit:
+    """
+    Limit on the total rate data is read from the connections of one or more sessions
+
+    Each read reserves the time needed to transfer it at the limiting rate
+    and waits until the reservations before it have passed,
+    so concurrent downloads share the bandwidth.
+
+    Args:
+        bytes_per_second:
+            Maximum average rate of the downloads
+    """
+
+    def __init__(self, bytes_per_second: float):
+        if bytes_per_second <= 0:
+            raise ValueError("bytes_per_second should be positive")
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def throttle(self, nbytes: int):
+        """Wait until `nbytes` more bytes can be read without exceeding the limit"""
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + nbytes / self.bytes_per_second
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def response_hook(self, r: requests.Response, *args, **kwargs):
+        """Request hook throttling the reads of the response body"""
+        read = r.raw.read
+
+        def throttled_read(*read_args, **read_kwargs):
+            data = read(*read_args, **read_kwargs)
+            self.throttle(len(data))
+            return data
+
+        r.raw.read = throttled_read
+        return r
+
+
+def create_session(
+    pool_size: int = DEFAULT_CONCURRENCY, bandwidth: BandwidthLimit | None = None
+) -> requests.Session:
     """
     Create a requests session
 
     This session will retry failed downloads up to 5 times
 
+    Args:
+        pool_size:
+            Number of connections kept open to each host.
+            Should be at least the number of concurrent downloads
+            so that connections are reused rather than reopened.
+        bandwidth:
+            Limit on the rate the responses are read at, which may be shared with other sessions
+
     Returns:
         New session with a backoff retry strategy
     """
@@ -51,20 +127,65 @@ def create_session() -> requests.Session:
         ],  # HTTP status codes to retry on
     )
     # Create an HTTP adapter with the retry strategy and mount it to session
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=max(pool_size, 10))
 
     # Create a new session object
     session = requests.Session()
     session.mount("http://", adapter)
     session.mount("https://", adapter)
+    if bandwidth is not None:
+        session.hooks["response"].append(bandwidth.response_hook)
 
     return session
 
 
-def download_file(session: requests.Session, target_dir: str, url: str) -> str:
+def _content_range_total(r: requests.Response) -> int | None:
+    """
+    Total size of the file from the Content-Range header of a partial response
+    """
+    content_range = r.headers.get("Content-Range", "")
+    total = content_range.rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+def complete_download(part_filename: str, filename: str, sha256: str) -> str:
+    """
+    Move a completed download into place and record it in the directory's manifest
+
+    Raises:
+        RuntimeError: If the file is a corrupt GRIB2 file
+    """
+    os.replace(part_filename, filename)
+    manifest = Manifest(os.path.dirname(filename))
+    try:
+        manifest.record(filename, sha256)
+    except InvalidGribFile as e:
+        os.remove(filename)
+        manifest.remove(filename)
+        raise RuntimeError(f"Downloaded file {filename} is corrupt") from e
+    return filename
+
+
+def download_file(
+    session: requests.Session,
+    target_dir: str,
+    url: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_attempts: int = MAX_RESUME_ATTEMPTS,
+) -> str:
     """
     Download a file from a URL
 
+    The file is downloaded to a `.part` file which is renamed once complete.
+    If the connection drops, the download is resumed from the end of the `.part` file
+    using a HTTP Range request.
+    The `.part` file is kept if the download fails,
+    so a later attempt will resume where this one left off.
+
+    The file is hashed as it is downloaded and recorded in the manifest
+    of the target directory (see `setup_runs.wrf.integrity`),
+    after checking the structure of GRIB2 files.
+
     Args:
         session:
             Authenticated session
@@ -72,6 +193,11 @@ def download_file(session: requests.Session, target_dir: str, url: str) -> str:
             Directory to save the downloaded file
         url:
             URL of the file to download
+        chunk_size:
+            Number of bytes to read from the connection at a time
+        max_attempts:
+            Number of times to try (and resume) the download
+            before giving up
 
     Raises:
         RuntimeError: If the download fails
@@ -80,22 +206,280 @@ def download_file(session: requests.Session, target_dir: str, url: str) -> str:
         Path to the downloaded file
     """
     filename = os.path.join(target_dir, os.path.basename(url))
+    part_filename = filename + PART_SUFFIX
+
+    error = None
+    # checksum of the part file, updated as it is written
+    sha256, hashed_bytes = hashlib.sha256(), 0
+    for attempt in range(max_attempts):
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        if offset != hashed_bytes:
+            # resuming a part file left by an earlier run
+            sha256 = hash_file(part_filename)
+            hashed_bytes = offset
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with session.get(url, stream=True, headers=headers) as r:
+                if offset and r.status_code == 416:
+                    # Nothing left to download if the part file is already complete
+                    if _content_range_total(r) == offset:
+                        return complete_download(
+                            part_filename, filename, sha256.hexdigest()
+                        )
+                    os.remove(part_filename)
+                    continue
+                r.raise_for_status()
+
+                if offset and r.status_code == 206:
+                    expected_size = _content_range_total(r)
+                    mode = "ab"
+                else:
+                    # The server sent the whole file
+                    content_length = r.headers.get("Content-Length")
+                    expected_size = int(content_length) if content_length else None
+                    mode = "wb"
+                    sha256, hashed_bytes = hashlib.sha256(), 0
+
+                with open(part_filename, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        hashed_bytes += len(chunk)
+        except requests.exceptions.HTTPError as e:
+            raise RuntimeError(f"Error downloading {url}") from e
+        except requests.exceptions.RequestException as e:
+            error = e
+            print(f"Download of {url} interrupted (attempt {attempt + 1}), resuming")
+            continue
+
+        size = os.path.getsize(part_filename)
+        if expected_size is not None and size != expected_size:
+            error = RuntimeError(f"Received {size} of {expected_size} bytes")
+            continue
+        return complete_download(part_filename, filename, sha256.hexdigest())
+
+    raise RuntimeError(f"Error downloading {url}") from error
+
+
+def _file_size(path: str) -> int:
+    """Size of a file, or 0 if it has already been moved (e.g. into a cache)"""
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+async def download_files_async(
+    session: requests.Session,
+    downloads: list[tuple[str, str]],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_per_host: int = DEFAULT_CONCURRENCY,
+    download: typing.Callable[..., str] = download_file,
+) -> list[str]:
+    """
+    Download files concurrently, sharing the connection pool of a single session
+
+    Each download runs in a thread so the session's pooled connections are reused
+    and no process is spawned per file.
+    No more than `max_per_host` files are downloaded from a host at once.
+    The aggregate throughput is reported once all the downloads are complete.
+
+    If a download fails, the remaining downloads are cancelled
+    (downloads already in progress run to completion in their threads).
+
+    Args:
+        session:
+            Session shared by all the downloads
+        downloads:
+            Pairs of URL and the directory the file is saved in
+        chunk_size:
+            Number of bytes to read from the connection at a time
+        max_per_host:
+            Maximum number of concurrent downloads from each host
+        download:
+            Function used to download each file, with the same signature as `download_file`
+
+    Raises:
+        RuntimeError: If any of the downloads fail
+
+    Returns:
+        Paths to the downloaded files, in the same order as `downloads`
+    """
+    semaphores = collections.defaultdict(lambda: asyncio.Semaphore(max_per_host))
+    start = time.monotonic()
 
+    async def download_from_host(url: str, target_dir: str) -> str:
+        async with semaphores[urllib.parse.urlsplit(url).netloc]:
+            return await asyncio.to_thread(
+                download, session, target_dir, url, chunk_size
+            )
+
+    tasks = [asyncio.ensure_future(download_from_host(url, d)) for url, d in downloads]
     try:
-        with session.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(filename, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            return filename
-    except requests.exceptions.RequestException as e:
-        if os.path.exists(filename):
-            os.remove(filename)
-        raise RuntimeError(f"Error downloading {url}") from e
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            await task
+    finally:
+        for task in tasks:
+            task.cancel()
+    downloaded_files = [task.result() for task in tasks]
+
+    elapsed = time.monotonic() - start
+    total_bytes = sum(_file_size(f) for f in downloaded_files)
+    if downloaded_files:
+        print(
+            f"Downloaded {len(downloaded_files)} files ({total_bytes / 1024**2:.1f} MiB) "
+            f"in {elapsed:.1f} s ({total_bytes / 1024**2 / max(elapsed, 1e-6):.1f} MiB/s)"
+        )
+    return downloaded_files
+
+
+def fnl_file_paths(download_dts: list[datetime.datetime]) -> list[str]:
+    """
+    Paths on the server of the analyses at a set of times
+    """
+    file_list = []
+    for analysis_time in download_dts:
+        assert (
+            (analysis_time.hour % 6) == 0
+            and analysis_time.minute == 0
+            and analysis_time.second == 0
+        ), "Analysis time should be staggered at 00Z, 06Z, 12Z, 18Z intervals"
+        assert (
+            analysis_time > FNL_START_DATE
+        ), "Analysis times should not be before 2015-07-08"
+        file_path = analysis_time.strftime("%Y/%Y%m/gdas1.fnl0p25.%Y%m%d%H.f00.grib2")
+        file_list.append(file_path)
+    return file_list
+
+
+def fnl_downloader(subset_vtable: str | None = None) -> tuple[typing.Callable, str]:
+    """
+    Function used to download each file, and the prefix of the files in a cache
+
+    Subsets are cached apart from the whole files (and each other).
+    """
+    if subset_vtable is None:
+        return download_file, DATASET_ID
+
+    from setup_runs.wrf.grib_inventory import subset_downloader
+
+    download, subset_name = subset_downloader(subset_vtable)
+    return download, f"{DATASET_ID}/{subset_name}"
+
+
+def _download_into_staging(
+    session: requests.Session,
+    cache: "AnalysisCache",
+    cache_keys: dict[str, str],
+    download: typing.Callable,
+    chunk_size: int,
+    concurrency: int,
+):
+    """
+    Download the files missing from a cache into its staging area
+
+    The cache is only locked while looking up the missing files,
+    so other jobs can use the cache while the files are downloaded.
+    Each file has its own lock in the staging area, so a job which needs a file
+    another job is downloading waits for that download rather than repeating it.
+    The downloaded files are then moved into the cache with `AnalysisCache.add`.
+
+    Args:
+        cache_keys: Cache key of each file, by its path on the server
+    """
+    with cache.lock():
+        missing = {
+            filename: key
+            for filename, key in cache_keys.items()
+            if cache.get(key) is None
+        }
+    print(
+        f"{len(cache_keys) - len(missing)} of {len(cache_keys)} files found in the cache"
+    )
+    keys = {DATASET_URL + filename: key for filename, key in missing.items()}
+
+    def download_staged(session, target_dir, url, chunk_size):
+        staged = cache.staging_path(keys[url])
+        with file_lock(staged.with_name(f".{staged.name}.lock")):
+            if cache.path(keys[url]).is_file():
+                # Added by another job since the lookup
+                return str(cache.path(keys[url]))
+            if Manifest(target_dir).verify(staged):
+                # Downloaded by another job, which hasn't added it yet
+                return str(staged)
+            return download(session, target_dir, url, chunk_size)
+
+    downloads = []
+    for url, key in keys.items():
+        cache.staging_path(key).parent.mkdir(parents=True, exist_ok=True)
+        downloads.append((url, str(cache.staging_path(key).parent)))
+    asyncio.run(
+        download_files_async(
+            session,
+            downloads,
+            chunk_size=chunk_size,
+            max_per_host=concurrency,
+            download=download_staged,
+        )
+    )
+
+
+def prefetch_gdas_fnl_data(
+    cache: "AnalysisCache",
+    download_dts: list[datetime.datetime],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    subset_vtable: str | None = None,
+    bandwidth: BandwidthLimit | None = None,
+) -> list[Path]:
+    """
+    Download the analyses at a set of times into a cache, without linking them anywhere
+
+    Used to fetch the analyses of later jobs ahead of time
+    (see `setup_runs.wrf.prefetch`).
+    The cache is only locked to look up and add the files, not during the downloads.
+    No files are evicted, and a later `download_gdas_fnl_data`
+    for the same times finds the files in the cache.
+
+    Args:
+        cache:
+            Cache to download the files into
+        download_dts:
+            Datetimes to download analysis data for
+        chunk_size:
+            Number of bytes to read from the connection at a time
+        concurrency:
+            Maximum number of files downloaded at once
+        subset_vtable:
+            Path to the ungrib Vtable used to select the GRIB messages to download
+        bandwidth:
+            Limit on the download rate
+
+    Returns:
+        Paths of the files which were downloaded (those already cached are left out)
+    """
+    download, cache_prefix = fnl_downloader(subset_vtable)
+    session = create_session(pool_size=concurrency, bandwidth=bandwidth)
+    cache_keys = {
+        filename: f"{cache_prefix}/{filename}"
+        for filename in fnl_file_paths(download_dts)
+    }
+    _download_into_staging(
+        session, cache, cache_keys, download, chunk_size, concurrency
+    )
+    with cache.lock():
+        added = [cache.add(key) for key in cache_keys.values()]
+    return [Path(path) for path in added if path is not None]
 
 
 def download_gdas_fnl_data(
-    target_dir: str, download_dts: list[datetime.datetime]
+    target_dir: str,
+    download_dts: list[datetime.datetime],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    cache: "AnalysisCache | None" = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    subset_vtable: str | None = None,
+    bandwidth: BandwidthLimit | None = None,
 ) -> list[str]:
     """
     Download NCEP GDAS/FNL 0.25 Degree Global Tropospheric Analyses and Forecast Grids, ds083.3
@@ -104,11 +488,20 @@ def download_gdas_fnl_data(
 
     If any of the files fail to download (after 5 retries),
     an exception will be raised and any other downloads will be aborted.
-    If that occurs, any files being downloaded may be incomplete and should be deleted.
+    If that occurs, the incomplete downloads are left as `.part` files
+    which are resumed the next time the data is downloaded.
 
     We are downloading raw grib files without any subsetting.
     This operation does not require any RDA credentials.
 
+    If a Vtable is given, only the GRIB messages it needs are downloaded
+    (see `setup_runs.wrf.grib_inventory`).
+
+    If a cache is provided, files are only downloaded if they aren't already cached
+    and are then linked into the target directory from the cache.
+    The cache is shared with other jobs, so it is only locked to look up the files
+    and to add, link and evict them, not during the downloads.
+
     Args:
         target_dir:
             Directory where the data should be downloaded
@@ -116,6 +509,17 @@ def download_gdas_fnl_data(
             Datetimes to download analysis data for
 
             Should be strictly at 00Z, 06Z, 12Z, 18Z and not before 2015-07-08
+        chunk_size:
+            Number of bytes to read from the connection at a time
+        cache:
+            Cache of previously downloaded files shared between jobs
+        concurrency:
+            Maximum number of files downloaded at once
+        subset_vtable:
+            Path to the ungrib Vtable used to select the GRIB messages to download.
+            If None, the whole files are downloaded.
+        bandwidth:
+            Limit on the download rate, which may be shared with other downloads
 
     Returns:
         List of downloaded files
@@ -128,25 +532,35 @@ def download_gdas_fnl_data(
     ), "Target directory {} not found...".format(target_dir)
 
     # Create a new session with a retry strategy
-    session = create_session()
+    session = create_session(pool_size=concurrency, bandwidth=bandwidth)
 
-    file_list = []
-    for time in download_dts:
-        assert (
-            (time.hour % 6) == 0 and time.minute == 0 and time.second == 0
-        ), "Analysis time should be staggered at 00Z, 06Z, 12Z, 18Z intervals"
-        assert time > FNL_START_DATE, "Analysis times should not be before 2015-07-08"
-        file_path = time.strftime("%Y/%Y%m/gdas1.fnl0p25.%Y%m%d%H.f00.grib2")
-        file_list.append(file_path)
+    file_list = fnl_file_paths(download_dts)
+    download, cache_prefix = fnl_downloader(subset_vtable)
 
-    downloaded_files = list(
-        tqdm(
-            Parallel(return_as="generator", n_jobs=N_JOBS)(
-                delayed(download_file)(session, target_dir, DATASET_URL + filename)
-                for filename in file_list
-            ),
-            total=len(file_list),
+    if cache is None:
+        return asyncio.run(
+            download_files_async(
+                session,
+                [(DATASET_URL + filename, target_dir) for filename in file_list],
+                chunk_size=chunk_size,
+                max_per_host=concurrency,
+                download=download,
+            )
         )
-    )
 
-    return downloaded_files
+    cache_keys = {filename: f"{cache_prefix}/{filename}" for filename in file_list}
+    while True:
+        _download_into_staging(
+            session, cache, cache_keys, download, chunk_size, concurrency
+        )
+        # Concurrent jobs share the cache, so only one of them adds, links and evicts files at a time
+        with cache.lock():
+            for key in cache_keys.values():
+                cache.add(key)
+            if all(cache.get(key) is not None for key in cache_keys.values()):
+                linked_files = [
+                    cache.link(key, target_dir) for key in cache_keys.values()
+                ]
+                cache.evict(keep=[cache.path(key) for key in cache_keys.values()])
+                return linked_files
+        # Another job evicted some of the files since they were looked up
@@ -0,0 +1,202 @@
+"""
+Persistent cache of downloaded analysis files shared between jobs
+
+Consecutive jobs overlap at their boundaries
+(the analysis at the end of one job is the start of the next one and
+the spin-up period repeats analyses), so without a cache the same
+files are downloaded over and over.
+
+Files are stored under `<cache_dir>/<dataset>/<path on the server>`,
+which identifies the dataset and analysis time.
+Jobs get hard links to the cached files (or symlinks if the cache is on
+another filesystem) so no data is copied.
+Once the cache exceeds its size limit,
+the least recently used files are removed.
+Use is tracked with the access time of the files,
+leaving the modification times recorded in the integrity manifests untouched.
+
+The cache can be shared by jobs prepared in parallel;
+`AnalysisCache.lock` serialises the processes which add, link or evict files.
+Files are downloaded without holding the lock, into a staging area
+(`<cache_dir>/.staging/<key>`), and then moved into the cache (`AnalysisCache.add`).
+"""
+
+import os
+import time
+from pathlib import Path
+
+from setup_runs.utils import file_lock
+from setup_runs.wrf.fetch_fnl import PART_SUFFIX
+from setup_runs.wrf.integrity import MANIFEST_FILENAME, Manifest
+
+LOCK_FILENAME = ".lock"
+STAGING_DIRNAME = ".staging"
+"""Directory in the cache where the files are downloaded before being added"""
+
+
+def _touch(path: Path):
+    """Mark a file as used now without changing its modification time"""
+    os.utime(path, ns=(time.time_ns(), path.stat().st_mtime_ns))
+
+
+class AnalysisCache:
+    """
+    Directory of cached analysis files with a least-recently-used size limit
+
+    Args:
+        cache_dir:
+            Directory where the files are stored.
+            Created if it doesn't exist.
+        max_bytes:
+            Maximum total size of the cached files.
+            If None, the cache is never pruned.
+    """
+
+    def __init__(self, cache_dir: str | Path, max_bytes: int | None = None):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        """
+        Path of a file in the cache
+
+        Args:
+            key:
+                Relative path identifying the file, e.g.
+                `ds083.3/2022/202207/gdas1.fnl0p25.2022072200.f00.grib2`
+        """
+        return self.cache_dir / key
+
+    def staging_path(self, key: str) -> Path:
+        """
+        Path a file is downloaded to before it is added to the cache
+        """
+        return self.cache_dir / STAGING_DIRNAME / key
+
+    def lock(self):
+        """
+        Exclusive lock on the cache, held while files are looked up, added, linked or evicted
+        """
+        return file_lock(self.cache_dir / LOCK_FILENAME)
+
+    def get(self, key: str) -> Path | None:
+        """
+        Find a valid file in the cache, marking it as recently used
+
+        Files which fail verification against their manifest are removed.
+
+        Returns:
+            Path of the cached file, or None if it isn't in the cache
+        """
+        path = self.path(key)
+        if not path.is_file():
+            return None
+        manifest = Manifest(path.parent)
+        if not manifest.verify(path):
+            path.unlink()
+            manifest.remove(path)
+            return None
+        _touch(path)
+        return path
+
+    def add(self, key: str) -> Path | None:
+        """
+        Move a downloaded file from the staging area into the cache
+
+        Should be called while holding the lock.
+        Only files which have been recorded in the manifest of the staging area
+        (i.e. complete downloads) are added.
+
+        Returns:
+            Path of the cached file,
+            or None if there is no downloaded file (e.g. another job already added it)
+        """
+        staged = self.staging_path(key)
+        staged_manifest = Manifest(staged.parent)
+        entry = staged_manifest.lookup(staged)
+        if entry is None or not staged.is_file():
+            return None
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(staged, path)
+        staged_manifest.remove(staged)
+        Manifest(path.parent).record(path, entry["sha256"])
+        _touch(path)
+        return path
+
+    def link(self, key: str, target_dir: str | Path) -> str:
+        """
+        Link a cached file into a directory
+
+        A hard link is used where possible so the file survives
+        being evicted from the cache while a job is still using it.
+        Otherwise a symlink is created.
+
+        Returns:
+            Path to the linked file
+        """
+        src = self.path(key)
+        dst = os.path.join(target_dir, src.name)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            os.symlink(src.resolve(), dst)
+        _touch(src)
+        return dst
+
+    def files(self) -> list[Path]:
+        """
+        Complete files in the cache, least recently used first
+
+        Files in the staging area aren't included.
+        """
+        files = [
+            path
+            for path in self.cache_dir.rglob("*")
+            if path.is_file()
+            and not path.name.endswith(PART_SUFFIX)
+            and not any(
+                part.startswith(".") for part in path.relative_to(self.cache_dir).parts
+            )
+            and path.name != MANIFEST_FILENAME
+        ]
+        return sorted(files, key=lambda path: path.stat().st_atime)
+
+    def size(self) -> int:
+        """
+        Total size of the cached files in bytes (including partial downloads)
+        """
+        return sum(
+            path.stat().st_size for path in self.cache_dir.rglob("*") if path.is_file()
+        )
+
+    def evict(self, keep: list[Path] = ()) -> list[Path]:
+        """
+        Remove the least recently used files until the cache is within its size limit
+
+        Args:
+            keep:
+                Files which must not be removed, such as those being used by the current job
+
+        Returns:
+            The files which were removed
+        """
+        if self.max_bytes is None:
+            return []
+
+        keep = {Path(path).resolve() for path in keep}
+        size = self.size()
+        removed = []
+        for path in self.files():
+            if size <= self.max_bytes:
+                break
+            if path.resolve() in keep:
+                continue
+            size -= path.stat().st_size
+            path.unlink()
+            Manifest(path.parent).remove(path)
+            removed.append(path)
+        return removed
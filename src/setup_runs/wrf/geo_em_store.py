@@ -0,0 +1,176 @@
+"""
+Store of geo_em files shared between runs with the same domain geometry
+
+The geo_em files only depend on the domain geometry
+(the `&geogrid` settings and a few `&share` settings of the WPS namelist)
+and on `GEOGRID.TBL`, but the same domain is often set up again
+under a different name or run directory.
+The store keeps one copy of the geo_em files for each geometry,
+in a directory named after a hash of the canonicalised settings,
+so geogrid only runs once for each geometry across projects.
+"""
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+import f90nml
+
+from setup_runs.utils import file_lock
+from setup_runs.wrf.stage_cache import file_digest, input_key
+
+GEOGRID_IGNORED_SETTINGS = (
+    "geog_data_path",
+    "opt_geogrid_tbl_path",
+    "opt_output_from_geogrid_path",
+)
+"""&geogrid settings which don't change the geo_em files (paths to the inputs and outputs)"""
+
+SHARE_GEOMETRY_SETTINGS = ("wrf_core", "max_dom", "io_form_geogrid")
+"""&share settings which change the geo_em files"""
+
+SETTINGS_FILENAME = "settings.json"
+
+
+def _canonical_value(value, max_dom: int):
+    """
+    Canonical form of a namelist value
+
+    Per-domain values are truncated to the number of domains,
+    numbers are compared as floats and strings are case-insensitive.
+    """
+    values = value if isinstance(value, list) else [value]
+    canonical = []
+    for item in values[:max_dom]:
+        if isinstance(item, str):
+            item = item.strip().lower()
+        elif isinstance(item, (int, float)) and not isinstance(item, bool):
+            item = float(item)
+        canonical.append(item)
+    return canonical
+
+
+def geometry_settings(WPSnml: f90nml.Namelist) -> dict:
+    """
+    Canonicalised settings of the WPS namelist which determine the geo_em files
+    """
+    max_dom = WPSnml["share"]["max_dom"]
+    share = {
+        name: _canonical_value(WPSnml["share"][name], max_dom)
+        for name in SHARE_GEOMETRY_SETTINGS
+        if name in WPSnml["share"]
+    }
+    geogrid = {
+        name: _canonical_value(value, max_dom)
+        for name, value in WPSnml["geogrid"].items()
+        if name not in GEOGRID_IGNORED_SETTINGS
+    }
+    return {"share": share, "geogrid": geogrid}
+
+
+def geometry_key(WPSnml: f90nml.Namelist, geogrid_tbl: str | Path) -> str:
+    """
+    Hash identifying the geo_em files of a domain
+
+    Args:
+        WPSnml: WPS namelist of the domain
+        geogrid_tbl: Path to the GEOGRID.TBL used by geogrid
+    """
+    return input_key(
+        settings=geometry_settings(WPSnml), geogrid_tbl=file_digest(geogrid_tbl)
+    )
+
+
+def geo_em_filenames(nDom: int) -> list[str]:
+    """Names of the geo_em files of each domain"""
+    return ["geo_em.d0{}.nc".format(iDom + 1) for iDom in range(nDom)]
+
+
+class GeoEmStore:
+    """
+    Directory of geo_em files keyed by domain geometry
+
+    Files are stored under `<store_dir>/<key>/geo_em.d0N.nc`,
+    along with the settings they were produced from (`settings.json`).
+
+    Args:
+        store_dir: Directory of the store. Created if it doesn't exist.
+    """
+
+    def __init__(self, store_dir: str | Path):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        """Directory of the geo_em files of a geometry"""
+        return self.store_dir / key
+
+    def lock(self, key: str):
+        """
+        Exclusive lock on a geometry, held while its files are checked and created
+        """
+        return file_lock(self.store_dir / f".{key}.lock")
+
+    def contains(self, key: str, nDom: int) -> bool:
+        """Check that the geo_em files of all the domains are stored"""
+        return all(
+            (self.path(key) / filename).is_file() for filename in geo_em_filenames(nDom)
+        )
+
+    def add(
+        self,
+        key: str,
+        geo_em_files: list[str | Path],
+        settings: dict | None = None,
+        move: bool = False,
+    ) -> list[Path]:
+        """
+        Add the geo_em files of a geometry to the store
+
+        Args:
+            key: Geometry key (see `geometry_key`)
+            geo_em_files: Files to add
+            settings: Settings of the geometry, stored for reference
+            move: Move the files into the store rather than linking (or copying) them
+
+        Returns:
+            Paths to the stored files
+        """
+        directory = self.path(key)
+        directory.mkdir(exist_ok=True)
+        stored = []
+        for src in geo_em_files:
+            dst = directory / os.path.basename(src)
+            # Write under a temporary name so a partial file is never mistaken for a stored one
+            tmp = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+            if move:
+                shutil.move(src, tmp)
+            else:
+                try:
+                    os.link(src, tmp)
+                except OSError:
+                    shutil.copy2(src, tmp)
+            os.replace(tmp, dst)
+            stored.append(dst)
+        if settings is not None:
+            with open(directory / SETTINGS_FILENAME, "w") as f:
+                json.dump(settings, f, indent=2, sort_keys=True)
+        return stored
+
+    def link(self, key: str, nDom: int, target_dir: str | Path) -> list[str]:
+        """
+        Link the stored geo_em files of a geometry into a directory
+
+        Returns:
+            Paths to the linked files
+        """
+        linked = []
+        for filename in geo_em_filenames(nDom):
+            src = self.path(key) / filename
+            dst = os.path.join(target_dir, filename)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.symlink(src, dst)
+            linked.append(dst)
+        return linked
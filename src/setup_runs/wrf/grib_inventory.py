@@ -0,0 +1,353 @@
+"""
+Download only the GRIB2 messages needed by ungrib using the server's inventory
+
+NCEP-style GRIB2 files are accompanied by a `.idx` inventory
+(as written by `wgrib2 -s`) listing the byte offset, variable and level of each message.
+The messages which match an entry in the ungrib Vtable are fetched with
+HTTP Range requests and concatenated, which is still a valid GRIB2 file.
+
+Vtable entries whose parameter or type of level isn't known are skipped (and reported).
+If the inventory is missing, none of the Vtable can be matched
+or the server ignores Range requests, the whole file is downloaded instead.
+"""
+
+import functools
+import hashlib
+import os
+import re
+
+import requests
+from attrs import define
+
+from setup_runs.wrf.fetch_fnl import (
+    DEFAULT_CHUNK_SIZE,
+    PART_SUFFIX,
+    complete_download,
+    download_file,
+)
+
+INVENTORY_SUFFIX = ".idx"
+
+GRIB2_NAMES = {
+    (0, 0, 0): "TMP",
+    (0, 1, 0): "SPFH",
+    (0, 1, 1): "RH",
+    (0, 1, 11): "SNOD",
+    (0, 1, 13): "WEASD",
+    (0, 2, 2): "UGRD",
+    (0, 2, 3): "VGRD",
+    (0, 2, 8): "VVEL",
+    (0, 3, 0): "PRES",
+    (0, 3, 1): "PRMSL",
+    (0, 3, 5): "HGT",
+    (0, 3, 192): "MSLET",
+    (2, 0, 0): "LAND",
+    (2, 0, 2): "TSOIL",
+    (2, 0, 192): "SOILW",
+    (10, 2, 0): "ICEC",
+}
+"""wgrib2 names of the GRIB2 parameters (discipline, category, number)"""
+
+FIXED_LEVELS = {
+    1: "surface",
+    2: "cloud base",
+    3: "cloud top",
+    4: "0C isotherm",
+    6: "max wind",
+    7: "tropopause",
+    8: "top of atmosphere",
+    10: "entire atmosphere",
+    101: "mean sea level",
+    200: "entire atmosphere (considered as a single layer)",
+    204: "highest tropospheric freezing level",
+    220: "planetary boundary layer",
+}
+"""wgrib2 descriptions of the GRIB2 types of level without a value"""
+
+HEIGHT_LEVELS = {
+    102: "m above mean sea level",
+    103: "m above ground",
+}
+"""wgrib2 descriptions of the GRIB2 types of level given as a height in metres"""
+
+
+@define
+class InventoryRecord:
+    number: int
+    """Message number"""
+    offset: int
+    """Byte offset of the start of the message"""
+    variable: str
+    """wgrib2 name of the variable, e.g. TMP"""
+    level: str
+    """wgrib2 description of the level, e.g. 500 mb"""
+    end: int | None = None
+    """Byte offset of the last byte of the message (None if it is the last message)"""
+
+
+@define
+class VtableEntry:
+    name: str
+    """metgrid name of the field"""
+    discipline: int
+    category: int
+    parameter: int
+    level_type: int
+    """GRIB2 code of the type of level"""
+    level1: str
+    """First level from the Vtable ('*' for all levels)"""
+    level2: str
+    """Second level from the Vtable (used for layers)"""
+
+
+def parse_inventory(text: str) -> list[InventoryRecord]:
+    """
+    Parse a `.idx` inventory
+
+    Each line has the form `number:offset:d=date:variable:level:forecast:`.
+    """
+    records = []
+    for line in text.splitlines():
+        fields = line.split(":")
+        if len(fields) < 5:
+            continue
+        number = int(fields[0].split(".")[0])
+        records.append(
+            InventoryRecord(
+                number=number,
+                offset=int(fields[1]),
+                variable=fields[3],
+                level=fields[4],
+            )
+        )
+
+    # Submessages share their offset with the message they belong to
+    offsets = sorted({record.offset for record in records})
+    ends = {start: end - 1 for start, end in zip(offsets, offsets[1:])}
+    for record in records:
+        record.end = ends.get(record.offset)
+    return records
+
+
+def parse_vtable(text: str) -> list[VtableEntry]:
+    """
+    Parse the GRIB2 columns of an ungrib Vtable
+
+    Entries without GRIB2 columns are ignored.
+    """
+    entries = []
+    for line in text.splitlines():
+        columns = [column.strip() for column in line.split("|")]
+        if len(columns) < 11 or not columns[0].isdigit():
+            continue
+        grib2 = columns[7:11]
+        if not all(column.isdigit() for column in grib2):
+            continue
+        discipline, category, parameter, level_type = (int(c) for c in grib2)
+        entries.append(
+            VtableEntry(
+                name=columns[4],
+                discipline=discipline,
+                category=category,
+                parameter=parameter,
+                level_type=level_type,
+                level1=columns[2],
+                level2=columns[3],
+            )
+        )
+    return entries
+
+
+def _format_level(value: str, scale: float = 1.0) -> str:
+    return f"{float(value) * scale:g}"
+
+
+def level_pattern(entry: VtableEntry) -> re.Pattern | None:
+    """
+    Regular expression matching the wgrib2 level descriptions of a Vtable entry
+
+    Returns None if the type of level isn't known.
+    """
+    any_level = entry.level1 in ("*", "")
+    if entry.level_type in FIXED_LEVELS:
+        return re.compile(re.escape(FIXED_LEVELS[entry.level_type]) + "$")
+    if entry.level_type == 100:
+        if any_level:
+            return re.compile(r"[\d.]+ mb$")
+        # Pressure levels are given in hPa in the Vtable
+        return re.compile(re.escape(f"{_format_level(entry.level1)} mb") + "$")
+    if entry.level_type in HEIGHT_LEVELS:
+        description = HEIGHT_LEVELS[entry.level_type]
+        if any_level:
+            return re.compile(r"[\d.]+ " + re.escape(description) + "$")
+        return re.compile(
+            re.escape(f"{_format_level(entry.level1)} {description}") + "$"
+        )
+    if entry.level_type == 106:
+        if any_level or not entry.level2:
+            return re.compile(r"[\d.-]+ m below ground$")
+        # Soil layers are given in cm in the Vtable
+        layer = (
+            f"{_format_level(entry.level1, 0.01)}-{_format_level(entry.level2, 0.01)}"
+        )
+        return re.compile(re.escape(f"{layer} m below ground") + "$")
+    return None
+
+
+def select_records(
+    records: list[InventoryRecord], entries: list[VtableEntry]
+) -> list[InventoryRecord] | None:
+    """
+    Select the messages needed by the Vtable
+
+    Vtable entries whose GRIB2 parameter or type of level isn't known are skipped
+    and reported, so one unknown entry doesn't stop the rest of the Vtable being subset.
+    Returns None if none of the entries are known,
+    in which case the whole file is needed.
+    Known fields which are missing from the inventory are skipped,
+    as ungrib wouldn't find them in the whole file either.
+    """
+    matchers = []
+    for entry in entries:
+        variable = GRIB2_NAMES.get((entry.discipline, entry.category, entry.parameter))
+        pattern = level_pattern(entry)
+        if variable is None or pattern is None:
+            print(
+                f"Skipping {entry.name} (GRIB2 parameter "
+                f"{entry.discipline}.{entry.category}.{entry.parameter}, "
+                f"level type {entry.level_type}) which can't be matched in the inventory"
+            )
+            continue
+        matchers.append((variable, pattern))
+    if not matchers:
+        return None
+
+    return [
+        record
+        for record in records
+        if any(
+            record.variable == variable and pattern.match(record.level)
+            for variable, pattern in matchers
+        )
+    ]
+
+
+def merge_ranges(records: list[InventoryRecord]) -> list[tuple[int, int | None]]:
+    """
+    Byte ranges covering the messages, merging adjacent messages
+
+    An end of None means the range extends to the end of the file.
+    """
+    ranges = []
+    for record in sorted(records, key=lambda r: r.offset):
+        if ranges and ranges[-1][1] is not None and record.offset <= ranges[-1][1] + 1:
+            start, end = ranges[-1]
+            ranges[-1] = (start, None if record.end is None else max(end, record.end))
+        else:
+            ranges.append((record.offset, record.end))
+    return ranges
+
+
+class RangeNotSupported(Exception):
+    """The server returned the whole file in response to a Range request"""
+
+
+def _download_ranges(
+    session: requests.Session,
+    filename: str,
+    url: str,
+    ranges: list[tuple[int, int | None]],
+    chunk_size: int,
+):
+    part_filename = filename + PART_SUFFIX
+    sha256 = hashlib.sha256()
+    try:
+        with open(part_filename, "wb") as f:
+            for start, end in ranges:
+                byte_range = f"bytes={start}-{'' if end is None else end}"
+                with session.get(url, stream=True, headers={"Range": byte_range}) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise RangeNotSupported(url)
+                    received = 0
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        received += len(chunk)
+                if end is not None and received != end - start + 1:
+                    raise RuntimeError(
+                        f"Received {received} of {end - start + 1} bytes of {url}"
+                    )
+    except BaseException:
+        # A partial subset can't be resumed as a full download
+        os.remove(part_filename)
+        raise
+    complete_download(part_filename, filename, sha256.hexdigest())
+
+
+def download_grib_subset(
+    session: requests.Session,
+    target_dir: str,
+    url: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    entries: list[VtableEntry] = (),
+) -> str:
+    """
+    Download the messages of a GRIB2 file needed by a Vtable
+
+    Falls back to downloading the whole file if the subset can't be determined.
+
+    Args:
+        session:
+            Authenticated session
+        target_dir:
+            Directory to save the downloaded file
+        url:
+            URL of the GRIB2 file. The inventory is expected at `url + ".idx"`
+        chunk_size:
+            Number of bytes to read from the connection at a time
+        entries:
+            Entries of the Vtable used to ungrib the file
+
+    Raises:
+        RuntimeError: If the download fails
+
+    Returns:
+        Path to the downloaded file
+    """
+    filename = os.path.join(target_dir, os.path.basename(url))
+    try:
+        r = session.get(url + INVENTORY_SUFFIX)
+        r.raise_for_status()
+    except requests.exceptions.RequestException:
+        print(f"No inventory found for {url}, downloading the whole file")
+        return download_file(session, target_dir, url, chunk_size)
+
+    records = select_records(parse_inventory(r.text), entries)
+    if not records:
+        print(f"Could not match the inventory of {url}, downloading the whole file")
+        return download_file(session, target_dir, url, chunk_size)
+
+    try:
+        _download_ranges(session, filename, url, merge_ranges(records), chunk_size)
+    except RangeNotSupported:
+        print(f"Range requests not supported for {url}, downloading the whole file")
+        return download_file(session, target_dir, url, chunk_size)
+    except requests.exceptions.RequestException as e:
+        raise RuntimeError(f"Error downloading {url}") from e
+    return filename
+
+
+def subset_downloader(vtable: str) -> tuple[functools.partial, str]:
+    """
+    Create a download function which only fetches the messages needed by a Vtable
+
+    Returns:
+        The download function, which has the same signature as `download_file`,
+        and a name identifying the subset (for keeping subsets apart in a cache)
+    """
+    with open(vtable) as f:
+        text = f.read()
+    digest = hashlib.sha1(text.encode()).hexdigest()[:12]
+    entries = parse_vtable(text)
+    return functools.partial(download_grib_subset, entries=entries), f"subset-{digest}"
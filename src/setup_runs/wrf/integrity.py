@@ -0,0 +1,179 @@
+"""
+Verify the integrity of downloaded analysis files
+
+Each downloaded file is hashed as it is written and its GRIB2 structure is checked
+(every message starts with `GRIB`, has a valid length and ends with `7777`).
+The results are stored in a JSON manifest in the same directory,
+so later runs can trust an unchanged file (same size and modification time)
+without reading it again.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+from setup_runs.utils import load_json_entries, update_json_entry
+
+MANIFEST_FILENAME = "manifest.json"
+
+GRIB2_SUFFIXES = (".grib2", ".grb2")
+"""Files with these suffixes have their GRIB2 structure checked"""
+
+_GRIB_HEADER_LENGTH = 16
+_END_OF_MESSAGE = b"7777"
+
+
+class InvalidGribFile(ValueError):
+    """A GRIB2 file is truncated or corrupt"""
+
+
+def count_grib2_messages(path: str | Path) -> int:
+    """
+    Check the structure of a GRIB2 file and count its messages
+
+    Only the message headers and end markers are read.
+
+    Raises:
+        InvalidGribFile: If the file is empty, truncated or isn't a GRIB2 file
+
+    Returns:
+        Number of messages in the file
+    """
+    size = os.path.getsize(path)
+    messages = 0
+    offset = 0
+    with open(path, "rb") as f:
+        while offset < size:
+            f.seek(offset)
+            header = f.read(_GRIB_HEADER_LENGTH)
+            if len(header) < _GRIB_HEADER_LENGTH or header[:4] != b"GRIB":
+                raise InvalidGribFile(f"{path}: no GRIB message at byte {offset}")
+            if header[7] != 2:
+                raise InvalidGribFile(
+                    f"{path}: message at byte {offset} is GRIB edition {header[7]}"
+                )
+            length = int.from_bytes(header[8:16], "big")
+            if length < _GRIB_HEADER_LENGTH or offset + length > size:
+                raise InvalidGribFile(f"{path}: message at byte {offset} is truncated")
+            f.seek(offset + length - len(_END_OF_MESSAGE))
+            if f.read(len(_END_OF_MESSAGE)) != _END_OF_MESSAGE:
+                raise InvalidGribFile(
+                    f"{path}: message at byte {offset} has no end marker"
+                )
+            offset += length
+            messages += 1
+    if messages == 0:
+        raise InvalidGribFile(f"{path}: no GRIB messages found")
+    return messages
+
+
+def hash_file(path: str | Path, chunk_size: int = 4 * 1024 * 1024):
+    """
+    SHA-256 hash of the contents of a file
+
+    Returns the hash object, so more data can be added as the file grows.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            sha256.update(chunk)
+    return sha256
+
+
+def sha256sum(path: str | Path) -> str:
+    """
+    SHA-256 checksum of a file
+    """
+    return hash_file(path).hexdigest()
+
+
+class Manifest:
+    """
+    Checksums and structure of the verified files in a directory
+
+    Stored as `manifest.json` in the directory,
+    mapping each file name to its size, modification time, SHA-256 checksum
+    and (for GRIB2 files) number of messages.
+    """
+
+    def __init__(self, directory: str | Path):
+        self.path = Path(directory) / MANIFEST_FILENAME
+
+    def lookup(self, path: str | Path) -> dict | None:
+        """
+        Get the manifest entry of a file
+        """
+        return load_json_entries(self.path).get(Path(path).name)
+
+    def record(self, path: str | Path, sha256: str) -> dict:
+        """
+        Check the structure of a file and record it in the manifest
+
+        Args:
+            path:
+                File in the manifest's directory
+            sha256:
+                Checksum of the file, computed while it was written
+
+        Raises:
+            InvalidGribFile: If a GRIB2 file is truncated or corrupt
+
+        Returns:
+            The manifest entry
+        """
+        path = Path(path)
+        messages = None
+        if path.suffix in GRIB2_SUFFIXES:
+            messages = count_grib2_messages(path)
+        stat = path.stat()
+        entry = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256,
+            "messages": messages,
+        }
+        # Concurrent downloads record into the same manifest
+        update_json_entry(self.path, path.name, entry)
+        return entry
+
+    def remove(self, path: str | Path):
+        """
+        Remove a file from the manifest
+        """
+        update_json_entry(self.path, Path(path).name, None)
+
+    def verify(self, path: str | Path) -> bool:
+        """
+        Check that a file exists and is intact
+
+        A file with the same size and modification time as its manifest entry
+        is trusted without being read.
+        Otherwise the file is hashed and its structure checked.
+        If it was in the manifest, the checksum must match the recorded one.
+        Files which pass are (re)recorded in the manifest.
+
+        Returns:
+            True if the file is valid
+        """
+        path = Path(path)
+        if not path.is_file():
+            return False
+        stat = path.stat()
+        entry = self.lookup(path)
+        if (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return True
+
+        sha256 = sha256sum(path)
+        if entry is not None and (
+            entry["size"] != stat.st_size or entry["sha256"] != sha256
+        ):
+            return False
+        try:
+            self.record(path, sha256)
+        except InvalidGribFile:
+            return False
+        return True
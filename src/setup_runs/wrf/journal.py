@@ -0,0 +1,206 @@
+"""
+Persistent journal of the WRF output files processed in a run directory
+
+The journal records a fingerprint (size and modification time) of each file,
+the number of time steps it contains and the state of its processing.
+This avoids re-opening unchanged files on every scan of the directory
+and allows processing to resume cleanly after a crash.
+"""
+
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from attrs import define
+
+from setup_runs.utils import fingerprint
+
+JOURNAL_FILENAME = "wrfout.journal.sqlite"
+"""
+Name of the journal in the run directory
+
+Doesn't match the `wrfout_*` pattern of the files being processed
+"""
+
+PENDING = "pending"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+STATES = (PENDING, PROCESSING, DONE, FAILED)
+
+
+@define
+class JournalEntry:
+    path: str
+    """Path of the input file"""
+    size: int
+    """Size of the input file in bytes"""
+    mtime_ns: int
+    """Modification time of the input file (in nanoseconds)"""
+    nsteps: int | None
+    """Number of time steps in the input file, if known"""
+    state: str
+    """One of pending, processing, done or failed"""
+    output: str | None
+    """Path of the processed file"""
+    error: str | None
+    """Error message of a failed attempt"""
+    updated: float
+    """Time of the last update (seconds since the epoch)"""
+
+    def matches(self, fingerprint: tuple[int, int]) -> bool:
+        """Check if the entry describes the current version of a file"""
+        return (self.size, self.mtime_ns) == fingerprint
+
+
+class ProcessingJournal:
+    """
+    SQLite-backed journal of the processing state of each file
+    """
+
+    def __init__(self, path: str | Path = JOURNAL_FILENAME):
+        self.path = Path(path)
+        self._connection = sqlite3.connect(self.path, timeout=60)
+        with self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    nsteps INTEGER,
+                    state TEXT NOT NULL,
+                    output TEXT,
+                    error TEXT,
+                    updated REAL NOT NULL
+                )
+                """
+            )
+
+    def lookup(self, path: str | Path) -> JournalEntry | None:
+        """
+        Get the journal entry for a file, if one exists
+        """
+        row = self._connection.execute(
+            "SELECT * FROM files WHERE path = ?", (str(path),)
+        ).fetchone()
+        return JournalEntry(*row) if row else None
+
+    def record(
+        self,
+        path: str | Path,
+        state: str,
+        nsteps: int | None = None,
+        output: str | None = None,
+        error: str | None = None,
+        file_fingerprint: tuple[int, int] | None = None,
+    ) -> JournalEntry:
+        """
+        Record the state of a file
+
+        Parameters
+        ----------
+        path
+            Path of the input file
+        state
+            One of pending, processing, done or failed
+        nsteps
+            Number of time steps in the file.
+            If None, any previously recorded value is kept.
+        output
+            Path of the processed file
+        error
+            Error message of a failed attempt
+        file_fingerprint
+            Size and modification time of the file.
+            If None, any previously recorded value is kept,
+            or the fingerprint is read from the file.
+
+        Returns
+        -------
+            The updated entry
+        """
+        if state not in STATES:
+            raise ValueError(f"state must be one of {', '.join(STATES)}")
+        previous = self.lookup(path)
+        if file_fingerprint is None:
+            if previous is not None:
+                file_fingerprint = (previous.size, previous.mtime_ns)
+            else:
+                file_fingerprint = fingerprint(path)
+        if (
+            nsteps is None
+            and previous is not None
+            and previous.matches(file_fingerprint)
+        ):
+            nsteps = previous.nsteps
+
+        entry = JournalEntry(
+            path=str(path),
+            size=file_fingerprint[0],
+            mtime_ns=file_fingerprint[1],
+            nsteps=nsteps,
+            state=state,
+            output=output,
+            error=error,
+            updated=time.time(),
+        )
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    entry.path,
+                    entry.size,
+                    entry.mtime_ns,
+                    entry.nsteps,
+                    entry.state,
+                    entry.output,
+                    entry.error,
+                    entry.updated,
+                ),
+            )
+        return entry
+
+    def entries(self, state: str | None = None) -> list[JournalEntry]:
+        """
+        List the entries in the journal, optionally only those in a given state
+        """
+        if state is None:
+            rows = self._connection.execute("SELECT * FROM files ORDER BY path")
+        else:
+            rows = self._connection.execute(
+                "SELECT * FROM files WHERE state = ? ORDER BY path", (state,)
+            )
+        return [JournalEntry(*row) for row in rows]
+
+    def recover(self) -> list[JournalEntry]:
+        """
+        Reset files left in the processing state by an interrupted run
+
+        Any partially written outputs are removed
+        and the files are marked as pending so they will be processed again.
+
+        Returns
+        -------
+            The entries which were reset
+        """
+        recovered = []
+        for entry in self.entries(PROCESSING):
+            if entry.output and os.path.exists(entry.output):
+                os.remove(entry.output)
+            recovered.append(
+                self.record(
+                    entry.path, PENDING, file_fingerprint=(entry.size, entry.mtime_ns)
+                )
+            )
+        return recovered
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
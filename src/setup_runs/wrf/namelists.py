@@ -1,4 +1,25 @@
+import copy
+import io
 import pdb
+from collections.abc import Hashable, Mapping, Sequence
+
+import f90nml
+
+FORMAT_OPTIONS = (
+    "assign_spacing",
+    "column_width",
+    "default_start_index",
+    "end_comma",
+    "false_repr",
+    "float_format",
+    "indent",
+    "index_spacing",
+    "repeat_counter",
+    "split_strings",
+    "true_repr",
+    "uppercase",
+)
+"""Formatting options of `f90nml.Namelist` which are carried over when rendering"""
 
 NAMELIST_PARAMS_TO_MATCH = [
     {
@@ -133,3 +154,94 @@ def validate_wrf_namelists(namelist_wps, namelist_wrf):
                 ), "Mismatched values for variable {} between the WRF and WPS namelists".format(
                     param_dict["wrf_var"]
                 )
+
+
+def _hashable(value) -> Hashable:
+    """Hashable form of a namelist value (lists become tuples)"""
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+class NamelistRenderer:
+    """
+    Namelist serialised once, with the values of some variables filled in when rendered
+
+    Rendering gives the same text as setting the variables in a copy of the namelist
+    and writing it with f90nml, but only the variables which change are formatted.
+    The namelist isn't modified when rendering,
+    so a renderer can be shared between jobs and threads.
+
+    Args:
+        namelist: Template namelist (not modified)
+        variables: Group and name of each variable filled in when rendering.
+            Variables which aren't in the template are added at the end of their group.
+    """
+
+    def __init__(self, namelist: f90nml.Namelist, variables: Sequence[tuple[str, str]]):
+        self.variables = [tuple(variable) for variable in variables]
+        self._options = {name: getattr(namelist, name) for name in FORMAT_OPTIONS}
+        # Formatted values of the variables, keyed by (group, name, value)
+        self._formatted: dict[tuple, str] = {}
+
+        # Mark the line of each variable with a placeholder value,
+        # then split the text into the fixed text and the index of each variable
+        template = copy.deepcopy(namelist)
+        markers = {}
+        for index, (group, name) in enumerate(self.variables):
+            marker = f"@@namelist-renderer-{index}@@"
+            template[group][name] = marker
+            markers[marker] = index
+        self._tokens: list[str | int] = []
+        for line in self._write(template).splitlines(keepends=True):
+            index = next(
+                (index for marker, index in markers.items() if marker in line), None
+            )
+            if index is None:
+                if self._tokens and isinstance(self._tokens[-1], str):
+                    self._tokens[-1] += line
+                else:
+                    self._tokens.append(line)
+            else:
+                self._tokens.append(index)
+
+    def _write(self, namelist: f90nml.Namelist) -> str:
+        """Serialise a namelist with the formatting options of the template"""
+        for name, value in self._options.items():
+            # Unset options (such as default_start_index) can't be assigned
+            if value is not None:
+                setattr(namelist, name, value)
+        stream = io.StringIO()
+        namelist.write(stream)
+        return stream.getvalue()
+
+    def _format(self, group: str, name: str, value) -> str:
+        """Lines of a variable set to a value, as written by f90nml"""
+        key = (group, name, _hashable(value))
+        if key not in self._formatted:
+            lines = self._write(f90nml.Namelist({group: {name: value}})).splitlines(
+                keepends=True
+            )
+            # Drop the "&group" and "/" lines around the variable
+            self._formatted[key] = "".join(lines[1:-1])
+        return self._formatted[key]
+
+    def render(self, values: Mapping[tuple[str, str], object]) -> str:
+        """
+        Text of the namelist with the variables set to the given values
+
+        Args:
+            values: Value of each of the variables, keyed by (group, name)
+
+        Returns:
+            The namelist, formatted as f90nml would write it
+        """
+        missing = set(self.variables) - set(values)
+        if missing:
+            raise KeyError(f"No value given for the namelist variables {missing}")
+        return "".join(
+            token
+            if isinstance(token, str)
+            else self._format(*self.variables[token], values[self.variables[token]])
+            for token in self._tokens
+        )
@@ -0,0 +1,162 @@
+"""
+Download the FNL analyses of upcoming WPS periods in the background
+
+Without prefetching, each period's analyses are only downloaded when its download stage runs,
+so the network sits idle while ungrib and metgrid run.
+The prefetcher downloads the analyses of the registered periods, in order,
+into the analysis cache (see `setup_runs.wrf.fnl_cache`) from a background thread.
+When a period's download stage runs it finds the files in the cache
+and "claims" the period.
+
+Two budgets bound the prefetching:
+
+* the disk budget limits the size of the files which have been prefetched
+  but not yet claimed, so the prefetcher doesn't run arbitrarily far ahead
+  (and doesn't push files which are still needed out of the cache)
+* the bandwidth budget (a `BandwidthLimit` which may be shared with the download stages)
+  limits the rate the files are downloaded at
+"""
+
+import datetime
+import threading
+
+from setup_runs.wrf.fetch_fnl import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_CONCURRENCY,
+    BandwidthLimit,
+    prefetch_gdas_fnl_data,
+)
+from setup_runs.wrf.fnl_cache import AnalysisCache
+
+
+def _window_key(times: list[datetime.datetime]) -> tuple:
+    return (times[0], times[-1])
+
+
+class AnalysisPrefetcher:
+    """
+    Background downloads of the analyses of upcoming periods
+
+    Used as a context manager, which starts the downloads and stops them on exit.
+
+    Args:
+        cache:
+            Cache the analyses are downloaded into
+        max_bytes:
+            Maximum size of the prefetched files which haven't been claimed yet
+        chunk_size:
+            Number of bytes to read from the connection at a time
+        concurrency:
+            Maximum number of files downloaded at once
+        subset_vtable:
+            Path to the ungrib Vtable used to select the GRIB messages to download
+        bandwidth:
+            Limit on the download rate
+    """
+
+    def __init__(
+        self,
+        cache: AnalysisCache,
+        max_bytes: int,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        subset_vtable: str | None = None,
+        bandwidth: BandwidthLimit | None = None,
+    ):
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.subset_vtable = subset_vtable
+        self.bandwidth = bandwidth
+        self.windows: dict[tuple, list[datetime.datetime]] = {}
+        self._claimed: set[tuple] = set()
+        self._prefetched_bytes: dict[tuple, int] = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def add_window(self, times: list[datetime.datetime]):
+        """
+        Register the analysis times of a period, in the order they will be needed
+        """
+        self.windows[_window_key(times)] = list(times)
+
+    @property
+    def pending_bytes(self) -> int:
+        """Size of the prefetched files which haven't been claimed yet"""
+        with self._condition:
+            return sum(self._prefetched_bytes.values())
+
+    def claim(self, times: list[datetime.datetime]):
+        """
+        Mark a period as being downloaded, releasing its share of the disk budget
+
+        Called when the period's download stage starts.
+        The prefetcher skips the rest of the period if it hasn't fetched it yet.
+        """
+        key = _window_key(times)
+        with self._condition:
+            self._claimed.add(key)
+            self._prefetched_bytes.pop(key, None)
+            self._condition.notify_all()
+
+    def _wait_for_budget(self, key: tuple) -> bool:
+        """Wait until there is room in the disk budget, returning False if the period is no longer needed"""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._stopped
+                or key in self._claimed
+                or sum(self._prefetched_bytes.values()) < self.max_bytes
+            )
+            return not (self._stopped or key in self._claimed)
+
+    def run(self):
+        """
+        Prefetch the analyses of the registered periods in order
+
+        Errors stop the prefetching without being raised,
+        as the download stages fetch (and report errors for) their own files.
+        """
+        for key, times in list(self.windows.items()):
+            for start in range(0, len(times), self.concurrency):
+                if not self._wait_for_budget(key):
+                    break
+                try:
+                    downloaded = prefetch_gdas_fnl_data(
+                        self.cache,
+                        times[start : start + self.concurrency],
+                        chunk_size=self.chunk_size,
+                        concurrency=self.concurrency,
+                        subset_vtable=self.subset_vtable,
+                        bandwidth=self.bandwidth,
+                    )
+                except Exception as e:
+                    print(f"Stopped prefetching the analyses: {e}")
+                    return
+                nbytes = sum(path.stat().st_size for path in downloaded)
+                with self._condition:
+                    if key not in self._claimed:
+                        self._prefetched_bytes[key] = (
+                            self._prefetched_bytes.get(key, 0) + nbytes
+                        )
+
+    def start(self):
+        """Start prefetching in a background thread"""
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop prefetching, waiting for the files being downloaded"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,6 +1,8 @@
 import datetime
+import hashlib
+import json
 
-from attrs import define, field
+from attrs import define, field, fields_dict
 import os
 from setup_runs.config_read_functions import (
     boolean_converter,
@@ -10,6 +12,9 @@ from setup_runs.config_read_functions import (
     load_json,
 )
 
+COMPILED_CONFIG_VERSION = 1
+"""Version of the format of the compiled configuration files"""
+
 
 @define
 class WRFConfig:
@@ -139,11 +144,65 @@ class WRFConfig:
     wrf_run_tables_pattern: str
     """pattern to match to get the WRF input tables and data-files 
     (within the folder ${wrf_run_dir}"""
+    wrfout_include_variables: str = ""
+    """comma-separated glob patterns of the variables to keep when averaging the WRF output
+    (all variables are kept if empty)"""
+    wrfout_exclude_variables: str = ""
+    """comma-separated glob patterns of the variables to drop when averaging the WRF output"""
+    fnl_download_chunk_bytes: int = 4 * 1024 * 1024
+    """number of bytes read at a time when downloading the FNL analyses"""
+    fnl_download_concurrency: int = 8
+    """maximum number of FNL analyses downloaded at once"""
+    fnl_download_mode: str = field(default="full")
+    """how the FNL analyses are downloaded - "full" downloads whole files,
+    "inventory" only downloads the GRIB messages needed by ${analysis_vtable}
+    (falling back to the whole file if the server has no .idx inventory)"""
+
+    @fnl_download_mode.validator
+    def check_fnl_download_mode(self, attribute, value):
+        if value not in ["full", "inventory"]:
+            raise ValueError("fnl_download_mode must be one of full or inventory")
+
+    fnl_cache_dir: str = ""
+    """directory where downloaded FNL analyses are cached and shared between jobs
+    (no cache is used if empty)"""
+    fnl_cache_max_gb: float = 100.0
+    """size of the FNL cache (in GB) above which the least recently used files are removed"""
+    fnl_prefetch_max_gb: float = 0.0
+    """maximum size (in GB) of the FNL analyses downloaded into ${fnl_cache_dir} ahead of the jobs
+    which need them, while earlier jobs run WPS (0 disables prefetching)"""
+    fnl_download_max_mb_per_s: float = 0.0
+    """maximum total rate (in MB/s) the FNL analyses are downloaded at (0 for no limit)"""
+    geo_em_store_dir: str = ""
+    """directory of geo_em files shared between runs, keyed by the domain geometry
+    (if empty, the geo_em files are kept in ${geo_em_dir})"""
+    wps_mode: str = field(default="job")
+    """how the met_em files are produced - "job" runs ungrib and metgrid for each job,
+    "campaign" runs them once over the union of the times needed by all the jobs
+    (the jobs then only link to the met_em files)"""
+
+    @wps_mode.validator
+    def check_wps_mode(self, attribute, value):
+        if value not in ["job", "campaign"]:
+            raise ValueError("wps_mode must be one of job or campaign")
 
+    wps_chunk_hours: int = 0
+    """if wps_mode is "campaign", the maximum period (in hours) covered by each pass of WPS
+    (0 for no limit). Shorter chunks need less space for the downloaded analyses"""
+    wps_timeout_minutes: float = 0.0
+    """maximum time (in minutes) each run of ungrib.exe and metgrid.exe may take
+    before it is killed (0 for no limit)"""
 
-def load_wrf_config(filename: str) -> WRFConfig:
+
+def _config_digest(filename: str) -> str:
+    """SHA-256 checksum of a configuration file"""
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def resolve_wrf_config(filename: str) -> tuple[dict, dict[str, str]]:
     """
-    Load and processes a WRF configuration file and create a WRFConfig object.
+    Read a WRF configuration file and substitute its variables
 
     Parameters
     ----------
@@ -152,9 +211,8 @@ def load_wrf_config(filename: str) -> WRFConfig:
 
     Returns
     -------
-    WRFConfig
-        An instance of the WRFConfig class initialized with the
-        processed configuration data.
+        The resolved configuration values (before conversion by `WRFConfig`),
+        and the values of the environment variables used in the substitutions
     """
 
     # fill variables in the values with environment variables
@@ -168,7 +226,128 @@ def load_wrf_config(filename: str) -> WRFConfig:
     config = substitute_variables(config)
 
     # remove environment variables that were previously added
+    environment = {}
     for env_var in config["environment_variables_for_substitutions"].split(","):
-        config.pop(env_var)
+        environment[env_var] = config.pop(env_var)
+
+    return config, environment
+
+
+def compiled_config_path(filename: str) -> str:
+    """
+    Default path of the compiled version of a WRF configuration file
+
+    For example `config/config.nci.compiled.json` for `config/config.nci.json`.
+    """
+    root, _ = os.path.splitext(filename)
+    return f"{root}.compiled.json"
+
+
+def compile_wrf_config(filename: str, output: str | None = None) -> str:
+    """
+    Resolve and validate a WRF configuration file, writing the result to a compiled file
+
+    The compiled file records the resolved configuration along with the checksum
+    of the configuration file and the values of the environment variables it was built from,
+    so `load_wrf_config` can reuse it while they are unchanged.
+    It also documents the exact configuration used by a run.
+
+    Parameters
+    ----------
+    filename
+        The path to the WRF configuration file.
+    output
+        Path of the compiled file (defaults to `compiled_config_path(filename)`)
+
+    Returns
+    -------
+        The path to the compiled file
+    """
+    if output is None:
+        output = compiled_config_path(filename)
+    config, environment = resolve_wrf_config(filename)
+    # check that the configuration is valid before writing it
+    WRFConfig(**config)
+
+    compiled = {
+        "version": COMPILED_CONFIG_VERSION,
+        "source": {
+            "path": os.path.abspath(filename),
+            "sha256": _config_digest(filename),
+        },
+        "environment": environment,
+        "fields": sorted(fields_dict(WRFConfig)),
+        "compiled_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": config,
+    }
+    tmp = f"{output}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(compiled, f, indent=2)
+    os.replace(tmp, output)
+    return output
+
+
+def load_compiled_config(filename: str, compiled_path: str) -> dict | None:
+    """
+    Read the resolved configuration from a compiled file, if it is up to date
+
+    Parameters
+    ----------
+    filename
+        The path to the WRF configuration file.
+    compiled_path
+        The path to its compiled version (see `compile_wrf_config`)
+
+    Returns
+    -------
+        The resolved configuration values,
+        or None if there is no compiled file or it was built from a different configuration file,
+        different values of the environment variables or a different version of `WRFConfig`
+    """
+    if not os.path.exists(compiled_path):
+        return None
+    with open(compiled_path) as f:
+        compiled = json.load(f)
+
+    current = (
+        compiled.get("version") == COMPILED_CONFIG_VERSION
+        and compiled["fields"] == sorted(fields_dict(WRFConfig))
+        and compiled["source"]["sha256"] == _config_digest(filename)
+        and all(
+            os.environ.get(name) == value
+            for name, value in compiled["environment"].items()
+        )
+    )
+    if not current:
+        print(
+            f"The compiled configuration {compiled_path} is out of date, reading {filename}"
+        )
+        return None
+    return compiled["config"]
+
+
+def load_wrf_config(filename: str, use_compiled: bool = True) -> WRFConfig:
+    """
+    Load and processes a WRF configuration file and create a WRFConfig object.
+
+    Parameters
+    ----------
+    filename
+        The path to the WRF configuration file.
+    use_compiled
+        Reuse the compiled version of the configuration file (see `compile_wrf_config`)
+        if it is up to date
+
+    Returns
+    -------
+    WRFConfig
+        An instance of the WRFConfig class initialized with the
+        processed configuration data.
+    """
+    if use_compiled:
+        config = load_compiled_config(filename, compiled_config_path(filename))
+        if config is not None:
+            return WRFConfig(**config)
 
+    config, _ = resolve_wrf_config(filename)
     return WRFConfig(**config)
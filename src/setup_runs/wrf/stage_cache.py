@@ -0,0 +1,156 @@
+"""
+Reuse the outputs of the WPS/WRF stages while their inputs are unchanged
+
+Each stage (geogrid, ungrib/metgrid, real.exe) is identified by a key,
+a hash of everything which determines its outputs:
+the namelist settings it uses, the tables and executables,
+fingerprints of its input files and the period it covers.
+Once a stage has run, its key and the fingerprints (size and modification time)
+of its outputs are recorded in a `.stages.json` file in the output directory.
+The outputs are only reused if the recorded key matches and
+they haven't been modified since.
+
+Outputs which predate the stage cache (no record exists) are trusted and adopted,
+so existing run directories aren't recomputed.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import f90nml
+
+from setup_runs.utils import fingerprint, load_json_entries, update_json_entry
+from setup_runs.wrf.integrity import sha256sum
+
+STAGES_FILENAME = ".stages.json"
+
+
+def input_key(**inputs) -> str:
+    """
+    Hash of the inputs of a stage
+
+    The inputs are serialised as JSON with sorted keys,
+    so the key doesn't depend on the order the inputs are given in.
+    Values which aren't JSON types (such as dates) are converted to strings.
+    """
+    text = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def namelist_section(
+    namelist: f90nml.Namelist, section: str, exclude: tuple[str, ...] = ()
+) -> dict:
+    """
+    Settings of a namelist section, leaving out those which don't affect a stage
+    (for example the dates of a job)
+    """
+    return {
+        name: value
+        for name, value in namelist.get(section, {}).items()
+        if name not in exclude
+    }
+
+
+def file_fingerprint(path: str | Path) -> dict | None:
+    """
+    Path, size and modification time of a file, or None if it doesn't exist
+
+    Cheap to compute, so used for large inputs such as executables.
+    """
+    if not os.path.exists(path):
+        return None
+    size, mtime_ns = fingerprint(path)
+    return {"path": os.path.abspath(path), "size": size, "mtime_ns": mtime_ns}
+
+
+def file_digest(path: str | Path) -> str | None:
+    """
+    SHA-256 checksum of a file, or None if it doesn't exist
+
+    Used for small inputs such as tables, so copies with the same contents match.
+    """
+    if not os.path.exists(path):
+        return None
+    return sha256sum(path)
+
+
+class StageCache:
+    """
+    Record of the stages whose outputs are stored in a directory
+
+    Parameters
+    ----------
+    directory
+        Directory where the record is stored, usually where the outputs are written
+    """
+
+    def __init__(self, directory: str | Path):
+        self.path = Path(directory) / STAGES_FILENAME
+
+    def lookup(self, name: str) -> dict | None:
+        """
+        Get the record of a stage
+        """
+        return load_json_entries(self.path).get(name)
+
+    def record(self, name: str, key: str, outputs: list[str | Path]):
+        """
+        Record that a stage has run
+
+        Parameters
+        ----------
+        name
+            Name of the stage
+        key
+            Hash of the inputs of the stage (see `input_key`)
+        outputs
+            Files written by the stage
+        """
+        entry = {
+            "key": key,
+            "outputs": {
+                os.path.abspath(path): list(fingerprint(path)) for path in outputs
+            },
+        }
+        # Stages of different jobs may record into the same directory at once
+        update_json_entry(self.path, name, entry)
+
+    def invalidate(self, name: str):
+        """
+        Forget a stage, so it is run again
+        """
+        update_json_entry(self.path, name, None)
+
+    def is_current(self, name: str, key: str, outputs: list[str | Path]) -> bool:
+        """
+        Check if the outputs of a stage can be reused
+
+        Parameters
+        ----------
+        name
+            Name of the stage
+        key
+            Hash of the current inputs of the stage
+        outputs
+            Files the stage writes
+
+        Returns
+        -------
+            True if the stage ran with the same inputs and its outputs are unchanged.
+            Outputs which exist but were never recorded are adopted with the current key.
+        """
+        if not all(os.path.exists(path) for path in outputs):
+            return False
+        entry = self.lookup(name)
+        if entry is None:
+            self.record(name, key, outputs)
+            return True
+        if entry["key"] != key:
+            return False
+        recorded = entry["outputs"]
+        return all(
+            recorded.get(os.path.abspath(path)) == list(fingerprint(path))
+            for path in outputs
+        )
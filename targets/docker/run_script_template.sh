@@ -4,7 +4,7 @@ export NCPUS=${NCPUS:-1}
 
 cd ${RUN_DIR} || exit 1
 
-python3 checkWrfoutInBackground.py --verify-steps --watch > wrf-background.log 2>&1 &
+python3 checkWrfoutInBackground.py --verify-steps --watch ${checkWrfoutOptions} > wrf-background.log 2>&1 &
 backgroundPID=$!
 
 echo running with $NCPUS mpi ranks
@@ -13,8 +13,10 @@ time mpirun -np $NCPUS ./wrf.exe >& wrf.log
 ## give the python script a chance to finish
 sleep 30
 
-## kill the process that was running in the background
+## kill the process that was running in the background,
+## waiting for it to finish the files it is averaging
 kill $backgroundPID
+wait $backgroundPID
 
 if [ ! -e rsl.out.0000 ] ; then
     echo "wrf.exe did not complete successfully - exiting"
@@ -47,18 +47,17 @@ for wrfoutfile in `find . -type f -iname 'wrfout_*'` ; do
     fi
 done
 
-for file in wrfout_*; do
-  echo "WARNING: $file remains unprocessed. Attempting to process"
-  python3 checkWrfoutInBackground.py --no-verify-steps --timeout 0 $file
-
-  if [ -e $file ] ; then
-    echo "Could not process $file. Exiting."
-    exit
-  fi
-done
+if compgen -G "wrfout_*" > /dev/null; then
+  echo "WARNING: some wrfout files remain unprocessed. Attempting to process"
+  python3 checkWrfoutInBackground.py --no-verify-steps --retry-failed --timeout 0 --workers ${PBS_NCPUS:-1} ${checkWrfoutOptions} "wrfout_*"
+fi
 
+if ! python3 checkWrfoutInBackground.py --report ; then
+  echo "Could not process all wrfout files. Exiting."
+  exit
+fi
 
 echo "Compress files"
-./nccopy_compress_output.sh .
+python3 -m setup_runs.compress --workers ${PBS_NCPUS:-1} .
 
 du -hc .
@@ -1,3 +1,7 @@
+import http.server
+import threading
+import time
+
 import pytest
 from pathlib import Path
 import xarray as xr
@@ -58,3 +62,80 @@ def compare_dataset(data_regression):
         data_regression.check(content, basename=basename)
 
     return compare
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves `server.files` by file name, supporting Range requests
+
+    The first `server.drops` responses are cut off halfway through
+    to simulate a dropped connection.
+    """
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.headers.get("Range"))
+            self.server.paths.append(self.path)
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            time.sleep(self.server.delay)
+            self._send()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def _send(self):
+        content = self.server.files.get(self.path.rpartition("/")[2])
+        if content is None:
+            self.send_error(404)
+            return
+
+        start, end = 0, len(content) - 1
+        if self.headers.get("Range"):
+            first, last = self.headers["Range"].removeprefix("bytes=").split("-")
+            start = int(first)
+            end = int(last) if last else end
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        else:
+            self.send_response(200)
+        body = content[start : end + 1]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if self.server.drops:
+            self.server.drops -= 1
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    """
+    Local HTTP server standing in for a data server
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    server.files = {}
+    server.requests = []
+    server.paths = []
+    server.drops = 0
+    server.delay = 0
+    server.lock = threading.Lock()
+    server.active = server.max_active = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
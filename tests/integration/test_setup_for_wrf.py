@@ -1,6 +1,96 @@
-def test_setup_for_wrf(
-    tmpdir,
-    root_dir,
-):
-    # TODO: Implement tests
-    pass
+import importlib.util
+import json
+import os
+import stat
+from pathlib import Path
+
+import f90nml
+import netCDF4
+from click.testing import CliRunner
+
+from setup_runs.wrf.read_config_wrf import load_wrf_config
+
+SCRIPT = Path(__file__).parents[2] / "scripts" / "setup_for_wrf.py"
+
+spec = importlib.util.spec_from_file_location("setup_for_wrf", SCRIPT)
+setup_for_wrf = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(setup_for_wrf)
+
+FAKE_MPIRUN = """#!/bin/sh
+## drop the "-np N" options and run the program
+shift 2
+exec "$@"
+"""
+
+STUB_REAL = """#!/bin/sh
+## fail unless the met_em files are linked, like real.exe
+ls met_em.d01.*.nc > /dev/null || exit 1
+for name in wrfbdy_d01 wrfinput_d01 wrflowinp_d01; do
+    echo "$(ls met_em.d01.*.nc | wc -l)" > $name
+done
+echo "SUCCESS COMPLETE REAL_EM INIT" > rsl.out.0000
+"""
+
+
+def write_executable(path: Path, content: str) -> None:
+    path.write_text(content)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+
+def test_setup_for_wrf_real_only(tmp_path, root_dir, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    write_executable(bin_dir / "mpirun", FAKE_MPIRUN)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    config = json.loads((root_dir / "config" / "config.docker.json").read_text())
+    config.update(
+        project_root=str(tmp_path),
+        setup_root=str(root_dir),
+        run_dir=str(tmp_path / "runs"),
+        wps_dir=str(tmp_path / "WPS"),
+        wrf_dir=str(tmp_path / "WRF"),
+    )
+    configfile = tmp_path / "config.json"
+    configfile.write_text(json.dumps(config))
+    wrf_config = load_wrf_config(str(configfile))
+    WPSnml = f90nml.read(wrf_config.namelist_wps)
+
+    ## the met_em files of the single job, as produced by an earlier run
+    job_start, _, _ = setup_for_wrf.job_times(wrf_config, 0)
+    job_metem_keys = setup_for_wrf.metem_keys(
+        wrf_config,
+        WPSnml,
+        setup_for_wrf.job_metem_times(
+            job_start, wrf_config.num_hours_per_run + wrf_config.num_hours_spin_up
+        ),
+    )
+    wps_dir = tmp_path / "wps_output"
+    wps_dir.mkdir()
+    for metem_file in job_metem_keys:
+        with netCDF4.Dataset(wps_dir / metem_file, "w") as nc:
+            nc.createDimension("num_metgrid_levels", 27)
+            nc.createDimension("num_st_layers", 4)
+    os.makedirs(wrf_config.metem_dir)
+    setup_for_wrf.store_metem_files(str(wps_dir), wrf_config.metem_dir, job_metem_keys)
+
+    ## the namelist step was run before, and left real.exe in the job directory
+    run_dir = Path(setup_for_wrf.job_run_dir(wrf_config, 0))
+    run_dir.mkdir(parents=True)
+    write_executable(run_dir / "real.exe", STUB_REAL)
+
+    runner = CliRunner()
+    for _ in range(2):
+        result = runner.invoke(
+            setup_for_wrf.run_setup_for_wrf,
+            ["--configfile", str(configfile), "--from", "real", "--until", "real"],
+        )
+        assert result.exit_code == 0, result.output
+        assert "Run 1 stages" in result.output
+        assert (run_dir / "wrfinput_d01").read_text().strip() == str(
+            len(job_metem_keys)
+        )
+        ## the links are removed once real.exe has run
+        assert not list(run_dir.glob("met_em*"))
+        ## make the next run redo real.exe
+        (run_dir / "wrfinput_d01").unlink()
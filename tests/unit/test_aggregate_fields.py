@@ -0,0 +1,175 @@
+import datetime
+
+import netCDF4
+import numpy
+import pytest
+
+from setup_runs.wrf.aggregate_fields import (
+    COUNT_SUFFIX,
+    aggregate_fields,
+    find_files,
+    period_key,
+)
+
+
+def _write_hourly_file(path, time, values, fill_value=None):
+    with netCDF4.Dataset(path, "w") as nc:
+        nc.createDimension("Time", None)
+        nc.createDimension("DateStrLen", 19)
+        nc.createDimension("south_north", 2)
+        nc.createDimension("west_east", 3)
+        nc.setncatts({"TITLE": "OUTPUT FROM WRF"})
+        times = nc.createVariable("Times", "S1", ("Time", "DateStrLen"))
+        times[:] = numpy.array([list(time.strftime("%Y-%m-%d_%H:%M:%S"))], dtype="S1")
+        t2 = nc.createVariable(
+            "T2", "f4", ("Time", "south_north", "west_east"), fill_value=fill_value
+        )
+        t2.units = "K"
+        t2[:] = values
+        hgt = nc.createVariable("HGT_M", "f4", ("south_north", "west_east"))
+        hgt[:] = numpy.arange(6).reshape(2, 3)
+
+
+@pytest.fixture
+def hourly_files(tmp_path):
+    rng = numpy.random.default_rng(0)
+    start = datetime.datetime(2022, 7, 22)
+    files = {}
+    for hour in range(48):
+        time = start + datetime.timedelta(hours=hour)
+        run_dir = tmp_path / "runs" / time.strftime("%Y%m%d00")
+        run_dir.mkdir(parents=True, exist_ok=True)
+        path = run_dir / f"WRFOUT_d01_{time.strftime('%Y-%m-%dT%H%M')}Z.nc"
+        values = rng.normal(290, 5, size=(1, 2, 3)).astype("f4")
+        _write_hourly_file(path, time, values)
+        files[path] = values
+    return files
+
+
+def test_period_key():
+    assert period_key("2022-07-22_13:00:00", "daily") == "2022-07-22"
+    assert period_key("2022-07-22_13:00:00", "monthly") == "2022-07"
+
+
+def test_aggregate_daily(hourly_files, tmp_path):
+    files = find_files([tmp_path / "runs"], "WRFOUT_*.nc")
+    assert files == sorted(hourly_files)
+
+    written = aggregate_fields(files, tmp_path / "daily", period="daily")
+
+    assert [p.name for p in written] == [
+        "WRFOUT_d01_2022-07-22_daily.nc",
+        "WRFOUT_d01_2022-07-23_daily.nc",
+    ]
+    values = list(hourly_files.values())
+    with netCDF4.Dataset(written[0]) as nc:
+        assert nc.getncattr("AGGREGATE_NFRAMES") == 24
+        assert nc.variables["T2"].dtype == numpy.dtype("f4")
+        assert nc.variables["T2"].units == "K"
+        assert b"".join(nc.variables["Times"][0].tolist()) == b"2022-07-22_00:00:00"
+        numpy.testing.assert_allclose(
+            nc.variables["T2"][:],
+            numpy.concatenate(values[:24]).astype("f8").mean(axis=0, keepdims=True),
+            rtol=1e-6,
+        )
+        numpy.testing.assert_array_equal(
+            nc.variables["HGT_M"][:], numpy.arange(6).reshape(2, 3)
+        )
+
+
+def test_aggregate_masked(tmp_path):
+    start = datetime.datetime(2022, 7, 22)
+    values = numpy.ma.masked_array(
+        numpy.arange(24, dtype="f4").reshape(4, 1, 2, 3),
+        mask=numpy.zeros((4, 1, 2, 3), dtype=bool),
+    )
+    # one point is missing from some of the frames, another from all of them
+    values.mask[1:3, 0, 0, 0] = True
+    values.mask[:, 0, 1, 2] = True
+    files = []
+    for hour in range(4):
+        path = tmp_path / f"WRFOUT_d01_2022-07-22T{hour:02d}00Z.nc"
+        _write_hourly_file(
+            path, start + datetime.timedelta(hours=hour), values[hour], fill_value=-1
+        )
+        files.append(path)
+
+    # the first file has no masked values, so the counts start part way through
+    aggregate_fields(files[:1], tmp_path / "daily", period="daily")
+    (written,) = aggregate_fields(
+        files, tmp_path / "daily", period="daily", incremental=True
+    )
+
+    with netCDF4.Dataset(written) as nc:
+        assert "T2" + COUNT_SUFFIX not in nc.variables
+        t2 = nc.variables["T2"][:]
+        numpy.testing.assert_allclose(t2, values.mean(axis=0), rtol=1e-6)
+        numpy.testing.assert_array_equal(
+            numpy.ma.getmaskarray(t2), numpy.ma.getmaskarray(values.mean(axis=0))
+        )
+
+
+def test_aggregate_incremental(hourly_files, tmp_path):
+    files = sorted(hourly_files)
+
+    # the files arrive in two batches
+    aggregate_fields(files[:30], tmp_path / "incremental", period="monthly")
+    aggregate_fields(
+        files, tmp_path / "incremental", period="monthly", incremental=True
+    )
+    (full,) = aggregate_fields(files, tmp_path / "full", period="monthly")
+
+    incremental = tmp_path / "incremental" / full.name
+    with netCDF4.Dataset(incremental) as inc, netCDF4.Dataset(full) as ref:
+        assert inc.getncattr("AGGREGATE_NFRAMES") == 48
+        numpy.testing.assert_allclose(
+            inc.variables["T2"][:], ref.variables["T2"][:], rtol=1e-6
+        )
+
+    # nothing new to fold in
+    assert (
+        aggregate_fields(
+            files, tmp_path / "incremental", period="monthly", incremental=True
+        )
+        == []
+    )
+
+
+def test_aggregate_incremental_same_names(hourly_files, tmp_path):
+    files = sorted(hourly_files)[:24]
+    # A later run writes files with the same names into another directory,
+    # for the first half of the day
+    rerun_dir = tmp_path / "rerun"
+    rerun_dir.mkdir()
+    rerun_files = []
+    expected = []
+    for hour, path in enumerate(files):
+        values = hourly_files[path]
+        if hour < 12:
+            values = values + 1
+            rerun = rerun_dir / path.name
+            time = datetime.datetime(2022, 7, 22) + datetime.timedelta(hours=hour)
+            _write_hourly_file(rerun, time, values)
+            rerun_files.append(rerun)
+        expected.append(values)
+
+    aggregate_fields(files, tmp_path / "daily", period="daily")
+    (written,) = aggregate_fields(
+        rerun_files, tmp_path / "daily", period="daily", incremental=True
+    )
+
+    with netCDF4.Dataset(written) as nc:
+        assert nc.getncattr("AGGREGATE_NFRAMES") == 24
+        numpy.testing.assert_allclose(
+            nc.variables["T2"][:],
+            numpy.concatenate(expected).astype("f8").mean(axis=0, keepdims=True),
+            rtol=1e-6,
+        )
+
+    # the rerun has already been folded in
+    assert (
+        aggregate_fields(
+            rerun_files, tmp_path / "daily", period="daily", incremental=True
+        )
+        == []
+    )
@@ -0,0 +1,180 @@
+import netCDF4
+import numpy
+import pytest
+
+from setup_runs.netcdf import NetCDFEncoding
+from setup_runs.wrf.average_fields import (
+    average_fields,
+    parse_patterns,
+    select_variables,
+    time_mean,
+)
+
+
+@pytest.fixture
+def wrfout_file(tmp_path):
+    """
+    A small file with the same layout as a raw WRF output file
+    """
+    path = tmp_path / "wrfout_d01_2022-07-22_00:00:00"
+    rng = numpy.random.default_rng(42)
+    ntimes = 12
+
+    with netCDF4.Dataset(path, "w", format="NETCDF3_64BIT_OFFSET") as nc:
+        nc.createDimension("Time", None)
+        nc.createDimension("DateStrLen", 19)
+        nc.createDimension("bottom_top", 4)
+        nc.createDimension("south_north", 5)
+        nc.createDimension("west_east", 6)
+        nc.setncatts({"TITLE": "OUTPUT FROM WRF", "DX": 10000.0})
+
+        times = nc.createVariable("Times", "S1", ("Time", "DateStrLen"))
+        times[:] = numpy.array(
+            [list(f"2022-07-22_00:{5 * i:02d}:00") for i in range(ntimes)], dtype="S1"
+        )
+        xtime = nc.createVariable("XTIME", "f4", ("Time",))
+        xtime[:] = numpy.arange(ntimes) * 5.0
+        xtime.units = "minutes since 2022-07-22 00:00:00"
+
+        t = nc.createVariable(
+            "T", "f4", ("Time", "bottom_top", "south_north", "west_east")
+        )
+        t[:] = rng.normal(300, 10, size=(ntimes, 4, 5, 6))
+        t.units = "K"
+
+        psfc = nc.createVariable("PSFC", "f4", ("Time", "south_north", "west_east"))
+        psfc[:] = rng.normal(1e5, 1e3, size=(ntimes, 5, 6))
+
+        lu = nc.createVariable("LU_INDEX", "i4", ("Time", "south_north", "west_east"))
+        lu[:] = rng.integers(1, 20, size=(ntimes, 5, 6))
+
+        sst = nc.createVariable(
+            "SST", "f4", ("Time", "south_north", "west_east"), fill_value=-999.0
+        )
+        data = numpy.ma.masked_array(rng.normal(290, 2, size=(ntimes, 5, 6)))
+        data[3:, 0, 0] = numpy.ma.masked
+        data[:, 1, 1] = numpy.ma.masked
+        sst[:] = data
+
+        hgt = nc.createVariable("ZNU", "f4", ("bottom_top",))
+        hgt[:] = numpy.linspace(1, 0, 4)
+
+    return path
+
+
+def test_time_mean_matches_numpy(wrfout_file):
+    with netCDF4.Dataset(wrfout_file) as nc:
+        for name in ["T", "PSFC", "LU_INDEX", "SST", "XTIME"]:
+            var = nc.variables[name]
+            expected = var[:].mean(axis=0, keepdims=True)
+            # budget smaller than a single frame forces one frame per slab
+            for max_chunk_bytes in [1, 200, 1000, None]:
+                result = time_mean(var, 0, max_chunk_bytes=max_chunk_bytes)
+
+                assert result.shape == expected.shape
+                numpy.testing.assert_array_equal(
+                    numpy.ma.getmaskarray(result), numpy.ma.getmaskarray(expected)
+                )
+                numpy.testing.assert_array_equal(
+                    numpy.ma.filled(result, 0), numpy.ma.filled(expected, 0)
+                )
+
+
+@pytest.mark.parametrize("max_chunk_bytes", [1, 1000])
+def test_average_fields_streaming(wrfout_file, tmp_path, max_chunk_bytes):
+    reference = tmp_path / "reference.nc"
+    streamed = tmp_path / "streamed.nc"
+
+    average_fields(wrfout_file, reference, "2022-07-22_00:00:00", max_chunk_bytes=None)
+    average_fields(
+        wrfout_file, streamed, "2022-07-22_00:00:00", max_chunk_bytes=max_chunk_bytes
+    )
+
+    with netCDF4.Dataset(reference) as ref, netCDF4.Dataset(streamed) as out:
+        assert len(out.dimensions["Time"]) == 1
+        assert list(out.variables) == list(ref.variables)
+        assert out.__dict__ == ref.__dict__
+        assert b"".join(out.variables["Times"][0].tolist()) == b"2022-07-22_00:00:00"
+        for name in ref.variables:
+            assert out.variables[name].dimensions == ref.variables[name].dimensions
+            assert out.variables[name].__dict__ == ref.variables[name].__dict__
+            numpy.testing.assert_array_equal(
+                out.variables[name][:], ref.variables[name][:]
+            )
+
+
+def test_average_fields_parallel(wrfout_file, tmp_path):
+    reference = tmp_path / "reference.nc"
+    parallel = tmp_path / "parallel.nc"
+
+    average_fields(wrfout_file, reference, "2022-07-22_00:00:00")
+    average_fields(
+        wrfout_file,
+        parallel,
+        "2022-07-22_00:00:00",
+        max_chunk_bytes=1000,
+        n_workers=2,
+    )
+
+    with netCDF4.Dataset(reference) as ref, netCDF4.Dataset(parallel) as out:
+        assert list(out.variables) == list(ref.variables)
+        for name in ref.variables:
+            numpy.testing.assert_array_equal(
+                out.variables[name][:], ref.variables[name][:]
+            )
+
+
+def test_average_fields_encoding(wrfout_file, tmp_path):
+    out_file = tmp_path / "encoded.nc"
+
+    average_fields(
+        wrfout_file,
+        out_file,
+        "2022-07-22_00:00:00",
+        encoding=NetCDFEncoding(
+            complevel=2,
+            compressed_dtypes=None,
+            chunk_sizes={"Time": 1, "bottom_top": 1},
+            significant_digits=4,
+        ),
+    )
+
+    with netCDF4.Dataset(out_file) as nc:
+        t = nc.variables["T"]
+        assert t.filters()["zlib"]
+        assert t.filters()["complevel"] == 2
+        assert t.chunking() == [1, 1, 5, 6]
+        assert t.quantization() == (4, "BitGroom")
+        assert nc.variables["LU_INDEX"].filters()["zlib"]
+        assert nc.variables["LU_INDEX"].quantization() is None
+
+
+def test_select_variables():
+    names = ["Times", "XTIME", "T", "T2", "U", "U10", "LU_INDEX"]
+
+    assert select_variables(names) == names
+    assert select_variables(names, include=["T*"]) == ["Times", "T", "T2"]
+    assert select_variables(names, include=["T*", "U*"], exclude=["*2", "U10"]) == [
+        "Times",
+        "T",
+        "U",
+    ]
+    assert parse_patterns(" T2, U* ,") == ["T2", "U*"]
+
+
+def test_average_fields_subset(wrfout_file, tmp_path):
+    out_file = tmp_path / "subset.nc"
+
+    average_fields(
+        wrfout_file,
+        out_file,
+        "2022-07-22_00:00:00",
+        include=["T", "PSFC", "ZNU"],
+        exclude=["PSFC"],
+    )
+
+    with netCDF4.Dataset(out_file) as nc:
+        assert list(nc.variables) == ["Times", "T", "ZNU"]
+        numpy.testing.assert_array_equal(
+            nc.variables["ZNU"][:], numpy.linspace(1, 0, 4, dtype="f4")
+        )
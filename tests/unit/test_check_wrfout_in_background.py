@@ -0,0 +1,257 @@
+import concurrent.futures
+import importlib.util
+import os
+import time
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from setup_runs.watch import inotify_available
+from setup_runs.wrf.journal import (
+    DONE,
+    FAILED,
+    JOURNAL_FILENAME,
+    PENDING,
+    ProcessingJournal,
+)
+
+SCRIPT = Path(__file__).parents[2] / "scripts" / "check_wrfout_in_background.py"
+
+spec = importlib.util.spec_from_file_location("check_wrfout_in_background", SCRIPT)
+check_wrfout = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(check_wrfout)
+
+WRFOUT = "wrfout_d01_2022-07-22_00:00:00"
+
+
+class Stop(Exception):
+    pass
+
+
+class RecordingProcessor:
+    """Stands in for a FileProcessor, stopping the watch once a file is queued"""
+
+    busy = True
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.queued = []
+
+    def queue(self, in_file):
+        self.queued.append(in_file)
+
+    def dispatch(self):
+        if self.queued:
+            raise Stop
+        assert time.monotonic() < self.deadline, "No files were queued"
+
+
+@pytest.mark.skipif(not inotify_available(), reason="inotify is not available")
+def test_watch_files_closed_before_watch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Closed just before the watch started, so too recent for the first scan
+    (tmp_path / WRFOUT).write_bytes(b"\0")
+    processor = RecordingProcessor(deadline=time.monotonic() + 10)
+
+    with pytest.raises(Stop):
+        check_wrfout.watch_files("wrfout_*", processor, timeout=0.2, poll_interval=0.05)
+
+    assert processor.queued == [Path(WRFOUT)]
+
+
+def fake_process_file(in_file, **average_kwargs):
+    out_file = check_wrfout.generate_out_filename(in_file.name)[0]
+    Path(out_file).write_bytes(b"\0")
+    os.remove(in_file)
+    return out_file
+
+
+def test_report_and_retry_failed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(check_wrfout, "process_file", fake_process_file)
+    processed, failed, unrecorded = [
+        f"wrfout_d01_2022-07-22_{hour:02d}:00:00" for hour in range(3)
+    ]
+    for name in [processed, failed, unrecorded]:
+        Path(name).write_bytes(b"\0")
+    with ProcessingJournal(JOURNAL_FILENAME) as journal:
+        journal.record(processed, DONE)
+        journal.record(failed, FAILED, error="RuntimeError()")
+    os.remove(processed)
+    runner = CliRunner()
+
+    result = runner.invoke(check_wrfout.main, ["--report"])
+    assert result.exit_code == 1
+    assert f"Could not process {failed} (RuntimeError())" in result.output
+    # The watcher never recorded this file
+    assert f"Could not process {unrecorded} (not in the journal)" in result.output
+    assert processed not in result.output
+
+    # Failed files are skipped unless retried
+    result = runner.invoke(check_wrfout.main, ["--timeout", "0"])
+    assert result.exit_code == 0
+    assert sorted(Path(".").glob("wrfout_*")) == [Path(failed)]
+    result = runner.invoke(check_wrfout.main, ["--report"])
+    assert result.exit_code == 1
+    assert "1 done" not in result.output and "2 done" in result.output
+
+    result = runner.invoke(check_wrfout.main, ["--timeout", "0", "--retry-failed"])
+    assert result.exit_code == 0
+    result = runner.invoke(check_wrfout.main, ["--report"])
+    assert result.exit_code == 0
+    assert "3 done" in result.output
+    assert sorted(Path(".").glob("WRFOUT_*")) == [
+        Path("WRFOUT_d01_2022-07-22T0100Z.nc"),
+        Path("WRFOUT_d01_2022-07-22T0200Z.nc"),
+    ]
+
+
+def wrfout_files(directory, n):
+    files = []
+    for hour in range(n):
+        path = directory / f"wrfout_d01_2022-07-22_{hour:02d}:00:00"
+        path.write_bytes(b"\0")
+        files.append(path)
+    return files
+
+
+def logged_worker(in_file, **average_kwargs):
+    """Stub worker logging when it starts, which waits until it is released"""
+    with open(in_file.parent / "started.log", "a") as f:
+        f.write(f"{in_file.name}\n")
+    while not (in_file.parent / f"{in_file.name}.release").exists():
+        time.sleep(0.01)
+    return fake_process_file(in_file)
+
+
+def started(directory):
+    log = directory / "started.log"
+    return log.read_text().splitlines() if log.exists() else []
+
+
+def test_file_processor_dedup(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    monkeypatch.setattr(
+        check_wrfout,
+        "process_file",
+        lambda in_file, **kwargs: calls.append(in_file) or fake_process_file(in_file),
+    )
+    in_file = Path(wrfout_files(Path("."), 1)[0].name)
+    processor = check_wrfout.FileProcessor(None)
+
+    processor.queue(in_file)
+    # Rescanning the directory finds the queued file again
+    processor.queue(in_file)
+    assert processor.pending == [in_file]
+
+    processor.drain()
+    assert calls == [in_file]
+    assert not processor.busy
+
+
+def test_file_processor_back_pressure(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(check_wrfout, "process_file", logged_worker)
+    files = wrfout_files(tmp_path, 4)
+    with ProcessingJournal(tmp_path / JOURNAL_FILENAME) as journal:
+        processor = check_wrfout.FileProcessor(None, workers=2, journal=journal)
+        try:
+            for in_file in files:
+                processor.queue(in_file)
+            processor.dispatch()
+
+            # Only as many files as there are workers are handed to the pool
+            assert list(processor.in_progress) == files[:2]
+            assert processor.pending == files[2:]
+            # Files in progress aren't queued again
+            processor.queue(files[0])
+            assert processor.pending == files[2:]
+
+            # The second file finishes first, freeing a worker for the third
+            (tmp_path / f"{files[1].name}.release").touch()
+            processor.wait()
+            processor.dispatch()
+            assert list(processor.in_progress) == [files[0], files[2]]
+            assert processor.pending == files[3:]
+            assert journal.lookup(files[1]).state == DONE
+            assert journal.lookup(files[0]).state != DONE
+
+            for in_file in files:
+                (tmp_path / f"{in_file.name}.release").touch()
+            processor.drain()
+        finally:
+            processor.close()
+
+        # Files are started in the order they were queued
+        assert started(tmp_path) == [in_file.name for in_file in files]
+        assert [entry.state for entry in journal.entries()] == [DONE] * 4
+
+
+def dying_worker(in_file, **average_kwargs):
+    """Stub worker whose process dies on the first file"""
+    if in_file.name.endswith("_00:00:00"):
+        os._exit(1)
+    return logged_worker(in_file)
+
+
+def test_file_processor_broken_pool(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(check_wrfout, "process_file", dying_worker)
+    files = wrfout_files(tmp_path, 3)
+    (tmp_path / f"{files[2].name}.release").touch()
+    with ProcessingJournal(tmp_path / JOURNAL_FILENAME) as journal:
+        processor = check_wrfout.FileProcessor(None, workers=2, journal=journal)
+        try:
+            processor.queue(files[0])
+            processor.queue(files[1])
+            processor.dispatch()
+            # The pool breaks when the first worker dies, failing the other file too
+            concurrent.futures.wait(list(processor.in_progress.values()), timeout=30)
+
+            # Later files are processed by a new pool
+            processor.queue(files[2])
+            processor.drain()
+        finally:
+            processor.close()
+
+        assert journal.lookup(files[0]).state == FAILED
+        assert "BrokenProcessPool" in journal.lookup(files[0]).error
+        assert journal.lookup(files[1]).state == FAILED
+        assert journal.lookup(files[2]).state == DONE
+
+
+def test_file_processor_close(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(check_wrfout, "process_file", logged_worker)
+    (in_file,) = wrfout_files(tmp_path, 1)
+    with ProcessingJournal(tmp_path / JOURNAL_FILENAME) as journal:
+        processor = check_wrfout.FileProcessor(None, workers=2, journal=journal)
+        processor.queue(in_file)
+        processor.dispatch()
+        (tmp_path / f"{in_file.name}.release").touch()
+
+        # The file in progress is finished and recorded before the pool shuts down
+        processor.close()
+        assert not processor.in_progress
+        assert journal.lookup(in_file).state == DONE
+
+
+def test_file_processor_unchanged_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(check_wrfout, "count_steps", lambda in_file: 6)
+    in_file = Path(wrfout_files(Path("."), 1)[0].name)
+    with ProcessingJournal(JOURNAL_FILENAME) as journal:
+        processor = check_wrfout.FileProcessor(12, journal=journal)
+
+        # Incomplete files are recorded but not processed
+        processor.queue(in_file)
+        assert processor.pending == []
+        assert journal.lookup(in_file).state == PENDING
+        assert journal.lookup(in_file).nsteps == 6
+
+        # and aren't read again while they are unchanged
+        monkeypatch.setattr(check_wrfout, "count_steps", None)
+        processor.queue(in_file)
+        assert processor.pending == []
@@ -0,0 +1,82 @@
+import netCDF4
+import numpy
+import numpy.testing as npt
+
+from setup_runs.compress import compress_file, compress_files, netcdf_format
+from setup_runs.netcdf import NetCDFEncoding
+
+
+def make_netcdf3_file(path, format="NETCDF3_CLASSIC"):
+    with netCDF4.Dataset(path, mode="w", format=format) as ds:
+        ds.TITLE = "OUTPUT FROM WRF"
+        ds.createDimension("Time", None)
+        ds.createDimension("south_north", 5)
+        ds.createDimension("DateStrLen", 19)
+        times = ds.createVariable("Times", "S1", ("Time", "DateStrLen"))
+        for i, time in enumerate(["2022-07-22_00:00:00", "2022-07-22_01:00:00"]):
+            times[i] = numpy.array([c for c in time], dtype="|S1")
+        t2 = ds.createVariable("T2", "f4", ("Time", "south_north"), fill_value=-999.0)
+        t2.units = "K"
+        t2[:] = numpy.arange(10, dtype="f4").reshape(2, 5) + 280.123
+        t2[1, 0] = numpy.ma.masked
+        lu = ds.createVariable("LU_INDEX", "i4", ("south_north",))
+        lu[:] = numpy.arange(5)
+        ds.createVariable("P_TOP", "f4", ())[...] = 5000.0
+
+
+def test_compress_file(tmp_path):
+    path = tmp_path / "wrfout_d01"
+    make_netcdf3_file(path, format="NETCDF3_64BIT_OFFSET")
+    assert netcdf_format(path) == "NETCDF3_64BIT_OFFSET"
+
+    assert compress_file(path)
+
+    assert netcdf_format(path) == "NETCDF4"
+    assert list(tmp_path.iterdir()) == [path]
+    with netCDF4.Dataset(path) as ds:
+        assert ds.TITLE == "OUTPUT FROM WRF"
+        assert ds.dimensions["Time"].isunlimited()
+        assert list(netCDF4.chartostring(ds["Times"][:])) == [
+            "2022-07-22_00:00:00",
+            "2022-07-22_01:00:00",
+        ]
+        t2 = ds["T2"]
+        assert t2.units == "K"
+        assert t2.filters()["zlib"]
+        assert t2[1, 0] is numpy.ma.masked
+        npt.assert_array_equal(t2[0], numpy.arange(5, dtype="f4") + 280.123)
+        npt.assert_array_equal(ds["LU_INDEX"][:], numpy.arange(5))
+        assert ds["P_TOP"].getValue() == 5000.0
+
+    # Files which are already compressed are skipped
+    assert not compress_file(path)
+
+
+def test_compress_file_quantize(tmp_path):
+    path = tmp_path / "wrfout_d01"
+    make_netcdf3_file(path)
+
+    compress_file(path, NetCDFEncoding(significant_digits=2))
+
+    with netCDF4.Dataset(path) as ds:
+        t2 = ds["T2"][0]
+        assert not numpy.array_equal(t2, numpy.arange(5, dtype="f4") + 280.123)
+        npt.assert_allclose(t2, numpy.arange(5) + 280.123, rtol=1e-2)
+
+
+def test_compress_files(tmp_path):
+    (tmp_path / "run").mkdir()
+    for name in ["wrfout_d01", "wrfout_d02", "run/geo_em.d01.nc"]:
+        make_netcdf3_file(tmp_path / name)
+    (tmp_path / "run.sh").write_text("#!/bin/bash\n")
+
+    compressed = compress_files([tmp_path], workers=2)
+
+    assert compressed == [
+        tmp_path / "run/geo_em.d01.nc",
+        tmp_path / "wrfout_d01",
+        tmp_path / "wrfout_d02",
+    ]
+    assert all(netcdf_format(path) == "NETCDF4" for path in compressed)
+    assert netcdf_format(tmp_path / "run.sh") is None
+    assert compress_files([tmp_path]) == []
@@ -0,0 +1,206 @@
+import asyncio
+import datetime
+import fcntl
+import hashlib
+import os
+import time
+
+import pytest
+
+from setup_runs.wrf import fetch_fnl
+from setup_runs.wrf.fetch_fnl import (
+    PART_SUFFIX,
+    BandwidthLimit,
+    create_session,
+    download_file,
+    download_files_async,
+    download_gdas_fnl_data,
+)
+from setup_runs.wrf.fnl_cache import AnalysisCache
+from setup_runs.wrf.integrity import Manifest
+
+
+def grib2_message(length: int, fill: int = 0) -> bytes:
+    """Minimal GRIB2 message: indicator section, padding and end marker"""
+    header = b"GRIB\0\0\0\x02" + length.to_bytes(8, "big")
+    return header + bytes([fill]) * (length - len(header) - 4) + b"7777"
+
+
+CONTENT = b"".join(grib2_message(64 * 1024, fill=i) for i in range(16))
+FILENAME = "gdas1.fnl0p25.2022072200.f00.grib2"
+
+
+@pytest.fixture
+def server(http_server):
+    http_server.files[FILENAME] = CONTENT
+    return http_server
+
+
+def url(server, filename=FILENAME):
+    return f"http://127.0.0.1:{server.server_port}/{filename}"
+
+
+def test_download_file(server, tmp_path):
+    filename = download_file(create_session(), str(tmp_path), url(server))
+
+    assert filename == str(tmp_path / FILENAME)
+    assert (tmp_path / FILENAME).read_bytes() == CONTENT
+    assert not os.path.exists(filename + PART_SUFFIX)
+    assert server.requests == [None]
+
+
+def test_download_file_resume(server, tmp_path):
+    server.drops = 2
+
+    filename = download_file(
+        create_session(), str(tmp_path), url(server), chunk_size=1024
+    )
+
+    assert (tmp_path / FILENAME).read_bytes() == CONTENT
+    assert server.requests[0] is None
+    assert all(r.startswith("bytes=") for r in server.requests[1:])
+    assert not os.path.exists(filename + PART_SUFFIX)
+    # the checksum computed while resuming covers the whole file
+    entry = Manifest(tmp_path).lookup(filename)
+    assert entry["sha256"] == hashlib.sha256(CONTENT).hexdigest()
+    assert entry["messages"] == 16
+
+
+def test_download_file_existing_part(server, tmp_path):
+    (tmp_path / (FILENAME + PART_SUFFIX)).write_bytes(CONTENT[:1000])
+
+    download_file(create_session(), str(tmp_path), url(server))
+
+    assert (tmp_path / FILENAME).read_bytes() == CONTENT
+    assert server.requests == ["bytes=1000-"]
+    entry = Manifest(tmp_path).lookup(FILENAME)
+    assert entry["sha256"] == hashlib.sha256(CONTENT).hexdigest()
+
+
+def test_download_file_corrupt(server, tmp_path):
+    server.files[FILENAME] = b"<html>Service unavailable</html>"
+
+    with pytest.raises(RuntimeError, match="corrupt"):
+        download_file(create_session(), str(tmp_path), url(server))
+
+    assert not (tmp_path / FILENAME).exists()
+    assert Manifest(tmp_path).lookup(FILENAME) is None
+
+
+def test_download_file_complete_part(server, tmp_path):
+    (tmp_path / (FILENAME + PART_SUFFIX)).write_bytes(CONTENT)
+
+    download_file(create_session(), str(tmp_path), url(server))
+
+    assert (tmp_path / FILENAME).read_bytes() == CONTENT
+
+
+def test_download_file_gives_up(server, tmp_path):
+    server.drops = 10
+
+    with pytest.raises(RuntimeError, match="Error downloading"):
+        download_file(
+            create_session(),
+            str(tmp_path),
+            url(server),
+            chunk_size=1024,
+            max_attempts=2,
+        )
+
+    # the partial download is kept so it can be resumed later
+    part = tmp_path / (FILENAME + PART_SUFFIX)
+    assert 0 < part.stat().st_size < len(CONTENT)
+    assert not (tmp_path / FILENAME).exists()
+
+
+def test_download_file_missing(server, tmp_path):
+    with pytest.raises(RuntimeError, match="Error downloading"):
+        download_file(create_session(), str(tmp_path), url(server, "missing.grib2"))
+
+
+def test_download_gdas_fnl_data_cached(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch_fnl, "DATASET_URL", url(server, ""))
+    cache = AnalysisCache(tmp_path / "cache")
+    download_dts = [datetime.datetime(2022, 7, 22, tzinfo=datetime.timezone.utc)]
+
+    for job in ["job1", "job2"]:
+        (tmp_path / job).mkdir()
+        files = download_gdas_fnl_data(str(tmp_path / job), download_dts, cache=cache)
+        assert files == [str(tmp_path / job / FILENAME)]
+        assert (tmp_path / job / FILENAME).read_bytes() == CONTENT
+
+    # the second job used the cached file
+    assert len(server.requests) == 1
+    assert cache.get(f"ds083.3/2022/202207/{FILENAME}") is not None
+
+
+def test_download_gdas_fnl_data_unlocked(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch_fnl, "DATASET_URL", url(server, ""))
+    cache = AnalysisCache(tmp_path / "cache")
+    download_dts = [datetime.datetime(2022, 7, 22, tzinfo=datetime.timezone.utc)]
+    locked_during_download = []
+
+    def download(*args):
+        # Other jobs can use the cache while the files are downloaded
+        with open(cache.cache_dir / ".lock", "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(f, fcntl.LOCK_UN)
+            except BlockingIOError:
+                locked_during_download.append(args[2])
+        return download_file(*args)
+
+    monkeypatch.setattr(
+        fetch_fnl, "fnl_downloader", lambda vtable: (download, "ds083.3")
+    )
+    (tmp_path / "job").mkdir()
+    files = download_gdas_fnl_data(str(tmp_path / "job"), download_dts, cache=cache)
+
+    assert locked_during_download == []
+    assert (tmp_path / "job" / FILENAME).read_bytes() == CONTENT
+    # The file was moved from the staging area into the cache
+    assert cache.files() == [cache.path(f"ds083.3/2022/202207/{FILENAME}")]
+    assert os.path.samefile(files[0], cache.files()[0])
+    assert not cache.staging_path(f"ds083.3/2022/202207/{FILENAME}").exists()
+
+
+def test_download_files_async(server, tmp_path, capsys):
+    server.delay = 0.1
+    downloads = []
+    for i in range(6):
+        (tmp_path / str(i)).mkdir()
+        downloads.append((url(server, f"{i}/{FILENAME}"), str(tmp_path / str(i))))
+
+    files = asyncio.run(
+        download_files_async(create_session(), downloads, max_per_host=2)
+    )
+
+    assert files == [str(tmp_path / str(i) / FILENAME) for i in range(6)]
+    assert all((tmp_path / str(i) / FILENAME).read_bytes() == CONTENT for i in range(6))
+    assert server.max_active == 2
+    assert "Downloaded 6 files" in capsys.readouterr().out
+
+
+def test_download_files_async_failure(server, tmp_path):
+    downloads = [
+        (url(server), str(tmp_path)),
+        (url(server, "missing.grib2"), str(tmp_path)),
+    ]
+
+    with pytest.raises(RuntimeError, match="missing.grib2"):
+        asyncio.run(download_files_async(create_session(), downloads))
+
+
+def test_bandwidth_limit(server, tmp_path):
+    bandwidth = BandwidthLimit(bytes_per_second=4 * len(CONTENT))
+    start = time.monotonic()
+
+    filename = download_file(
+        create_session(bandwidth=bandwidth), str(tmp_path), url(server)
+    )
+
+    assert time.monotonic() - start >= 0.2
+    assert (tmp_path / FILENAME).read_bytes() == CONTENT
+    assert filename == str(tmp_path / FILENAME)
+    with pytest.raises(ValueError):
+        BandwidthLimit(0)
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+from setup_runs.wrf.fnl_cache import AnalysisCache
+from setup_runs.wrf.integrity import Manifest
+
+KEY = "ds083.3/2022/202207/gdas1.fnl0p25.2022072200.f00.grib2"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AnalysisCache(tmp_path / "cache", max_bytes=250)
+
+
+def add(cache, key, size, mtime):
+    path = cache.path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix == ".grib2":
+        # a single minimal GRIB2 message
+        header = b"GRIB\0\0\0\x02" + size.to_bytes(8, "big")
+        path.write_bytes(header + b"\0" * (size - len(header) - 4) + b"7777")
+    else:
+        path.write_bytes(b"\0" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_get(cache):
+    assert cache.get(KEY) is None
+
+    path = add(cache, KEY, 100, mtime=1000)
+    assert cache.get(KEY) == path
+    # marked as recently used
+    assert path.stat().st_atime > 1000
+    assert path.stat().st_mtime == 1000
+
+
+def test_link(cache, tmp_path):
+    path = add(cache, KEY, 100, mtime=1000)
+    job_dir = tmp_path / "job"
+    job_dir.mkdir()
+
+    linked = cache.link(KEY, job_dir)
+
+    assert linked == str(job_dir / path.name)
+    assert os.path.samefile(linked, path)
+    # linking again replaces the existing link
+    assert cache.link(KEY, job_dir) == linked
+
+    # a hard link survives the file being removed from the cache
+    path.unlink()
+    assert os.path.getsize(linked) == 100
+
+
+def test_evict(cache):
+    oldest = add(cache, "ds083.3/a.grib2", 100, mtime=1000)
+    in_use = add(cache, "ds083.3/b.grib2", 100, mtime=2000)
+    newest = add(cache, "ds083.3/c.grib2", 100, mtime=3000)
+    partial = add(cache, "ds083.3/d.grib2.part", 10, mtime=500)
+
+    assert cache.size() == 310
+    assert cache.files() == [oldest, in_use, newest]
+
+    removed = cache.evict(keep=[oldest])
+
+    assert removed == [in_use]
+    assert oldest.exists() and newest.exists() and partial.exists()
+    assert cache.size() == 210
+
+
+def test_evict_unlimited(tmp_path):
+    cache = AnalysisCache(tmp_path / "cache")
+    add(cache, KEY, 1000, mtime=1000)
+
+    assert cache.evict() == []
+
+
+def test_get_corrupt(cache):
+    path = add(cache, KEY, 100, mtime=1000)
+    assert cache.get(KEY) == path
+
+    # truncate the file after it was recorded in the manifest
+    path.write_bytes(path.read_bytes()[:50])
+
+    assert cache.get(KEY) is None
+    assert not path.exists()
+
+
+def test_add(cache):
+    assert cache.add(KEY) is None
+
+    staged = cache.staging_path(KEY)
+    staged.parent.mkdir(parents=True)
+    staged.write_bytes(add(cache, KEY, 100, mtime=1000).read_bytes())
+    cache.path(KEY).unlink()
+    # Incomplete downloads aren't recorded in the manifest of the staging area
+    assert cache.add(KEY) is None
+    # and aren't part of the cache
+    assert cache.files() == []
+
+    Manifest(staged.parent).verify(staged)
+    path = cache.add(KEY)
+
+    assert path == cache.path(KEY)
+    assert cache.get(KEY) == path
+    assert not staged.exists()
+    assert Manifest(staged.parent).lookup(staged) is None
@@ -0,0 +1,93 @@
+import os
+import shutil
+
+import f90nml
+import pytest
+
+from setup_runs.wrf.geo_em_store import (
+    SETTINGS_FILENAME,
+    GeoEmStore,
+    geometry_key,
+    geometry_settings,
+)
+
+
+@pytest.fixture
+def namelist(root_dir):
+    return f90nml.read(os.path.join(root_dir, "domains/aust-test/namelist.wps"))
+
+
+@pytest.fixture
+def geogrid_tbl(tmp_path):
+    path = tmp_path / "GEOGRID.TBL"
+    path.write_text("name = HGT_M")
+    return path
+
+
+def test_geometry_key_invariant(namelist, geogrid_tbl):
+    key = geometry_key(namelist, geogrid_tbl)
+
+    namelist["share"]["start_date"] = "2000-01-01_00:00:00"
+    namelist["geogrid"]["geog_data_path"] = "/elsewhere/geog"
+    # Settings of domains beyond max_dom are ignored
+    namelist["geogrid"]["parent_id"] = [1, 1]
+    # Numbers and strings are compared in canonical form
+    namelist["geogrid"]["dx"] = float(namelist["geogrid"]["dx"])
+    namelist["geogrid"]["map_proj"] = namelist["geogrid"]["map_proj"].upper()
+
+    assert geometry_key(namelist, geogrid_tbl) == key
+
+
+def test_geometry_key_changes(namelist, geogrid_tbl, tmp_path):
+    key = geometry_key(namelist, geogrid_tbl)
+
+    other_tbl = tmp_path / "OTHER.TBL"
+    other_tbl.write_text("name = LANDUSEF")
+    assert geometry_key(namelist, other_tbl) != key
+
+    namelist["geogrid"]["dx"] = namelist["geogrid"]["dx"] * 2
+    assert geometry_key(namelist, geogrid_tbl) != key
+
+
+def test_store(namelist, tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    files = []
+    for filename in ["geo_em.d01.nc", "geo_em.d02.nc"]:
+        (source_dir / filename).write_bytes(b"data")
+        files.append(source_dir / filename)
+    store = GeoEmStore(tmp_path / "store")
+
+    assert not store.contains("key", 2)
+    with store.lock("key"):
+        store.add("key", files, settings=geometry_settings(namelist))
+
+    assert store.contains("key", 2)
+    assert not store.contains("key", 3)
+    assert (store.path("key") / SETTINGS_FILENAME).exists()
+    # The source files are left in place
+    assert all(path.exists() for path in files)
+
+    run_dir = tmp_path / "run"
+    run_dir.mkdir()
+    store.link("key", 2, run_dir)
+    # Linking again replaces the existing links
+    linked = store.link("key", 2, run_dir)
+
+    assert [os.path.basename(path) for path in linked] == [
+        "geo_em.d01.nc",
+        "geo_em.d02.nc",
+    ]
+    shutil.rmtree(source_dir)
+    assert (run_dir / "geo_em.d02.nc").read_bytes() == b"data"
+
+
+def test_store_move(tmp_path):
+    src = tmp_path / "geo_em.d01.nc"
+    src.write_bytes(b"data")
+    store = GeoEmStore(tmp_path / "store")
+
+    store.add("key", [src], move=True)
+
+    assert not src.exists()
+    assert store.contains("key", 1)
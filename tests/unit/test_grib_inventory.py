@@ -0,0 +1,171 @@
+import pytest
+
+from setup_runs.wrf.fetch_fnl import create_session
+from setup_runs.wrf.grib_inventory import (
+    download_grib_subset,
+    merge_ranges,
+    parse_inventory,
+    parse_vtable,
+    select_records,
+)
+
+FILENAME = "gdas1.fnl0p25.2022072200.f00.grib2"
+
+VTABLE = """\
+GRIB1| Level| From |  To  | metgrid  | metgrid | metgrid                                 |GRIB2|GRIB2|GRIB2|GRIB2|
+Param| Type |Level1|Level2| Name     | Units   | Description                             |Discp|Catgy|Param|Level|
+-----+------+------+------+----------+---------+-----------------------------------------+-----------------------+
+  11 | 100  |   *  |      | TT       | K       | Temperature                             |  0  |  0  |  0  | 100 |
+  11 | 105  |   2  |      | TT       | K       | Temperature       at 2 m                |  0  |  0  |  0  | 103 |
+   1 |   1  |   0  |      | PSFC     | Pa      | Surface Pressure                        |  0  |  3  |  0  |   1 |
+  33 |   6  |   0  |      | UMAXW    | m s-1   | U                 at max wind           |  0  |  2  |  2  |   6 |
+  11 |   7  |   0  |      | TTROP    | K       | Temperature at tropopause               |  0  |  0  |  0  |   7 |
+ 144 | 112  |   0  |  10  | SM000010 | fraction| Soil Moist 0-10 cm below grn layer (Up) |  2  |  0  | 192 | 106 |
+ 999 |   1  |   0  |      | GRIB1    | -       | GRIB1 only                              |     |     |     |     |
+-----+------+------+------+----------+---------+-----------------------------------------+-----------------------+
+"""
+
+MESSAGES = [
+    ("TMP", "1000 mb"),
+    ("TMP", "500 mb"),
+    ("RH", "500 mb"),
+    ("TMP", "2 m above ground"),
+    ("TMP", "80 m above ground"),
+    ("PRES", "surface"),
+    ("UGRD", "max wind"),
+    ("TMP", "tropopause"),
+    ("SOILW", "0-0.1 m below ground"),
+    ("SOILW", "0.1-0.4 m below ground"),
+]
+
+
+def grib2_message(length: int, fill: int = 0) -> bytes:
+    """Minimal GRIB2 message: indicator section, padding and end marker"""
+    header = b"GRIB\0\0\0\x02" + length.to_bytes(8, "big")
+    return header + bytes([fill]) * (length - len(header) - 4) + b"7777"
+
+
+def make_grib():
+    """Fake GRIB2 file with 100 byte messages and its inventory"""
+    content = b""
+    lines = []
+    for number, (variable, level) in enumerate(MESSAGES, start=1):
+        lines.append(f"{number}:{len(content)}:d=2022072200:{variable}:{level}:anl:")
+        content += grib2_message(100, fill=number)
+    return content, "\n".join(lines) + "\n"
+
+
+@pytest.fixture
+def entries():
+    return parse_vtable(VTABLE)
+
+
+def test_parse_vtable(entries):
+    assert [entry.name for entry in entries] == [
+        "TT",
+        "TT",
+        "PSFC",
+        "UMAXW",
+        "TTROP",
+        "SM000010",
+    ]
+    assert entries[5].discipline == 2
+    assert entries[5].parameter == 192
+    assert entries[5].level_type == 106
+    assert (entries[5].level1, entries[5].level2) == ("0", "10")
+
+
+def test_parse_inventory():
+    records = parse_inventory(
+        "1:0:d=2022072200:HGT:1000 mb:anl:\n"
+        "2.1:100:d=2022072200:UGRD:10 m above ground:anl:\n"
+        "2.2:100:d=2022072200:VGRD:10 m above ground:anl:\n"
+        "3:250:d=2022072200:TMP:surface:anl:\n"
+    )
+
+    assert [r.number for r in records] == [1, 2, 2, 3]
+    assert [(r.offset, r.end) for r in records] == [
+        (0, 99),
+        (100, 249),
+        (100, 249),
+        (250, None),
+    ]
+    assert records[1].variable == "UGRD"
+    assert records[1].level == "10 m above ground"
+
+
+def test_select_records(entries):
+    _, inventory = make_grib()
+    selected = select_records(parse_inventory(inventory), entries)
+
+    assert [(r.variable, r.level) for r in selected] == [
+        ("TMP", "1000 mb"),
+        ("TMP", "500 mb"),
+        ("TMP", "2 m above ground"),
+        ("PRES", "surface"),
+        ("UGRD", "max wind"),
+        ("TMP", "tropopause"),
+        ("SOILW", "0-0.1 m below ground"),
+    ]
+
+
+def test_select_records_unknown(entries, capsys):
+    _, inventory = make_grib()
+    entries[0].parameter = 250
+    entries[3].level_type = 250
+
+    # Only the unknown entries are skipped
+    selected = select_records(parse_inventory(inventory), entries)
+    assert [(r.variable, r.level) for r in selected] == [
+        ("TMP", "2 m above ground"),
+        ("PRES", "surface"),
+        ("TMP", "tropopause"),
+        ("SOILW", "0-0.1 m below ground"),
+    ]
+    output = capsys.readouterr().out
+    assert "Skipping TT" in output and "Skipping UMAXW" in output
+
+    for entry in entries:
+        entry.parameter = 250
+    assert select_records(parse_inventory(inventory), entries) is None
+
+
+def test_merge_ranges():
+    records = parse_inventory(make_grib()[1])
+
+    assert merge_ranges([records[0], records[1], records[3], records[9]]) == [
+        (0, 199),
+        (300, 399),
+        (900, None),
+    ]
+
+
+def test_download_grib_subset(http_server, tmp_path, entries):
+    content, inventory = make_grib()
+    http_server.files[FILENAME] = content
+    http_server.files[FILENAME + ".idx"] = inventory.encode()
+    url = f"http://127.0.0.1:{http_server.server_port}/{FILENAME}"
+
+    filename = download_grib_subset(
+        create_session(), str(tmp_path), url, entries=entries
+    )
+
+    assert filename == str(tmp_path / FILENAME)
+    expected = b"".join(content[i * 100 : (i + 1) * 100] for i in [0, 1, 3, 5, 6, 7, 8])
+    assert (tmp_path / FILENAME).read_bytes() == expected
+    assert http_server.requests == [
+        None,
+        "bytes=0-199",
+        "bytes=300-399",
+        "bytes=500-899",
+    ]
+
+
+def test_download_grib_subset_no_inventory(http_server, tmp_path, entries):
+    content, _ = make_grib()
+    http_server.files[FILENAME] = content
+    url = f"http://127.0.0.1:{http_server.server_port}/{FILENAME}"
+
+    download_grib_subset(create_session(), str(tmp_path), url, entries=entries)
+
+    assert (tmp_path / FILENAME).read_bytes() == content
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from setup_runs.wrf.integrity import (
+    InvalidGribFile,
+    Manifest,
+    count_grib2_messages,
+    sha256sum,
+)
+
+
+def grib2_message(length: int, fill: int = 0) -> bytes:
+    """Minimal GRIB2 message: indicator section, padding and end marker"""
+    header = b"GRIB\0\0\0\x02" + length.to_bytes(8, "big")
+    return header + bytes([fill]) * (length - len(header) - 4) + b"7777"
+
+
+@pytest.fixture
+def grib_file(tmp_path):
+    path = tmp_path / "gdas1.fnl0p25.2022072200.f00.grib2"
+    path.write_bytes(grib2_message(100) + grib2_message(200, fill=1))
+    return path
+
+
+def test_count_grib2_messages(grib_file):
+    assert count_grib2_messages(grib_file) == 2
+
+
+@pytest.mark.parametrize(
+    "content, match",
+    [
+        (b"", "no GRIB messages"),
+        (b"<html>Not found</html>", "no GRIB message at byte 0"),
+        (grib2_message(100)[:80], "at byte 0 is truncated"),
+        (grib2_message(100)[:10], "no GRIB message at byte 0"),
+        (grib2_message(100) + grib2_message(200)[:150], "at byte 100 is truncated"),
+        (grib2_message(100)[:-4] + b"0000", "has no end marker"),
+        (b"GRIB\0\0\0\x01" + grib2_message(100)[8:], "GRIB edition 1"),
+    ],
+)
+def test_count_grib2_messages_invalid(tmp_path, content, match):
+    path = tmp_path / "invalid.grib2"
+    path.write_bytes(content)
+
+    with pytest.raises(InvalidGribFile, match=match):
+        count_grib2_messages(path)
+
+
+def test_manifest_record(grib_file):
+    manifest = Manifest(grib_file.parent)
+
+    entry = manifest.record(grib_file, sha256sum(grib_file))
+
+    assert entry["messages"] == 2
+    assert entry["size"] == 300
+    assert Manifest(grib_file.parent).lookup(grib_file) == entry
+
+    manifest.remove(grib_file)
+    assert manifest.lookup(grib_file) is None
+
+
+def test_manifest_verify(grib_file):
+    manifest = Manifest(grib_file.parent)
+
+    # an unrecorded file is checked and recorded
+    assert manifest.verify(grib_file)
+    assert manifest.lookup(grib_file)["sha256"] == sha256sum(grib_file)
+
+    # touched but unchanged
+    os.utime(grib_file, (1000, 1000))
+    assert manifest.verify(grib_file)
+    assert manifest.lookup(grib_file)["mtime_ns"] == 1000 * 10**9
+
+    # changed contents no longer match the recorded checksum
+    content = bytearray(grib_file.read_bytes())
+    content[50] = 1
+    grib_file.write_bytes(content)
+    assert not manifest.verify(grib_file)
+
+
+def test_manifest_verify_invalid(tmp_path):
+    path = tmp_path / "truncated.grib2"
+    path.write_bytes(grib2_message(100)[:60])
+    manifest = Manifest(tmp_path)
+
+    assert not manifest.verify(path)
+    assert not manifest.verify(tmp_path / "missing.grib2")
+    assert manifest.lookup(path) is None
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from setup_runs.utils import fingerprint
+from setup_runs.wrf.journal import (
+    DONE,
+    PENDING,
+    PROCESSING,
+    ProcessingJournal,
+)
+
+
+@pytest.fixture
+def journal(tmp_path):
+    with ProcessingJournal(tmp_path / "journal.sqlite") as journal:
+        yield journal
+
+
+@pytest.fixture
+def wrfout(tmp_path):
+    path = tmp_path / "wrfout_d01_2022-07-22_00:00:00"
+    path.write_bytes(b"\0" * 16)
+    return path
+
+
+def test_record(journal, wrfout):
+    assert journal.lookup(wrfout) is None
+
+    entry = journal.record(wrfout, PENDING, nsteps=12)
+    assert entry.matches(fingerprint(wrfout))
+    assert journal.lookup(wrfout) == entry
+
+    # The step count is kept while the file is unchanged
+    entry = journal.record(wrfout, DONE, output="WRFOUT.nc")
+    assert entry.nsteps == 12
+    assert journal.entries(DONE) == [entry]
+    assert journal.entries(PENDING) == []
+
+
+def test_record_changed(journal, wrfout):
+    journal.record(wrfout, PENDING, nsteps=6)
+    wrfout.write_bytes(b"\0" * 32)
+
+    entry = journal.record(wrfout, PENDING, file_fingerprint=fingerprint(wrfout))
+    assert entry.size == 32
+    assert entry.nsteps is None
+
+
+def test_record_invalid_state(journal, wrfout):
+    with pytest.raises(ValueError, match="state must be one of"):
+        journal.record(wrfout, "unknown")
+
+
+def test_persistent(tmp_path, wrfout):
+    with ProcessingJournal(tmp_path / "journal.sqlite") as journal:
+        journal.record(wrfout, DONE, nsteps=12)
+    with ProcessingJournal(tmp_path / "journal.sqlite") as journal:
+        assert journal.lookup(wrfout).state == DONE
+
+
+def test_recover(journal, wrfout, tmp_path):
+    partial = tmp_path / "WRFOUT_d01_2022-07-22T0000Z.nc"
+    partial.write_bytes(b"partial")
+    journal.record(wrfout, PROCESSING, nsteps=12, output=str(partial))
+
+    recovered = journal.recover()
+
+    assert [entry.path for entry in recovered] == [str(wrfout)]
+    assert journal.lookup(wrfout).state == PENDING
+    assert journal.lookup(wrfout).nsteps == 12
+    assert not os.path.exists(partial)
+    assert journal.recover() == []
@@ -0,0 +1,70 @@
+import copy
+import io
+import os
+
+import f90nml
+import pytest
+
+from setup_runs.wrf.namelists import NamelistRenderer
+
+TIME_VARIABLES = [
+    ("time_control", f"{prefix}_{unit}")
+    for prefix in ["start", "end"]
+    for unit in ["year", "month", "day", "hour", "minute", "second"]
+]
+
+
+def write_with_f90nml(namelist, values):
+    namelist = copy.deepcopy(namelist)
+    for (group, name), value in values.items():
+        namelist[group][name] = value
+    stream = io.StringIO()
+    namelist.write(stream)
+    return stream.getvalue()
+
+
+@pytest.mark.parametrize("domain", ["aust-test", "aust10km"])
+def test_render_wrf_namelist(root_dir, domain):
+    WRFnml = f90nml.read(os.path.join(root_dir, "domains", domain, "namelist.wrf"))
+    template = copy.deepcopy(WRFnml)
+    variables = TIME_VARIABLES + [
+        ("time_control", "restart"),
+        ("domains", "num_metgrid_levels"),
+        # not in the template namelists
+        ("domains", "num_metgrid_soil_levels"),
+    ]
+    renderer = NamelistRenderer(WRFnml, variables)
+
+    for day, nDom in [(1, 1), (2, 3), (3, 40)]:
+        values = {variable: [day] * nDom for variable in TIME_VARIABLES}
+        values[("time_control", "restart")] = day == 2
+        values[("domains", "num_metgrid_levels")] = 27
+        values[("domains", "num_metgrid_soil_levels")] = 4
+
+        assert renderer.render(values) == write_with_f90nml(WRFnml, values)
+    # The template isn't modified
+    assert WRFnml == template
+
+
+def test_render_wps_namelist(root_dir):
+    WPSnml = f90nml.read(os.path.join(root_dir, "domains/aust-test/namelist.wps"))
+    renderer = NamelistRenderer(
+        WPSnml,
+        [
+            ("share", "start_date"),
+            ("share", "end_date"),
+            ("ungrib", "prefix"),
+            ("metgrid", "fg_name"),
+        ],
+    )
+    values = {
+        ("share", "start_date"): ["2022-07-22_00:00:00"] * 4,
+        ("share", "end_date"): ["2022-07-23_00:00:00"] * 4,
+        ("ungrib", "prefix"): "ERA",
+        # Without the SST intermediate files
+        ("metgrid", "fg_name"): ["ERA"],
+    }
+
+    assert renderer.render(values) == write_with_f90nml(WPSnml, values)
+    with pytest.raises(KeyError, match="prefix"):
+        renderer.render({("share", "start_date"): "2022-07-22_00:00:00"})
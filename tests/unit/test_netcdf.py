@@ -0,0 +1,57 @@
+import numpy
+import pytest
+
+from setup_runs.netcdf import NetCDFEncoding, parse_chunk_sizes
+
+
+def test_parse_chunk_sizes():
+    assert parse_chunk_sizes("Time=1, bottom_top=4") == {"Time": 1, "bottom_top": 4}
+    assert parse_chunk_sizes("") == {}
+    assert parse_chunk_sizes(None) == {}
+
+    with pytest.raises(ValueError, match="dimension=length"):
+        parse_chunk_sizes("Time")
+
+
+def test_default_encoding():
+    encoding = NetCDFEncoding()
+    dims = ("Time", "south_north", "west_east")
+
+    assert encoding.variable_kwargs(numpy.dtype("f4"), dims, [1, 5, 6]) == {
+        "zlib": True,
+        "complevel": 4,
+        "shuffle": True,
+    }
+    assert encoding.variable_kwargs(numpy.dtype("i4"), dims, [1, 5, 6]) == {}
+
+
+def test_encoding_options():
+    encoding = NetCDFEncoding(
+        complevel=1,
+        shuffle=False,
+        compressed_dtypes=None,
+        chunk_sizes={"Time": 1, "south_north": 10},
+        significant_digits=3,
+    )
+    dims = ("Time", "south_north", "west_east")
+
+    assert encoding.variable_kwargs(numpy.dtype("f4"), dims, [1, 5, 6]) == {
+        "zlib": True,
+        "complevel": 1,
+        "shuffle": False,
+        "chunksizes": [1, 5, 6],
+        "significant_digits": 3,
+        "quantize_mode": "BitGroom",
+    }
+    # quantization only applies to floating point variables
+    assert encoding.variable_kwargs(numpy.dtype("i4"), dims, [1, 5, 6]) == {
+        "zlib": True,
+        "complevel": 1,
+        "shuffle": False,
+        "chunksizes": [1, 5, 6],
+    }
+
+
+def test_encoding_validation():
+    with pytest.raises(ValueError):
+        NetCDFEncoding(complevel=10)
@@ -0,0 +1,105 @@
+import datetime
+import time
+
+import pytest
+
+from setup_runs.wrf import fetch_fnl
+from setup_runs.wrf.fetch_fnl import download_gdas_fnl_data
+from setup_runs.wrf.fnl_cache import AnalysisCache
+from setup_runs.wrf.prefetch import AnalysisPrefetcher
+
+
+def grib2_message(length: int) -> bytes:
+    """Minimal GRIB2 message: indicator section, padding and end marker"""
+    header = b"GRIB\0\0\0\x02" + length.to_bytes(8, "big")
+    return header + b"\0" * (length - len(header) - 4) + b"7777"
+
+
+CONTENT = grib2_message(64 * 1024)
+
+TIMES = [
+    datetime.datetime(2022, 7, 22, hour, tzinfo=datetime.timezone.utc)
+    for hour in (0, 6)
+]
+
+
+def cache_key(analysis_time):
+    return analysis_time.strftime("ds083.3/%Y/%Y%m/gdas1.fnl0p25.%Y%m%d%H.f00.grib2")
+
+
+def wait_until(condition, timeout=10):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "Timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def server(http_server, monkeypatch):
+    for analysis_time in TIMES:
+        filename = analysis_time.strftime("gdas1.fnl0p25.%Y%m%d%H.f00.grib2")
+        http_server.files[filename] = CONTENT
+    monkeypatch.setattr(
+        fetch_fnl, "DATASET_URL", f"http://127.0.0.1:{http_server.server_port}/"
+    )
+    return http_server
+
+
+def test_prefetch(server, tmp_path):
+    cache = AnalysisCache(tmp_path / "cache")
+    prefetcher = AnalysisPrefetcher(cache, max_bytes=10 * len(CONTENT))
+    prefetcher.add_window(TIMES[:1])
+    prefetcher.add_window(TIMES[1:])
+
+    with prefetcher:
+        wait_until(lambda: prefetcher.pending_bytes == 2 * len(CONTENT))
+    assert len(server.requests) == 2
+
+    # The job finds its analyses in the cache
+    prefetcher.claim(TIMES[:1])
+    (tmp_path / "job").mkdir()
+    download_gdas_fnl_data(str(tmp_path / "job"), TIMES, cache=cache)
+    assert len(server.requests) == 2
+    assert prefetcher.pending_bytes == len(CONTENT)
+
+
+def test_prefetch_budget(server, tmp_path):
+    cache = AnalysisCache(tmp_path / "cache")
+    prefetcher = AnalysisPrefetcher(cache, max_bytes=1, concurrency=1)
+    prefetcher.add_window(TIMES[:1])
+    prefetcher.add_window(TIMES[1:])
+
+    with prefetcher:
+        wait_until(lambda: prefetcher.pending_bytes > 0)
+        time.sleep(0.2)
+        # The first window uses up the budget until it is claimed
+        assert cache.get(cache_key(TIMES[1])) is None
+
+        prefetcher.claim(TIMES[:1])
+        wait_until(lambda: prefetcher.pending_bytes > 0)
+    assert cache.get(cache_key(TIMES[1])) is not None
+
+
+def test_prefetch_claimed(server, tmp_path):
+    cache = AnalysisCache(tmp_path / "cache")
+    prefetcher = AnalysisPrefetcher(cache, max_bytes=10 * len(CONTENT))
+    prefetcher.add_window(TIMES)
+    # The job started downloading the window itself
+    prefetcher.claim(TIMES)
+
+    with prefetcher:
+        pass
+
+    assert server.requests == []
+
+
+def test_prefetch_error(http_server, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(
+        fetch_fnl, "DATASET_URL", f"http://127.0.0.1:{http_server.server_port}/"
+    )
+    prefetcher = AnalysisPrefetcher(AnalysisCache(tmp_path / "cache"), max_bytes=1)
+    prefetcher.add_window(TIMES)
+
+    prefetcher.run()
+
+    assert "Stopped prefetching" in capsys.readouterr().out
@@ -1,12 +1,20 @@
+import json
 import pytest
 import os
+import shutil
 from setup_runs.config_read_functions import (
+    SubstitutionError,
     add_environment_variables,
     substitute_variables,
     boolean_converter,
     process_date_string,
 )
-from setup_runs.wrf.read_config_wrf import load_wrf_config, WRFConfig
+from setup_runs.wrf.read_config_wrf import (
+    compile_wrf_config,
+    compiled_config_path,
+    load_wrf_config,
+    WRFConfig,
+)
 from setup_runs.config_read_functions import load_json
 from attrs import asdict
 
@@ -71,6 +79,29 @@ def test_substitute_variables():
     assert out == expected
 
 
+def test_substitute_variables_chain():
+    # A chain far longer than the number of passes the substitution used to make
+    config = {f"level_{i}": f"${{level_{i - 1}}}/{i}" for i in range(1, 500)}
+    config["level_0"] = "root"
+    config["num_levels"] = 500
+    config["summary"] = "${level_3} of ${num_levels}"
+
+    out = substitute_variables(config)
+
+    assert out["level_499"] == "/".join(["root"] + [str(i) for i in range(1, 500)])
+    assert out["summary"] == "root/1/2/3 of 500"
+
+
+def test_substitute_variables_errors():
+    with pytest.raises(SubstitutionError, match="undefined variable: run_name"):
+        substitute_variables({"run_dir": "/scratch/${run_name}"})
+
+    with pytest.raises(SubstitutionError, match="cycle: a -> b -> c -> a"):
+        substitute_variables(
+            {"a": "${b}/a", "b": "${c}/b", "c": "${a}/c", "d": "${a}/d"}
+        )
+
+
 def test_parse_boolean_keys():
     config = {
         "test_key_1": "t",
@@ -245,3 +276,34 @@ def test_validator_end_date_after_start_date_errors(
 
     with pytest.raises(ValueError, match="End date must be after start date."):
         WRFConfig(**wrf_config_dict)
+
+
+def test_compiled_config(tmp_path, config_path_wrf_nci, monkeypatch):
+    monkeypatch.setenv("HOME", "/home/test_user")
+    config_path = str(tmp_path / "config.nci.json")
+    shutil.copy(config_path_wrf_nci, config_path)
+    expected = load_wrf_config(config_path)
+
+    compiled_path = compile_wrf_config(config_path)
+
+    assert compiled_path == str(tmp_path / "config.nci.compiled.json")
+    assert compiled_path == compiled_config_path(config_path)
+    with open(compiled_path) as f:
+        compiled = json.load(f)
+    assert compiled["environment"] == {"HOME": "/home/test_user"}
+    assert load_wrf_config(config_path) == expected
+
+    # The compiled configuration is used while it is up to date
+    compiled["config"]["run_name"] = "compiled"
+    with open(compiled_path, "w") as f:
+        json.dump(compiled, f)
+    assert load_wrf_config(config_path).run_name == "compiled"
+    assert load_wrf_config(config_path, use_compiled=False) == expected
+
+    # ...and ignored once the environment variables or the configuration file change
+    monkeypatch.setenv("HOME", "/home/other_user")
+    assert load_wrf_config(config_path).run_name == expected.run_name
+    monkeypatch.setenv("HOME", "/home/test_user")
+    with open(config_path, "a") as f:
+        f.write("\n")
+    assert load_wrf_config(config_path) == expected
@@ -0,0 +1,127 @@
+import threading
+
+import pytest
+
+from setup_runs.scheduler import Pipeline, PipelineError, Stage
+
+STEPS = ("download", "ungrib", "metgrid")
+
+
+def make_pipeline(calls):
+    pipeline = Pipeline(STEPS)
+    for job in ["a", "b"]:
+        pipeline.add(
+            Stage(
+                f"download {job}",
+                "download",
+                lambda job=job: calls.append(f"download {job}"),
+                outputs=[f"analyses:{job}"],
+            )
+        )
+        pipeline.add(
+            Stage(
+                f"ungrib {job}",
+                "ungrib",
+                lambda job=job: calls.append(f"ungrib {job}"),
+                inputs=[f"analyses:{job}"],
+                outputs=[f"intermediate:{job}"],
+            )
+        )
+        pipeline.add(
+            Stage(
+                f"metgrid {job}",
+                "metgrid",
+                lambda job=job: calls.append(f"metgrid {job}"),
+                inputs=[f"intermediate:{job}", "geo_em"],
+            )
+        )
+    return pipeline
+
+
+def test_order():
+    calls = []
+    pipeline = make_pipeline(calls)
+
+    pipeline.run()
+
+    # Ready stages run in the order they were added
+    assert calls == [
+        "download a",
+        "ungrib a",
+        "metgrid a",
+        "download b",
+        "ungrib b",
+        "metgrid b",
+    ]
+    # Inputs which no stage produces are assumed to exist
+    assert pipeline.dependencies("metgrid a") == {"ungrib a"}
+
+
+def test_concurrent():
+    calls = []
+    pipeline = Pipeline(STEPS)
+    barrier = threading.Barrier(2, timeout=5)
+    # Both downloads have to be running at once to get past the barrier
+    for job in ["a", "b"]:
+        pipeline.add(
+            Stage(
+                f"download {job}",
+                "download",
+                barrier.wait,
+                outputs=[f"analyses:{job}"],
+            )
+        )
+    pipeline.add(
+        Stage(
+            "ungrib",
+            "ungrib",
+            lambda: calls.append("ungrib"),
+            inputs=["analyses:a", "analyses:b"],
+        )
+    )
+
+    pipeline.run(max_workers=2)
+
+    assert calls == ["ungrib"]
+
+
+def test_failure():
+    calls = []
+    pipeline = make_pipeline(calls)
+
+    def fail():
+        raise RuntimeError("download failed")
+
+    pipeline.stages["download a"].action = fail
+
+    with pytest.raises(RuntimeError, match="download failed"):
+        pipeline.run(max_workers=2)
+    assert "ungrib a" not in calls
+    assert "metgrid a" not in calls
+
+
+def test_select():
+    calls = []
+    pipeline = make_pipeline(calls).select("ungrib", "ungrib")
+
+    pipeline.run(max_workers=2)
+
+    assert sorted(calls) == ["ungrib a", "ungrib b"]
+    with pytest.raises(PipelineError, match="Unknown step"):
+        make_pipeline(calls).select("real")
+
+
+def test_invalid():
+    pipeline = Pipeline(STEPS)
+    pipeline.add(Stage("a", "ungrib", print, inputs=["y"], outputs=["x"]))
+
+    with pytest.raises(PipelineError, match="Unknown step"):
+        pipeline.add(Stage("b", "real", print))
+    with pytest.raises(PipelineError, match="Duplicate stage"):
+        pipeline.add(Stage("a", "ungrib", print))
+    with pytest.raises(PipelineError, match="produced by both"):
+        pipeline.add(Stage("c", "ungrib", print, outputs=["x"]))
+
+    pipeline.add(Stage("d", "metgrid", print, inputs=["x"], outputs=["y"]))
+    with pytest.raises(PipelineError, match="cycle"):
+        pipeline.order()
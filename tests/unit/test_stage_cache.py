@@ -0,0 +1,97 @@
+import os
+
+import f90nml
+import pytest
+
+from setup_runs.wrf.stage_cache import (
+    STAGES_FILENAME,
+    StageCache,
+    file_digest,
+    input_key,
+    namelist_section,
+)
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    paths = [tmp_path / "geo_em.d01.nc", tmp_path / "geo_em.d02.nc"]
+    for path in paths:
+        path.write_bytes(b"data")
+    return paths
+
+
+def test_input_key():
+    key = input_key(namelist={"a": 1, "b": [1, 2]}, table="abc")
+
+    assert key == input_key(table="abc", namelist={"b": [1, 2], "a": 1})
+    assert key != input_key(namelist={"a": 2, "b": [1, 2]}, table="abc")
+
+
+def test_namelist_section(root_dir):
+    namelist = f90nml.read(os.path.join(root_dir, "domains/aust-test/namelist.wps"))
+
+    share = namelist_section(namelist, "share", exclude=("start_date", "end_date"))
+
+    assert "start_date" not in share
+    assert share["max_dom"] == namelist["share"]["max_dom"]
+    # The key doesn't depend on the dates of the job
+    namelist["share"]["start_date"] = "2000-01-01_00:00:00"
+    assert input_key(share=share) == input_key(
+        share=namelist_section(namelist, "share", exclude=("start_date", "end_date"))
+    )
+    assert namelist_section(namelist, "missing") == {}
+
+
+def test_file_digest(tmp_path):
+    assert file_digest(tmp_path / "missing") is None
+
+    (tmp_path / "a.TBL").write_text("table")
+    (tmp_path / "b.TBL").write_text("table")
+    assert file_digest(tmp_path / "a.TBL") == file_digest(tmp_path / "b.TBL")
+
+
+def test_record(tmp_path, outputs):
+    stages = StageCache(tmp_path)
+    stages.record("geogrid", "key", outputs)
+
+    assert (tmp_path / STAGES_FILENAME).exists()
+    assert stages.is_current("geogrid", "key", outputs)
+    assert not stages.is_current("geogrid", "other key", outputs)
+    assert not stages.is_current("geogrid", "key", outputs + [tmp_path / "missing"])
+
+
+def test_modified_output(tmp_path, outputs):
+    stages = StageCache(tmp_path)
+    stages.record("geogrid", "key", outputs)
+
+    outputs[1].write_bytes(b"modified")
+
+    assert not stages.is_current("geogrid", "key", outputs)
+
+
+def test_adopt_existing_outputs(tmp_path, outputs):
+    stages = StageCache(tmp_path)
+
+    assert stages.is_current("geogrid", "key", outputs)
+    assert stages.lookup("geogrid")["key"] == "key"
+    # Once recorded, a different key invalidates the outputs
+    assert not stages.is_current("geogrid", "new key", outputs)
+
+
+def test_missing_outputs(tmp_path):
+    stages = StageCache(tmp_path)
+
+    assert not stages.is_current("real", "key", [tmp_path / "wrfbdy_d01"])
+    assert stages.lookup("real") is None
+
+
+def test_invalidate(tmp_path, outputs):
+    stages = StageCache(tmp_path)
+    stages.record("geogrid", "key", outputs)
+    stages.record("met_em.d01.2022-07-22_00:00:00.nc", "key", outputs[:1])
+
+    stages.invalidate("geogrid")
+    stages.invalidate("unknown")
+
+    assert stages.lookup("geogrid") is None
+    assert stages.lookup("met_em.d01.2022-07-22_00:00:00.nc") is not None
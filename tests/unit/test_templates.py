@@ -0,0 +1,48 @@
+import os
+import stat
+
+from setup_runs.templates import Template, render_files, write_if_changed
+
+
+def test_render():
+    template = Template(
+        "cd ${RUN_DIR}\nmpirun -np ${NCPUS:-1} ./wrf.exe ${ARGS} ${RUN_DIR}\n"
+    )
+
+    assert template.names == {"RUN_DIR", "ARGS"}
+    # Placeholders without a value and shell expansions are left in place
+    assert template.render({"RUN_DIR": "/runs/2022072200"}) == (
+        "cd /runs/2022072200\nmpirun -np ${NCPUS:-1} ./wrf.exe ${ARGS} /runs/2022072200\n"
+    )
+    assert Template("no placeholders").render({"RUN_DIR": "x"}) == "no placeholders"
+
+
+def test_write_if_changed(tmp_path):
+    path = tmp_path / "run.sh"
+
+    assert write_if_changed(path, "#!/bin/bash\n", executable=True)
+    assert path.read_text() == "#!/bin/bash\n"
+    assert path.stat().st_mode & stat.S_IEXEC
+    assert list(tmp_path.iterdir()) == [path]
+
+    # Unchanged files aren't rewritten
+    os.utime(path, (0, 0))
+    assert not write_if_changed(path, "#!/bin/bash\n", executable=True)
+    assert path.stat().st_mtime == 0
+
+    assert write_if_changed(path, "#!/bin/bash\necho\n")
+    assert path.read_text() == "#!/bin/bash\necho\n"
+    assert path.stat().st_mtime > 0
+    # The mode of the replaced file is kept
+    assert path.stat().st_mode & stat.S_IEXEC
+
+
+def test_render_files(tmp_path):
+    template = Template("cd ${RUN_DIR}\n")
+    files = [(tmp_path / f"{job}.sh", template, {"RUN_DIR": job}) for job in "ab"]
+
+    assert render_files(files) == [tmp_path / "a.sh", tmp_path / "b.sh"]
+    assert (tmp_path / "b.sh").read_text() == "cd b\n"
+
+    files[1] = (tmp_path / "b.sh", template, {"RUN_DIR": "c"})
+    assert render_files(files) == [tmp_path / "b.sh"]
@@ -0,0 +1,119 @@
+import fcntl
+import multiprocessing
+import subprocess
+
+import pytest
+
+from setup_runs.utils import (
+    file_lock,
+    load_json_entries,
+    run_command,
+    run_commands,
+    stream_command,
+    update_json_entry,
+)
+
+
+def test_run_command_cwd(tmp_path):
+    stdout, stderr = run_command(["pwd"], log_prefix="pwd.log", cwd=tmp_path)
+
+    assert stdout.strip() == str(tmp_path)
+    assert stderr == ""
+    # Relative log files are written in the working directory of the command
+    assert (tmp_path / "pwd.log.stdout").read_text() == stdout
+
+
+def test_stream_command(tmp_path):
+    script = "for i in 1 2 3; do echo line $i; done; echo warning >&2; echo Successful completion"
+    result = stream_command(
+        ["sh", "-c", script],
+        log_prefix="sh.log",
+        cwd=tmp_path,
+        success_pattern="^Successful",
+        tail_lines=2,
+    )
+
+    assert result.succeeded
+    assert result.success_line == "Successful completion"
+    assert result.stdout_tail == ["line 3", "Successful completion"]
+    assert (tmp_path / "sh.log.stdout").read_text() == (
+        "line 1\nline 2\nline 3\nSuccessful completion\n"
+    )
+    assert (tmp_path / "sh.log.stderr").read_text() == "warning\n"
+
+    # A failure pattern overrides the success pattern and the exit code
+    result = stream_command(
+        ["sh", "-c", script],
+        success_pattern="^Successful",
+        failure_patterns=["warn"],
+    )
+    assert not result.succeeded
+    assert result.failure_line == "warning"
+
+    # Without a success pattern the exit code decides
+    assert not stream_command(["sh", "-c", "exit 3"]).succeeded
+
+
+def test_stream_command_timeout(tmp_path):
+    with pytest.raises(subprocess.TimeoutExpired):
+        stream_command(["sleep", "10"], timeout=0.2)
+
+
+def test_run_commands(tmp_path):
+    # Each command waits for a file created by the other,
+    # so they only complete if they run at the same time
+    commands = [
+        ["sh", "-c", "touch a; while [ ! -e b ]; do sleep 0.01; done; echo a"],
+        ["sh", "-c", "touch b; while [ ! -e a ]; do sleep 0.01; done; echo b"],
+    ]
+
+    results = run_commands(commands, cwd=tmp_path, timeout=10)
+
+    assert [result.stdout_tail for result in results] == [["a"], ["b"]]
+    assert all(result.succeeded for result in results)
+
+
+def _hold_lock(path, held, release):
+    with file_lock(path):
+        held.set()
+        release.wait(10)
+
+
+def test_file_lock(tmp_path):
+    lock_path = tmp_path / ".lock"
+    held = multiprocessing.Event()
+    release = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=_hold_lock, args=(lock_path, held, release)
+    )
+    process.start()
+    try:
+        assert held.wait(10)
+        # The lock can't be taken while another process holds it
+        with open(lock_path) as f:
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    finally:
+        release.set()
+        process.join()
+
+    with file_lock(lock_path):
+        pass
+
+
+def test_update_json_entry(tmp_path):
+    path = tmp_path / "manifest.json"
+    assert load_json_entries(path) == {}
+
+    update_json_entry(path, "a", {"size": 1})
+    update_json_entry(path, "b", {"size": 2})
+    update_json_entry(path, "a", None)
+    # Removing a missing entry is a no-op
+    update_json_entry(path, "c", None)
+
+    assert load_json_entries(path) == {"b": {"size": 2}}
+    # Only hidden lock files are left next to the file
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        ".manifest.json.lock",
+        "manifest.json",
+    ]
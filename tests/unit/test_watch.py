@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from setup_runs.watch import InotifyWatcher, inotify_available
+
+pytestmark = pytest.mark.skipif(
+    not inotify_available(), reason="inotify is not available"
+)
+
+
+def test_close_write(tmp_path):
+    with InotifyWatcher(tmp_path) as watcher:
+        assert watcher.read_events(timeout=0) == []
+
+        with open(tmp_path / "wrfout_d01_2022-07-22_00:00:00", "w") as fh:
+            fh.write("partial")
+            # nothing is reported until the file is closed
+            assert watcher.read_events(timeout=0) == []
+
+        assert watcher.read_events(timeout=1) == ["wrfout_d01_2022-07-22_00:00:00"]
+
+
+def test_moved_to(tmp_path):
+    (tmp_path / "incoming").mkdir()
+    (tmp_path / "incoming" / "file.nc").write_text("data")
+
+    with InotifyWatcher(tmp_path) as watcher:
+        os.rename(tmp_path / "incoming" / "file.nc", tmp_path / "file.nc")
+
+        assert watcher.read_events(timeout=1) == ["file.nc"]
+
+
+def test_missing_directory(tmp_path):
+    with pytest.raises(OSError):
+        InotifyWatcher(tmp_path / "missing")